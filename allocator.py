@@ -0,0 +1,193 @@
+import context
+import models
+
+
+SECTIONS = ('instructions', 'goal', 'memory', 'retrieval', 'tool_outputs')
+
+# THE FIXED BUDGETS ADD UP TO THE WINDOW WE HAVE ALWAYS ASSEMBLED; A LARGER MODEL WINDOW CAN BE PASSED IN
+TOTAL_WINDOW = sum(context.BUDGETS.values())
+
+# 1 IS SERVED FIRST. SLACK LEFT BY A SECTION FLOWS DOWN TO THE SECTIONS AFTER IT
+PRIORITIES = {
+    'instructions': 1,
+    'goal': 2,
+    'memory': 3,
+    'retrieval': 4,
+    'tool_outputs': 5
+}
+
+# SHARES OF THE WINDOW. A SECTION IS ALWAYS GIVEN UP TO ITS MINIMUM (IF IT NEEDS IT) BEFORE ANY SECTION IS
+# GIVEN MORE, AND NEVER MORE THAN ITS MAXIMUM, SO A LONG HISTORY CAN'T CROWD OUT THE POLICY TEXT
+MIN_SHARES = {
+    'instructions': 0.05,
+    'goal': 0.05,
+    'memory': 0.01,
+    'retrieval': 0.15,
+    'tool_outputs': 0.05
+}
+
+MAX_SHARES = {
+    'instructions': 0.10,
+    'goal': 0.50,
+    'memory': 0.10,
+    'retrieval': 0.85,
+    'tool_outputs': 0.30
+}
+
+
+# INSTEAD OF FIVE FIXED BUDGETS, WE SPLIT ONE WINDOW BETWEEN THE SECTIONS BY WHAT THEY ACTUALLY NEED:
+#   1. MEASURE EVERY SECTION'S UNTRUNCATED SIZE (ONE BATCHED TOKENIZER CALL + THE RETRIEVAL CHUNK COSTS)
+#   2. RESERVE EACH SECTION'S MINIMUM SHARE, CAPPED AT ITS DEMAND
+#   3. HAND OUT THE REST IN PRIORITY ORDER, EACH SECTION UP TO min(DEMAND, MAXIMUM SHARE)
+#   4. BUILD THE SECTIONS IN PRIORITY ORDER; WHATEVER A SECTION LEAVES UNUSED (E.G. PACKING COULDN'T FILL
+#      RETRIEVAL EXACTLY) IS CARRIED TO THE NEXT SECTION THAT IS STILL SHORT
+# THE RESULT IS THE SAME (assembled, breakdown, overflow, total_tokens) AS context.assemble_context PLUS A
+# DESCRIPTION OF THE ALLOCATION AND EVERY BUDGET THAT MOVED AWAY FROM THE FIXED BUDGETS
+class ContextAllocator:
+
+    def __init__(self, total_tokens=TOTAL_WINDOW, priorities=None, min_shares=None, max_shares=None, strategy=None,
+                 model=None):
+        self.total_tokens = total_tokens
+        self.model = model
+        self.counter = models.model_counter(model)
+        self.priorities = {**PRIORITIES, **(priorities or {})}
+        self.min_shares = {**MIN_SHARES, **(min_shares or {})}
+        self.max_shares = {**MAX_SHARES, **(max_shares or {})}
+        self.strategy = strategy
+
+        for section in SECTIONS:
+            if not 0 <= self.min_shares[section] <= self.max_shares[section] <= 1:
+                raise ValueError(
+                    f"Shares for {section!r} must satisfy 0 <= min <= max <= 1, got "
+                    f"{self.min_shares[section]} and {self.max_shares[section]}"
+                )
+
+        if sum(self.min_shares.values()) > 1:
+            raise ValueError(f"Minimum shares add up to {sum(self.min_shares.values()):.2f}, more than the whole window")
+
+        self.order = sorted(SECTIONS, key=lambda section: (self.priorities[section], SECTIONS.index(section)))
+
+    # AN ALLOCATOR THAT FILLS EVERYTHING THE MODEL'S PROFILE LEAVES FOR THE CONTEXT
+    @classmethod
+    def for_model(cls, model=None, **kwargs):
+        return cls(total_tokens=models.get_profile(model)['input_tokens'], model=model, **kwargs)
+
+    def minimum(self, section):
+        return int(self.total_tokens * self.min_shares[section])
+
+    def maximum(self, section):
+        return int(self.total_tokens * self.max_shares[section])
+
+    # WHAT EACH SECTION WOULD COST WITH NO BUDGET AT ALL
+    # PASS deduplicated=True WHEN retrieved_docs HAVE ALREADY BEEN THROUGH context.prepare_retrieval
+    def demands(self, user_question, retrieved_docs, conversation_history=None, memory_items=None, tool_results=None,
+                deduplicated=False):
+        texts = [
+            context.INSTRUCTIONS,
+            context.goal_text(user_question, conversation_history),
+            context.memory_text(memory_items),
+            context.tool_outputs_text(tool_results)
+        ]
+        instructions, goal, memory, tool_outputs = self.counter.count_many(texts)
+
+        # RETRIEVAL IS MEASURED AFTER THE DEDUP STAGE, AS build_retrieval WILL SEE IT
+        if not deduplicated:
+            retrieved_docs, _ = context.prepare_retrieval(retrieved_docs, self.counter)
+        if retrieved_docs:
+            header_tokens, _, costs, _ = context.retrieval_costs(retrieved_docs, self.counter)
+            retrieval = header_tokens + sum(costs)
+        else:
+            retrieval = 7
+
+        return {
+            'instructions': instructions,
+            'goal': goal,
+            'memory': memory,
+            'retrieval': retrieval,
+            'tool_outputs': tool_outputs
+        }
+
+    def allocate(self, demands):
+        budgets = {section: min(demands[section], self.minimum(section)) for section in SECTIONS}
+        remaining = self.total_tokens - sum(budgets.values())
+
+        for section in self.order:
+            extra = min(remaining, max(0, min(demands[section], self.maximum(section)) - budgets[section]))
+            budgets[section] += extra
+            remaining -= extra
+
+        return budgets, remaining
+
+    def assemble(self, user_question, retrieved_docs, conversation_history=None, memory_items=None, tool_results=None):
+        # DEDUPLICATE ONCE: THE SAME DOCUMENTS ARE MEASURED HERE AND PACKED BY build_retrieval BELOW
+        retrieved_docs, dedup_report = context.prepare_retrieval(retrieved_docs, self.counter)
+        demands = self.demands(
+            user_question, retrieved_docs, conversation_history, memory_items, tool_results, deduplicated=True
+        )
+        budgets, idle = self.allocate(demands)
+
+        builders = {
+            'instructions': lambda budget: context.build_instructions(budget, self.counter),
+            'goal': lambda budget: context.build_goal(user_question, conversation_history, budget, self.counter),
+            'memory': lambda budget: context.build_memory(memory_items, budget, self.counter),
+            'retrieval': lambda budget: context.build_retrieval(
+                retrieved_docs, self.strategy, budget, self.counter, query=user_question, deduplicated=True,
+                dedup_report=dedup_report
+            ),
+            'tool_outputs': lambda budget: context.build_tool_outputs(tool_results, budget, self.counter)
+        }
+
+        sections = {}
+        carried = {}
+        carry = idle
+
+        for section in self.order:
+            shortfall = min(demands[section], self.maximum(section)) - budgets[section]
+            if carry > 0 and shortfall > 0:
+                carried[section] = min(carry, shortfall)
+                budgets[section] += carried[section]
+                carry -= carried[section]
+
+            built = builders[section](budgets[section])
+            built['demand'] = demands[section]
+            built['fixed_budget'] = context.BUDGETS[section]
+            sections[section] = built
+
+            carry += max(0, budgets[section] - built['tokens_used'])
+
+        assembled, breakdown, overflow_occurred, total_tokens = context.assemble_sections(
+            *(sections[section] for section in SECTIONS)
+        )
+
+        reallocations = []
+        for section in SECTIONS:
+            change = budgets[section] - context.BUDGETS[section]
+            if change:
+                reallocations.append({
+                    'section': section,
+                    'action': 'gained' if change > 0 else 'released',
+                    'tokens': abs(change),
+                    'fixed_budget': context.BUDGETS[section],
+                    'budget': budgets[section],
+                    'demand': demands[section],
+                    'carried': carried.get(section, 0)
+                })
+
+        allocation = {
+            'total_tokens': self.total_tokens,
+            'demands': demands,
+            'budgets': budgets,
+            'idle_tokens': self.total_tokens - total_tokens,
+            'reallocations': reallocations
+        }
+
+        return assembled, breakdown, overflow_occurred, total_tokens, allocation
+
+
+def display_allocation(allocation):
+
+    print(f"\nALLOCATION: {allocation['total_tokens']} token window, {allocation['idle_tokens']} tokens idle")
+
+    for decision in allocation['reallocations']:
+        print(f"  → {decision['section']} {decision['action']} {decision['tokens']} tokens "
+              f"({decision['fixed_budget']} → {decision['budget']}, needs {decision['demand']})")
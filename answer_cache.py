@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+CACHE_PATH = "./cache/answers.sqlite3"
+MAX_CACHE_BYTES = 50 * 1024 * 1024
+SIMILARITY_THRESHOLD = 0.95
+
+
+def _hash(payload):
+
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# THE NEAR-DUPLICATE TIER MAY ONLY REUSE AN ANSWER THAT WAS GENERATED FROM THE SAME POLICY TEXT, MEMORY AND TOOL
+# OUTPUTS WITH THE SAME MODEL SETTINGS; ONLY THE WORDING OF THE QUESTION IS ALLOWED TO DIFFER
+def answer_scope(model_params, breakdown):
+
+    return _hash({
+        'model': model_params,
+        'memory': breakdown['memory']['content'],
+        'retrieval': breakdown['retrieval']['content'],
+        'tool_outputs': breakdown['tool_outputs']['content']
+    })
+
+
+# ON-DISK ANSWER CACHE WITH TWO TIERS:
+#   EXACT    - KEYED BY A HASH OF THE ASSEMBLED PROMPT AND THE MODEL PARAMETERS
+#   SEMANTIC - WITHIN THE SAME SCOPE, A PREVIOUS QUESTION WHOSE EMBEDDING IS ABOVE THE SIMILARITY THRESHOLD
+# WHEN THE FILE GROWS PAST max_bytes THE LEAST RECENTLY USED ANSWERS ARE EVICTED
+class AnswerCache:
+
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_CACHE_BYTES, similarity_threshold=SIMILARITY_THRESHOLD):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.similarity_threshold = similarity_threshold
+        self.hits = {'exact': 0, 'semantic': 0}
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._scopes = {}
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                scope TEXT,
+                question TEXT,
+                embedding BLOB,
+                answer TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS answers_scope ON answers(scope)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers(last_used)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(prompt, model_params):
+        return _hash({'prompt': prompt, 'model': model_params})
+
+    # WE KEEP ONE NORMALIZED EMBEDDING MATRIX PER SCOPE IN MEMORY SO A SEMANTIC LOOKUP IS A SINGLE MATRIX-VECTOR PRODUCT
+    def _scope_matrix(self, scope):
+        if scope not in self._scopes:
+            rows = self._db.execute(
+                "SELECT key, embedding FROM answers WHERE scope = ? AND embedding IS NOT NULL", (scope,)
+            ).fetchall()
+
+            keys = [row[0] for row in rows]
+            matrix = np.array([np.frombuffer(row[1], dtype=np.float32) for row in rows], dtype=np.float32)
+            self._scopes[scope] = (keys, matrix)
+
+        return self._scopes[scope]
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _touch(self, key):
+        self._db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+        self._db.commit()
+
+    # RETURNS (answer, tier) WHERE tier IS 'exact' OR 'semantic', OR (None, None) ON A MISS
+    def get(self, prompt, model_params, query_embedding=None, scope=None):
+        key = self.make_key(prompt, model_params)
+
+        with self._lock:
+            row = self._db.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+
+            if row:
+                self._touch(key)
+                self.hits['exact'] += 1
+                return row[0], 'exact'
+
+            if self.similarity_threshold is not None and query_embedding is not None and scope is not None:
+                keys, matrix = self._scope_matrix(scope)
+
+                if keys and matrix.shape[1] == len(query_embedding):
+                    similarities = matrix @ self._normalize(query_embedding)
+                    best = int(np.argmax(similarities))
+
+                    if similarities[best] >= self.similarity_threshold:
+                        row = self._db.execute("SELECT answer FROM answers WHERE key = ?", (keys[best],)).fetchone()
+                        if row:
+                            self._touch(keys[best])
+                            self.hits['semantic'] += 1
+                            return row[0], 'semantic'
+
+            self.misses += 1
+            return None, None
+
+    def put(self, prompt, model_params, answer, question=None, query_embedding=None, scope=None):
+        key = self.make_key(prompt, model_params)
+        embedding = None if query_embedding is None else self._normalize(query_embedding)
+        blob = None if embedding is None else embedding.tobytes()
+        size = len(prompt.encode('utf-8')) + len(answer.encode('utf-8')) + (len(blob) if blob else 0)
+        now = time.time()
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers (key, scope, question, embedding, answer, size, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, scope, question, blob, answer, size, now, now)
+            )
+            self._db.commit()
+            self._scopes.pop(scope, None)
+            self._evict()
+
+    # WE EVICT LEAST RECENTLY USED ANSWERS UNTIL THE CACHE IS BACK UNDER 90% OF ITS SIZE LIMIT
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+
+        if total <= self.max_bytes:
+            return
+
+        target = self.max_bytes * 0.9
+        evicted = []
+
+        for key, size in self._db.execute("SELECT key, size FROM answers ORDER BY last_used").fetchall():
+            if total <= target:
+                break
+            evicted.append((key,))
+            total -= size
+
+        self._db.executemany("DELETE FROM answers WHERE key = ?", evicted)
+        self._db.commit()
+        self._scopes.clear()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+
+        return {
+            'exact_hits': self.hits['exact'],
+            'semantic_hits': self.hits['semantic'],
+            'misses': self.misses,
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,397 @@
+from memory_store import MemoryStore
+from pipeline import AsyncPipeline, Session
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+
+MAX_CONCURRENCY = 8
+# HOW MANY RECORDS ARE READ AHEAD OF THE ONES BEING ANSWERED, PER CONCURRENT REQUEST; THE INPUT IS NEVER LOADED WHOLE
+READ_AHEAD = 4
+TIMEOUT = 120.0
+
+STAGES = ('retrieval_seconds', 'sections_seconds', 'assembly_seconds', 'generation_seconds', 'total_seconds')
+
+
+def percentile(values, fraction):
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# THE SESSIONS' CONVERSATION MEMORY LIVES NEXT TO THE RESULTS (results.jsonl -> results.memory.sqlite3)
+def memory_path(output):
+
+    return os.path.splitext(output)[0] + ".memory.sqlite3"
+
+
+# ONE RECORD PER INPUT LINE: {"question": ..., "id": ..., "session_id": ...}. id DEFAULTS TO THE LINE NUMBER;
+# RECORDS THAT SHARE A session_id ARE ONE CONVERSATION, ANSWERED IN FILE ORDER. LINES THAT ARE NOT A RECORD ARE
+# PASSED ON WITH THEIR ERROR, SO THEY SHOW UP IN THE RESULTS INSTEAD OF STOPPING THE RUN
+def read_records(path):
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                record, error = {}, f"invalid JSON: {e}"
+            else:
+                record = record if isinstance(record, dict) else {}
+                error = None if isinstance(record.get('question'), str) and record['question'].strip() else \
+                    "no question in record"
+
+            session_id = record.get('session_id', record.get('session'))
+            yield {
+                'id': str(record.get('id', record.get('request_id', line_number))),
+                'line': line_number,
+                'session_id': None if session_id is None else str(session_id),
+                'question': record.get('question'),
+                'error': error
+            }
+
+
+# A RECORD IS DONE ONCE IT HAS AN 'ok' RESULT; FAILED RECORDS ARE RETRIED ON RESUME AND THE LAST LINE FOR AN id WINS
+# A LINE CUT SHORT BY AN INTERRUPTED RUN IS REMOVED, SO THE NEXT RESULT STARTS ON A LINE OF ITS OWN
+def load_done(output):
+
+    if not os.path.exists(output):
+        return set()
+
+    done = set()
+    offset = 0
+
+    with open(output, 'rb+') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                f.truncate(offset)
+                break
+            offset += len(line)
+
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get('status') == 'ok':
+                done.add(result['id'])
+            else:
+                done.discard(result.get('id'))
+
+    return done
+
+
+# THE RESULTS ARE THE ONLY CHECKPOINT: ON RESUME THE SESSIONS ARE REBUILT BY RECORDING THEIR ANSWERED TURNS AGAIN,
+# IN THE ORDER THEY WERE ANSWERED, SO A TURN THAT REACHED THE MEMORY BUT NOT THE RESULTS IS NOT COUNTED TWICE
+def restore_sessions(output, memory_store):
+
+    sessions = {}
+
+    with open(output, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get('status') != 'ok' or result['session_id'] is None or result.get('answer') is None:
+                continue
+
+            session_id = result['session_id']
+            if session_id not in sessions:
+                sessions[session_id] = memory_store.session(session_id)
+            sessions[session_id].record_turn(result['question'], result['answer'])
+
+    return len(sessions)
+
+
+def clear_memory(output):
+
+    for path in (memory_path(output), memory_path(output) + "-wal", memory_path(output) + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# THE TOKENS, BUDGET AND TRUNCATION FLAG OF EACH SECTION, WITH THE RETRIEVAL'S CHUNK COUNTS AND WHAT DEDUP AND
+# COMPRESSION REMOVED; NOT THE TEXT ITSELF
+def token_breakdown(breakdown):
+
+    sections = {}
+
+    for name, section in breakdown.items():
+        sections[name] = {
+            'tokens_used': section['tokens_used'],
+            'budget': section['budget'],
+            'truncated': section['truncated']
+        }
+
+    retrieval = breakdown['retrieval']
+    sections['retrieval'].update({
+        'chunks_kept': retrieval.get('chunks_kept', 0),
+        'chunks_dropped': retrieval.get('chunks_dropped', 0),
+        'tokens_deduplicated': (retrieval.get('dedup') or {}).get('tokens_saved', 0),
+        'tokens_compressed': (retrieval.get('compression') or {}).get('tokens_removed', 0)
+    })
+
+    return sections
+
+
+def serialize_result(record, result, latency):
+
+    return {
+        'id': record['id'],
+        'line': record['line'],
+        'session_id': record['session_id'],
+        'question': record['question'],
+        'status': 'ok',
+        'answer': result.get('answer'),
+        'cache_hit': result.get('cache_hit'),
+        'sources': [document.metadata.get('source', 'unknown') for document in result['retrieved_docs']],
+        'total_tokens': result['total_tokens'],
+        'overflow': result['overflow'],
+        'truncated_sections': [name for name, section in result['breakdown'].items() if section['truncated']],
+        'tokens': token_breakdown(result['breakdown']),
+        'timings': dict(result['timings'], latency_seconds=latency)
+    }
+
+
+def serialize_failure(record, status, error, latency):
+
+    return {
+        'id': record['id'],
+        'line': record['line'],
+        'session_id': record['session_id'],
+        'question': record['question'],
+        'status': status,
+        'error': error,
+        'timings': {'latency_seconds': latency}
+    }
+
+
+# STREAMS THE RECORDS THROUGH THE PIPELINE (RETRIEVE -> ASSEMBLE -> GENERATE) AND APPENDS ONE RESULT LINE PER
+# RECORD AS SOON AS IT FINISHES, SO THE OUTPUT IS ALSO THE CHECKPOINT
+#   - THE PIPELINE'S SEMAPHORE BOUNDS HOW MANY RECORDS ARE ANSWERED AT ONCE; READ_AHEAD BOUNDS HOW MANY ARE WAITING
+#   - A RECORD WAITS FOR THE PREVIOUS RECORD OF ITS SESSION, SO A CONVERSATION IS ANSWERED TURN BY TURN WHILE
+#     DIFFERENT CONVERSATIONS RUN CONCURRENTLY. A SESSION IS DROPPED FROM MEMORY WHEN IT HAS NOTHING QUEUED; ITS
+#     HISTORY STAYS IN THE MemoryStore AND IS LOADED AGAIN IF THE SESSION COMES BACK LATER IN THE FILE
+#   - RECORDS WITHOUT A session_id ARE SINGLE QUESTIONS WITH NO HISTORY, AND ARE NOT PERSISTED
+# WITH assemble_only THE LLM IS NOT CALLED AND SESSIONS DON'T CHANGE
+class BatchRunner:
+
+    def __init__(self, pipeline, output, memory_store=None, assemble_only=False, read_ahead=READ_AHEAD):
+        self.pipeline = pipeline
+        self.output = output
+        self.memory_store = memory_store
+        self.assemble_only = assemble_only
+        self.read_ahead = read_ahead
+        self._sessions = {}
+        self.results = []
+
+    async def _session(self, session_id):
+        if session_id is None:
+            return Session()
+
+        if session_id not in self._sessions:
+            self._sessions[session_id] = await asyncio.to_thread(Session, session_id, self.memory_store)
+        return self._sessions[session_id]
+
+    async def _answer(self, record):
+        if record['error']:
+            return serialize_failure(record, 'error', record['error'], 0.0)
+
+        start = time.perf_counter()
+        try:
+            session = await self._session(record['session_id'])
+            if self.assemble_only:
+                result = await self.pipeline.assemble_async(record['question'], session)
+            else:
+                result = await self.pipeline.answer_async(record['question'], session)
+        except asyncio.TimeoutError:
+            return serialize_failure(record, 'timeout', "timed out", time.perf_counter() - start)
+        except Exception as e:
+            return serialize_failure(record, 'error', f"{type(e).__name__}: {e}", time.perf_counter() - start)
+
+        return serialize_result(record, result, time.perf_counter() - start)
+
+    async def _run_record(self, record, previous, out):
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        result = await self._answer(record)
+        out.write(json.dumps(result, default=str) + "\n")
+        out.flush()
+
+        self.results.append({
+            'status': result['status'],
+            'timings': result['timings'],
+            'total_tokens': result.get('total_tokens', 0),
+            'truncated': bool(result.get('truncated_sections'))
+        })
+
+    async def run(self, records):
+        window = asyncio.Semaphore(self.pipeline.max_concurrency * self.read_ahead)
+        tasks = set()
+        last = {}
+
+        def finished(task, session_id):
+            window.release()
+            tasks.discard(task)
+            if last.get(session_id) is task:
+                del last[session_id]
+                self._sessions.pop(session_id, None)
+
+        start = time.perf_counter()
+        os.makedirs(os.path.dirname(self.output) or ".", exist_ok=True)
+
+        with open(self.output, 'a', encoding='utf-8') as out:
+            for record in records:
+                await window.acquire()
+
+                session_id = record['session_id']
+                task = asyncio.ensure_future(
+                    self._run_record(record, last.get(session_id) if session_id is not None else None, out)
+                )
+                tasks.add(task)
+                if session_id is not None:
+                    last[session_id] = task
+                task.add_done_callback(lambda task, session_id=session_id: finished(task, session_id))
+
+            await asyncio.gather(*tasks)
+
+        return self.summary(time.perf_counter() - start)
+
+    def summary(self, elapsed):
+        ok = [result for result in self.results if result['status'] == 'ok']
+        latencies = [result['timings']['latency_seconds'] for result in ok]
+
+        summary = {
+            'records': len(self.results),
+            'ok': len(ok),
+            'timeouts': sum(1 for result in self.results if result['status'] == 'timeout'),
+            'errors': sum(1 for result in self.results if result['status'] == 'error'),
+            'truncated': sum(1 for result in ok if result['truncated']),
+            'wall_seconds': elapsed,
+            'requests_per_second': len(self.results) / elapsed if elapsed else 0.0,
+            'context_tokens_per_second': sum(result['total_tokens'] for result in ok) / elapsed if elapsed else 0.0,
+            'latency_seconds': None,
+            'stage_mean_seconds': {}
+        }
+
+        if latencies:
+            summary['latency_seconds'] = {
+                'p50': percentile(latencies, 0.50),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'max': max(latencies)
+            }
+        for stage in STAGES:
+            values = [result['timings'][stage] for result in ok if stage in result['timings']]
+            if values:
+                summary['stage_mean_seconds'][stage] = statistics.mean(values)
+
+        return summary
+
+
+def display_summary(summary, skipped):
+
+    print(f"Records:     {summary['records']} answered, {skipped} already done  "
+          f"({summary['ok']} ok, {summary['timeouts']} timed out, {summary['errors']} failed, "
+          f"{summary['truncated']} truncated)")
+    print(f"Wall time:   {summary['wall_seconds']:.2f}s   throughput {summary['requests_per_second']:.2f} req/s, "
+          f"{summary['context_tokens_per_second']:.0f} context tokens/s")
+
+    latency = summary['latency_seconds']
+    if latency:
+        print(f"Latency:     p50 {latency['p50'] * 1000:.0f} ms   p95 {latency['p95'] * 1000:.0f} ms   "
+              f"p99 {latency['p99'] * 1000:.0f} ms")
+    for stage, mean in summary['stage_mean_seconds'].items():
+        print(f"  {stage:<20} mean {mean * 1000:7.1f} ms")
+
+
+# THE SAME RETRIEVER AND MODEL AS THE CLI AND THE SERVER, OR (fake) THE DETERMINISTIC STAND-INS FROM fakes.py OVER
+# THE POLICY FILES, FOR DRY RUNS WITHOUT OLLAMA
+def build_pipeline(max_concurrency=MAX_CONCURRENCY, timeout=TIMEOUT, fake=False):
+
+    if fake:
+        from fakes import FakeLLM, FakeRetriever
+        from ingest import iter_policy_files, split_policy_file
+
+        documents = [
+            document
+            for name, content in iter_policy_files(os.path.join(os.path.dirname(os.path.abspath(__file__)), "policies"))
+            for document in split_policy_file(name, content)
+        ]
+        retriever, model = FakeRetriever(documents, k=6), FakeLLM(answer_tokens=40)
+    else:
+        from langchain_ollama import OllamaLLM
+        import models
+        import pipeline
+        import vector_db
+
+        retriever = vector_db.get_retriever()
+        model = OllamaLLM(model=pipeline.LLM_MODEL, temperature=0.1, **models.ollama_options(pipeline.LLM_MODEL))
+
+    return AsyncPipeline(retriever, model, max_concurrency=max_concurrency, retrieval_timeout=timeout,
+                         generation_timeout=timeout)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions offline and write JSONL results")
+    parser.add_argument("input", help='one {"question": ..., "id": ..., "session_id": ...} per line')
+    parser.add_argument("output", help="results, one line per record")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENCY, help="records answered at once")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="seconds per retrieval and per generation")
+    parser.add_argument("--resume", action="store_true", help="skip records already answered in the output")
+    parser.add_argument("--assemble-only", action="store_true", help="retrieve and assemble without calling the LLM")
+    parser.add_argument("--fake", action="store_true", help="use the fake retriever and LLM (no Ollama)")
+    parser.add_argument("--summary", help="also write the run summary as JSON to this file")
+    args = parser.parse_args()
+
+    done = load_done(args.output) if args.resume else set()
+    if not args.resume and os.path.exists(args.output):
+        os.remove(args.output)
+    clear_memory(args.output)
+
+    skipped = 0
+
+    def pending(records):
+        nonlocal skipped
+        for record in records:
+            if record['id'] in done:
+                skipped += 1
+                continue
+            yield record
+
+    memory_store = MemoryStore(memory_path(args.output))
+    if done:
+        print(f"Resuming: {len(done)} records done, {restore_sessions(args.output, memory_store)} sessions restored")
+    runner = BatchRunner(
+        build_pipeline(args.concurrency, args.timeout, args.fake),
+        args.output,
+        memory_store=memory_store,
+        assemble_only=args.assemble_only
+    )
+
+    try:
+        summary = asyncio.run(runner.run(pending(read_records(args.input))))
+    except KeyboardInterrupt:
+        print(f"\nInterrupted after {len(runner.results)} records; rerun with --resume to continue", file=sys.stderr)
+        sys.exit(130)
+    finally:
+        memory_store.close()
+
+    display_summary(summary, skipped)
+
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flat_store import FlatVectorStore, normalize
+from ivf_store import IVFVectorStore
+
+
+NPROBES = [1, 2, 4, 8, 16, 32, 64]
+UPSERT_BATCH = 4096
+
+
+# EMBEDDINGS CLUSTER BY TOPIC, SO WE DRAW THEM AROUND RANDOM CENTRES; QUERIES ARE NOISIER DRAWS FROM THE SAME
+# CENTRES. spread IS THE LENGTH OF THE NOISE RELATIVE TO THE (UNIT) CENTRE
+def synthetic_embeddings(rng, rows, dim, clusters, queries, spread=0.6):
+
+    centres = normalize(rng.standard_normal((clusters, dim)).astype(np.float32))
+    noise = spread / np.sqrt(dim)
+
+    def draw(count, scale):
+        return normalize(centres[rng.integers(clusters, size=count)]
+                         + scale * rng.standard_normal((count, dim)).astype(np.float32))
+
+    return draw(rows, noise), draw(queries, 1.5 * noise)
+
+
+def fill(store, vectors):
+
+    for start in range(0, len(vectors), UPSERT_BATCH):
+        batch = vectors[start:start + UPSERT_BATCH]
+        ids = [f"doc-{i}" for i in range(start, start + len(batch))]
+        store.upsert(ids, batch, documents=[""] * len(batch))
+
+
+# ONE QUERY AT A TIME, THE WAY THE RETRIEVER ASKS
+def run_queries(store, queries, k):
+
+    results, seconds = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hits = store.search_batch([query], k)[0]
+        seconds.append(time.perf_counter() - start)
+        results.append({document.id for document, _ in hits})
+    return results, seconds
+
+
+def percentile(values, fraction):
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Recall@k and latency of the IVF store against exact flat search")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--spread", type=float, default=0.6, help="cluster noise relative to the centre")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists (default 4 * sqrt(rows))")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors, queries = synthetic_embeddings(rng, args.rows, args.dim, args.clusters, args.queries, args.spread)
+
+    with tempfile.TemporaryDirectory() as flat_dir, tempfile.TemporaryDirectory() as ivf_dir:
+        flat = FlatVectorStore("bench", flat_dir, None)
+        fill(flat, vectors)
+
+        start = time.perf_counter()
+        ivf = IVFVectorStore("bench", ivf_dir, None, nlist=args.nlist)
+        fill(ivf, vectors)
+        ivf.train()
+        build_seconds = time.perf_counter() - start
+
+        exact, exact_seconds = run_queries(flat, queries, args.k)
+
+        print(f"{args.rows} vectors x {args.dim} dims, {len(ivf._ivf['centroids'])} lists, "
+              f"built and trained in {build_seconds:.2f}s\n")
+        print(f"{'search':<12} {'recall@' + str(args.k):>10} {'p50 (ms)':>9} {'p95 (ms)':>9} {'speedup':>8}")
+        print(f"{'exact':<12} {1.0:>10.3f} {statistics.median(exact_seconds) * 1000:>9.3f} "
+              f"{percentile(exact_seconds, 0.95) * 1000:>9.3f} {1.0:>7.1f}x")
+
+        for nprobe in NPROBES:
+            ivf.nprobe = nprobe
+            approximate, seconds = run_queries(ivf, queries, args.k)
+            recall = statistics.mean(len(found & truth) / len(truth) for found, truth in zip(approximate, exact))
+
+            print(f"{'nprobe=' + str(nprobe):<12} {recall:>10.3f} {statistics.median(seconds) * 1000:>9.3f} "
+                  f"{percentile(seconds, 0.95) * 1000:>9.3f} "
+                  f"{statistics.median(exact_seconds) / statistics.median(seconds):>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
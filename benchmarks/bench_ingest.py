@@ -0,0 +1,74 @@
+from langchain_chroma import Chroma
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeEmbeddings
+import ingest
+
+
+WORDS = (
+    "travel expense policy receipt hotel flight meal allowance per diem approval manager "
+    "reimbursement international domestic taxi rental car mileage luggage booking economy "
+    "business class cancellation exception regional london tokyo nairobi invoice currency"
+).split()
+
+
+# WE GENERATE SYNTHETIC POLICY FILES MADE OF HEADED SECTIONS AND BULLET LISTS LIKE THE REAL ONES
+def synthetic_policy(rng, sections=8):
+
+    lines = []
+    for section in range(sections):
+        lines.append(f"SECTION {section + 1}: {' '.join(rng.sample(WORDS, 3)).upper()}")
+        lines.append("")
+        for _ in range(rng.randint(3, 8)):
+            lines.append("- " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))) + ".")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the ingest pipeline with a fake embedding backend")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=ingest.EMBED_BATCH_SIZE)
+    parser.add_argument("--embed-workers", type=int, default=ingest.EMBED_WORKERS)
+    parser.add_argument("--split-workers", type=int, default=ingest.SPLIT_WORKERS)
+    parser.add_argument("--embed-delay", type=float, default=0.02, help="simulated seconds per embedding request")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    files = [(f"policy_{i:05d}.txt", synthetic_policy(rng)) for i in range(args.files)]
+
+    split_results, split_stats = ingest.split_files(files, workers=args.split_workers)
+    documents = [document for batch in split_results.values() for document in batch]
+
+    print(f"Split {split_stats['chunks']} chunks from {split_stats['files']} files in "
+          f"{split_stats['seconds']:.2f}s ({split_stats['chunks_per_sec']:.0f} chunks/sec)")
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        vector_store = Chroma(
+            collection_name="bench_ingest",
+            persist_directory=db_dir,
+            embedding_function=FakeEmbeddings(delay=args.embed_delay)
+        )
+
+        embed_stats = ingest.embed_and_store(
+            vector_store,
+            documents,
+            os.path.join(db_dir, "checkpoint.jsonl"),
+            signature="bench",
+            batch_size=args.batch_size,
+            workers=args.embed_workers
+        )
+
+    print(f"Embedded {embed_stats['embedded']} chunks in {embed_stats['batches']} batches in "
+          f"{embed_stats['seconds']:.2f}s ({embed_stats['embeddings_per_sec']:.0f} embeddings/sec)")
+
+
+if __name__ == "__main__":
+    main()
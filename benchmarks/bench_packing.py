@@ -0,0 +1,53 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import packing
+
+
+BUDGET = 540
+SIZES = [6, 20, 50, 100, 250, 500]
+
+
+# CANDIDATES LOOK LIKE RETRIEVED CHUNKS: 40-300 TOKENS EACH, WITH RELEVANCE DECAYING BY RANK PLUS SOME NOISE
+def synthetic_candidates(rng, count):
+
+    costs = [rng.randint(40, 300) for _ in range(count)]
+    scores = sorted((max(0.01, 1.0 - i / count + rng.uniform(-0.1, 0.1)) for i in range(count)), reverse=True)
+    return costs, scores
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Compare retrieval packing strategies on synthetic candidate sets")
+    parser.add_argument("--trials", type=int, default=50)
+    parser.add_argument("--budget", type=int, default=BUDGET)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+
+    print(f"{'chunks':>6}  {'strategy':<9} {'budget used':>11} {'relevance':>10} {'kept':>6} {'time (ms)':>10}")
+
+    for size in SIZES:
+        candidate_sets = [synthetic_candidates(rng, size) for _ in range(args.trials)]
+
+        for strategy in packing.STRATEGIES:
+            used, relevance, kept, seconds = [], [], [], []
+
+            for costs, scores in candidate_sets:
+                result = packing.pack(strategy, costs, scores, args.budget)
+                used.append(result['tokens_selected'] / args.budget)
+                relevance.append(result['score_selected'])
+                kept.append(len(result['selected']))
+                seconds.append(result['seconds'])
+
+            print(f"{size:>6}  {strategy:<9} {statistics.mean(used):>10.1%} {statistics.mean(relevance):>10.2f} "
+                  f"{statistics.mean(kept):>6.1f} {statistics.mean(seconds) * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import context
+import models
+from fakes import FakeLLM, FakeRetriever
+from generation import BackendSession, stream_answer
+from ingest import iter_policy_files, split_policy_file
+
+
+LLM_MODEL = "llama3.2:1b"
+
+# ONE SESSION OF FOLLOW-UP QUESTIONS, THE WAY A USER ASKS THEM IN main.py
+QUESTIONS = [
+    "I'm traveling to London next week - what do I need to know?",
+    "What's the hotel limit there?",
+    "And the meal allowance?",
+    "Can I expense Uber rides from the airport?",
+    "Do I need receipts for those?",
+    "What about a rental car instead?",
+    "Is business class allowed on the flight?",
+    "Who has to approve the trip?",
+    "What if I extend the trip for a personal weekend?",
+    "How do I submit the expense report afterwards?",
+]
+
+
+def common_prefix(first, second):
+
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+    return length
+
+
+# ONE MULTI-TURN SESSION IN ONE LAYOUT: RETRIEVE, ASSEMBLE, PROMPT AND STREAM THE ANSWER, THEN RECORD THE TURN IN
+# THE HISTORY AS main.py DOES. THE BACKEND REPORTS HOW MANY PROMPT TOKENS IT HAD TO EVALUATE EACH TURN
+def run_session(layout, model, retriever, turns):
+
+    backend = BackendSession()
+    conversation_history = []
+    memory_items = ["User is based in the New York office.", "User travels for client work."]
+    previous_prompt = ""
+    rows = []
+
+    for question in (QUESTIONS * (turns // len(QUESTIONS) + 1))[:turns]:
+        assembled_context, _, _, _ = context.assemble_context(
+            question, retriever.invoke(question), conversation_history, memory_items, model=LLM_MODEL, layout=layout
+        )
+        prompt = context.build_prompt(assembled_context, question, layout)
+
+        stream = stream_answer(model, prompt, backend)
+        answer = "".join(stream)
+        timings = stream.timings()
+
+        rows.append({
+            'prompt_chars': len(prompt),
+            'stable_chars': common_prefix(previous_prompt, prompt),
+            'prompt_eval_count': timings.get('prompt_eval_count'),
+            'prompt_eval_seconds': timings.get('prompt_eval_seconds') or 0.0,
+            'ttft_seconds': timings['ttft_seconds']
+        })
+        previous_prompt = prompt
+
+        conversation_history += [{'role': 'user', 'content': question}, {'role': 'assistant', 'content': answer[:200]}]
+        conversation_history = conversation_history[-6:]
+
+    return rows
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Prompt-eval time per turn of a session, for each prompt layout")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--prompt-token-ms", type=float, default=0.2,
+                        help="stand-in model: milliseconds to evaluate one uncached prompt token")
+    parser.add_argument("--ollama", action="store_true", help=f"measure the real {LLM_MODEL} instead of the stand-in")
+    args = parser.parse_args()
+
+    documents = [
+        document
+        for name, content in iter_policy_files(os.path.join(ROOT, "policies"))
+        for document in split_policy_file(name, content)
+    ]
+    retriever = FakeRetriever(documents, k=6)
+
+    for layout in ('classic', 'prefix_stable'):
+        # A FRESH MODEL PER LAYOUT, SO NEITHER STARTS WITH THE OTHER'S CACHE
+        if args.ollama:
+            from langchain_ollama import OllamaLLM
+            model = OllamaLLM(model=LLM_MODEL, temperature=0.1, **models.ollama_options(LLM_MODEL))
+            model.invoke("", keep_alive=0)
+        else:
+            model = FakeLLM(answer_tokens=40, prompt_token_delay=args.prompt_token_ms / 1000)
+
+        rows = run_session(layout, model, retriever, args.turns)
+
+        print(f"\n{layout.upper()}")
+        print(f"{'turn':>4} {'prompt chars':>13} {'stable prefix':>14} {'evaluated':>10} {'prompt eval (ms)':>17} "
+              f"{'ttft (ms)':>10}")
+        for turn, row in enumerate(rows, 1):
+            print(f"{turn:>4} {row['prompt_chars']:>13} {row['stable_chars']:>14} {row['prompt_eval_count']:>10} "
+                  f"{row['prompt_eval_seconds'] * 1000:>17.1f} {row['ttft_seconds'] * 1000:>10.1f}")
+
+        later = rows[1:] or rows
+        print(f"  total prompt eval {sum(row['prompt_eval_seconds'] for row in rows) * 1000:.1f} ms, "
+              f"after the first turn {sum(row['prompt_eval_seconds'] for row in later) / len(later) * 1000:.1f} ms/turn, "
+              f"stable prefix {sum(row['stable_chars'] / row['prompt_chars'] for row in later) / len(later):.0%} "
+              f"of the prompt")
+
+
+if __name__ == "__main__":
+    main()
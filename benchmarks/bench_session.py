@@ -0,0 +1,106 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import context
+import models
+from context_session import ContextSession
+from fakes import FakeRetriever
+from ingest import iter_policy_files, split_policy_file
+from tokenizer import TokenCounter
+
+
+QUESTIONS = [
+    "When do I need receipts for expenses?",
+    "What's the meal allowance for domestic travel?",
+    "Can I expense Uber rides during business travel?",
+    "What are all the rules for international travel including flights, hotels, and meals?",
+    "I'm traveling to London next week - what do I need to know?",
+    "Tell me about ground transportation including Uber, taxis, and rental cars",
+]
+
+WINDOW = 10
+
+
+# THE BREAKDOWN RECORDS HOW LONG PACKING, DEDUP AND COMPRESSION TOOK; THOSE ARE THE ONLY FIELDS ALLOWED TO DIFFER
+def without_timings(value):
+
+    if isinstance(value, dict):
+        return {key: without_timings(item) for key, item in value.items() if not key.endswith('seconds')}
+    if isinstance(value, (list, tuple)):
+        return type(value)(without_timings(item) for item in value)
+    return value
+
+
+# ONE LONG CONVERSATION, ASSEMBLED EACH TURN BY THE STATELESS FUNCTION AND BY A ContextSession. EVERY TURN THE TWO
+# RESULTS MUST BE IDENTICAL; THE TIMINGS SHOW WHETHER THE PER-TURN COST STAYS FLAT AS THE SESSION GROWS
+# THE SESSION COUNTS WITH ITS OWN TokenCounter, SO IT NEVER HITS TOKEN-CACHE ENTRIES THE STATELESS PASS JUST MADE
+def main():
+
+    parser = argparse.ArgumentParser(description="Per-turn context assembly cost over a long session")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--cold", action="store_true",
+                        help="clear the shared token cache before every assembly, as on a busy server where other "
+                             "sessions evict this one's entries")
+    args = parser.parse_args()
+
+    documents = [
+        document
+        for name, content in iter_policy_files(os.path.join(ROOT, "policies"))
+        for document in split_policy_file(name, content)
+    ]
+    retriever = FakeRetriever(documents, k=6)
+    retrieved = {question: retriever.invoke(question) for question in QUESTIONS}
+
+    counter = models.model_counter()
+    session = ContextSession(counter=TokenCounter(counter.encoding_name))
+    conversation_history = []
+    memory_items = []
+    stateless_seconds, session_seconds = [], []
+
+    for turn in range(args.turns):
+        # EACH QUESTION IS ASKED TWICE IN A ROW (A REPHRASED FOLLOW-UP GETS THE SAME CHUNKS); A FACT IS LEARNED EVERY
+        # FIFTH TURN
+        question = QUESTIONS[turn // 2 % len(QUESTIONS)] + ("" if turn % 2 == 0 else " Please be specific.")
+        retrieved_docs = retrieved[QUESTIONS[turn // 2 % len(QUESTIONS)]]
+        if turn % 5 == 4:
+            memory_items = (memory_items + [f"Fact {turn}: the user asked about {question.split()[-1]}"])[-3:]
+
+        if args.cold:
+            counter.clear()
+        start = time.perf_counter()
+        expected = context.assemble_context(question, retrieved_docs, conversation_history, memory_items)
+        stateless_seconds.append(time.perf_counter() - start)
+
+        if args.cold:
+            session.counter.clear()
+        start = time.perf_counter()
+        actual = session.assemble(question, retrieved_docs, conversation_history, memory_items)
+        session_seconds.append(time.perf_counter() - start)
+
+        if without_timings(actual) != without_timings(expected):
+            raise SystemExit(f"turn {turn + 1}: ContextSession output differs from assemble_context")
+
+        conversation_history.append({'role': 'user', 'content': question})
+        conversation_history.append({'role': 'assistant', 'content': f"Answer {turn}: " + "see the policy. " * 20})
+
+    print(f"{args.turns} turns, outputs identical on every turn (apart from stage timings)\n")
+    print(f"{'turns':>11} {'stateless (ms)':>15} {'session (ms)':>13}")
+    for start in range(0, args.turns, max(WINDOW, args.turns // 10)):
+        window = slice(start, start + WINDOW)
+        print(f"{start + 1:>5}-{min(start + WINDOW, args.turns):<5} "
+              f"{statistics.mean(stateless_seconds[window]) * 1000:>15.3f} "
+              f"{statistics.mean(session_seconds[window]) * 1000:>13.3f}")
+
+    print(f"\nmean: stateless {statistics.mean(stateless_seconds) * 1000:.3f} ms, "
+          f"session {statistics.mean(session_seconds) * 1000:.3f} ms")
+    print(f"session: {session.stats()}")
+
+
+if __name__ == "__main__":
+    main()
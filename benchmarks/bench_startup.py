@@ -0,0 +1,51 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_ONLY = "import time; s = time.perf_counter(); import vector_db; print(time.perf_counter() - s)"
+OPEN_RETRIEVER = (
+    "import time; s = time.perf_counter(); import vector_db; "
+    "vector_db.get_retriever(); print(time.perf_counter() - s)"
+)
+
+
+# EACH RUN IS A FRESH INTERPRETER, SO THIS MEASURES A TRUE COLD START (WHAT A NEW CLI OR STREAMLIT WORKER PAYS)
+def cold_start(code, runs):
+
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Measure cold start of vector_db import and retriever open")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--skip-open", action="store_true", help="only time the import (no chroma_db needed)")
+    args = parser.parse_args()
+
+    cases = [("import vector_db", IMPORT_ONLY)]
+    if not args.skip_open:
+        cases.append(("import + get_retriever()", OPEN_RETRIEVER))
+
+    for label, code in cases:
+        timings = cold_start(code, args.runs)
+        print(f"{label:<28} median {statistics.median(timings) * 1000:8.1f} ms   "
+              f"min {min(timings) * 1000:8.1f} ms   max {max(timings) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
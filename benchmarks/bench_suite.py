@@ -0,0 +1,353 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from langchain_core.documents import Document
+
+import context
+import models
+from fakes import FakeEmbeddings, synthetic_documents
+from tokenizer import TokenCounter
+
+
+BASELINE_FILE = os.path.join(ROOT, "benchmarks", "baseline.json")
+RESULTS_FILE = os.path.join(ROOT, "cache", "bench_results.json")
+
+# A CASE REGRESSES WHEN ITS BEST p50 LATENCY OR ITS PEAK ALLOCATION GROWS BY MORE THAN THIS SHARE OF THE BASELINE
+THRESHOLD = 0.20
+# THE TIMED CALLS OF A CASE ARE SPLIT INTO ROUNDS; THE FASTEST ROUND'S MEDIAN (best_p50_ms) IS WHAT IS COMPARED, SO A
+# BURST OF OTHER WORK ON THE MACHINE DURING ONE ROUND DOESN'T READ AS A REGRESSION
+ROUNDS = 5
+# BELOW THIS, A p50 DIFFERENCE IS TIMER NOISE, NOT A REGRESSION
+NOISE_FLOOR_MS = 0.005
+
+TEXT_WORDS = [20, 200, 2000]
+TRUNCATE_BUDGET = 100
+# (RETRIEVED CHUNKS, WORDS PER CHUNK): THE DEFAULT k, A LARGER k, AND A WIDE CANDIDATE POOL OF LONG CHUNKS
+RETRIEVAL_SHAPES = [(6, 80), (6, 300), (20, 80), (50, 150)]
+CORPUS_SIZES = [1000, 10000]
+EMBEDDING_DIMENSIONS = 256
+
+QUESTIONS = [
+    "When do I need receipts for expenses?",
+    "What's the meal allowance for domestic travel?",
+    "Can I expense Uber rides during business travel?",
+    "What are all the rules for international travel including flights, hotels, and meals?",
+    "I'm traveling to London next week - what do I need to know?",
+    "Tell me about ground transportation including Uber, taxis, and rental cars",
+]
+
+HISTORY = [
+    {'role': 'user', 'content': "I'm flying to London next week for a client workshop."},
+    {'role': 'assistant', 'content': "International trips need manager approval before booking. The hotel limit in "
+                                     "London is 250 GBP per night and meals are reimbursed up to the daily allowance."},
+    {'role': 'user', 'content': "What about the flight?"},
+    {'role': 'assistant', 'content': "Economy class for flights under six hours; business class needs VP approval."},
+]
+MEMORY_ITEMS = ["The user is based in the New York office.", "The user is flying to London next week."]
+
+
+def percentile(values, fraction):
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def synthetic_text(words, seed=0):
+
+    return synthetic_documents(1, words_per_chunk=words, seed=seed)[0].page_content
+
+
+# RETRIEVED CHUNKS CARRY THEIR TOKEN COUNT AND A RELEVANCE SCORE, AS THEY DO COMING OUT OF THE REAL INDEX AND RETRIEVER
+def retrieved_chunks(count, words, counter, seed=0):
+
+    documents = synthetic_documents(count, words_per_chunk=words, seed=seed)
+    token_counts = counter.count_many([document.page_content for document in documents])
+
+    return [
+        Document(id=document.metadata['chunk_id'], page_content=document.page_content, metadata={
+            **document.metadata,
+            'token_count': tokens,
+            'token_encoding': counter.encoding_name,
+            'relevance_score': 1.0 / (1.0 + i / count)
+        })
+        for i, (document, tokens) in enumerate(zip(documents, token_counts))
+    ]
+
+
+# ONE CASE IS A ZERO-ARGUMENT FUNCTION DOING ONE OPERATION, TIMED CALL BY CALL IN ROUNDS. ALLOCATIONS ARE MEASURED IN A
+# SEPARATE, SHORTER PASS UNDER tracemalloc, WHICH WOULD OTHERWISE SLOW THE TIMED CALLS DOWN
+#   peak_kib     - THE MEDIAN PEAK OF MEMORY ALLOCATED DURING ONE CALL
+#   retained_kib - THE MEDIAN MEMORY STILL ALLOCATED AFTER IT (CACHES GROWING, LEAKS)
+# THROUGHPUT IS items (TOKENS, CHUNKS, QUERIES...) PER SECOND AT THE MEAN LATENCY
+def measure(operation, items, unit, iterations, warmup, alloc_iterations, rounds=ROUNDS):
+
+    for _ in range(warmup):
+        operation()
+
+    seconds = []
+    round_medians = []
+    for _ in range(rounds):
+        gc.collect()
+        timed = []
+        for _ in range(max(1, iterations // rounds)):
+            start = time.perf_counter()
+            operation()
+            timed.append(time.perf_counter() - start)
+        seconds += timed
+        round_medians.append(statistics.median(timed))
+
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_iterations):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            operation()
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(current - before)
+    finally:
+        tracemalloc.stop()
+
+    mean = statistics.mean(seconds)
+    return {
+        'iterations': len(seconds),
+        'best_p50_ms': min(round_medians) * 1000,
+        'p50_ms': percentile(seconds, 0.50) * 1000,
+        'p95_ms': percentile(seconds, 0.95) * 1000,
+        'p99_ms': percentile(seconds, 0.99) * 1000,
+        'mean_ms': mean * 1000,
+        'throughput': items / mean if mean else 0.0,
+        'unit': f"{unit}/s",
+        'peak_kib': statistics.median(peaks) / 1024,
+        'retained_kib': statistics.median(retained) / 1024
+    }
+
+
+def rotating(values):
+
+    state = {'i': -1}
+
+    def next_value():
+        state['i'] = (state['i'] + 1) % len(values)
+        return values[state['i']]
+
+    return next_value
+
+
+# count_tokens AND truncate_to_budget WITH THE SHARED COUNTER (WARM: THE TEXT IS IN ITS CACHE, AS POLICY CHUNKS AND
+# INSTRUCTIONS ARE) AND WITH AN UNCACHED ONE (COLD: EVERY CALL GOES THROUGH THE ENCODER, AS A NEW QUESTION DOES)
+def token_cases(counter):
+
+    cold = TokenCounter(counter.encoding_name, cache_size=0)
+
+    for words in TEXT_WORDS:
+        text = synthetic_text(words)
+        tokens = counter.count(text)
+        yield f"count_tokens/warm/{words}w", lambda text=text: context.count_tokens(text, counter), tokens, "tokens"
+        yield f"count_tokens/cold/{words}w", lambda text=text: context.count_tokens(text, cold), tokens, "tokens"
+
+    for words in TEXT_WORDS[1:]:
+        text = synthetic_text(words, seed=1)
+        tokens = counter.count(text)
+        yield (f"truncate_to_budget/warm/{words}w",
+               lambda text=text: context.truncate_to_budget(text, TRUNCATE_BUDGET, counter), tokens, "tokens")
+        yield (f"truncate_to_budget/cold/{words}w",
+               lambda text=text: context.truncate_to_budget(text, TRUNCATE_BUDGET, cold), tokens, "tokens")
+
+
+# build_retrieval AND assemble_context OVER RETRIEVED CHUNKS OF EACH SHAPE, ROTATING THROUGH THE QUESTIONS. ALL OF
+# THE RETRIEVAL STAGES (DEDUP, COMPRESSION, PACKING) RUN WITH THEIR DEFAULT SETTINGS
+def assembly_cases(counter, model):
+
+    for count, words in RETRIEVAL_SHAPES:
+        documents = retrieved_chunks(count, words, counter)
+        question = rotating(QUESTIONS)
+
+        yield (f"build_retrieval/{count}x{words}w",
+               lambda documents=documents, question=question:
+                   context.build_retrieval(documents, counter=counter, query=question()),
+               count, "chunks")
+
+        yield (f"assemble_context/{count}x{words}w",
+               lambda documents=documents, question=question:
+                   context.assemble_context(question(), documents, HISTORY, MEMORY_ITEMS, model=model),
+               count, "chunks")
+
+
+# THE RETRIEVER STACK OF vector_db.get_retriever OVER A FLAT NUMPY STORE IN A TEMPORARY DIRECTORY, WITH FAKE
+# EMBEDDINGS: THE PLAIN VECTOR SEARCH (ROUTING OFF) AND THE DEFAULT HYBRID + ROUTED ONE. THE RESULT CACHE IS OFF,
+# SO EVERY QUERY IS EMBEDDED AND SEARCHED
+def retriever_cases(directory):
+
+    from flat_store import FlatVectorStore
+    from hybrid import HybridRetriever
+    from lexical import BM25Index
+    from retrieval_cache import CachedRetriever
+    from router import SourceRouter
+
+    for size in CORPUS_SIZES:
+        embeddings = FakeEmbeddings(dimensions=EMBEDDING_DIMENSIONS)
+        documents = [
+            Document(id=document.metadata['chunk_id'], page_content=document.page_content, metadata=document.metadata)
+            for document in synthetic_documents(size, seed=size)
+        ]
+        texts = [document.page_content for document in documents]
+        metadatas = [document.metadata for document in documents]
+        vectors = embeddings.embed_documents(texts)
+
+        store = FlatVectorStore(f"bench_{size}", directory, embeddings)
+        store.upsert([document.id for document in documents], vectors, metadatas=metadatas, documents=texts)
+
+        router = SourceRouter.build(texts, metadatas, vectors)
+        index = BM25Index.build(documents)
+
+        vector = CachedRetriever(store, k=6, max_entries=1, ttl=0)
+        routed = CachedRetriever(store, k=6, max_entries=1, ttl=0, router_fn=lambda router=router: router)
+        hybrid = HybridRetriever(routed, index_fn=lambda index=index: index, k=6)
+
+        question = rotating(QUESTIONS)
+        yield (f"retriever/vector/{size}",
+               lambda vector=vector, question=question: vector.invoke(question()), 1, "queries")
+        yield (f"retriever/hybrid/{size}",
+               lambda hybrid=hybrid, question=question: hybrid.invoke(question()), 1, "queries")
+
+
+def run_suite(args):
+
+    model = models.DEFAULT_MODEL
+    counter = models.model_counter(model)
+    results = {}
+
+    def run(cases):
+        for name, operation, items, unit in cases:
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(operation, items, unit, args.iterations, args.warmup, args.alloc_iterations,
+                                    args.rounds)
+            result = results[name]
+            print(f"{name:<34} p50 {result['p50_ms']:9.3f} ms  p95 {result['p95_ms']:9.3f} ms  "
+                  f"p99 {result['p99_ms']:9.3f} ms  {result['throughput']:>12.1f} {result['unit']:<10} "
+                  f"peak {result['peak_kib']:8.1f} KiB")
+
+    run(token_cases(counter))
+    run(assembly_cases(counter, model))
+    if not args.skip_retriever:
+        with tempfile.TemporaryDirectory() as directory:
+            run(retriever_cases(directory))
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'model': model,
+            'encoding': counter.encoding_name,
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        'settings': {'iterations': args.iterations, 'rounds': args.rounds, 'warmup': args.warmup,
+                     'alloc_iterations': args.alloc_iterations},
+        'results': results
+    }
+
+
+# EVERY CASE IN BOTH RUNS IS COMPARED ON BEST p50 LATENCY AND PEAK ALLOCATION. A CASE ONLY IN ONE OF THEM IS LISTED BUT
+# NEVER FAILS THE RUN (A NEW CASE, OR ONE SKIPPED WITH --filter)
+def compare(current, baseline, threshold):
+
+    regressions = []
+
+    print(f"\nAgainst the baseline of {baseline['environment'].get('created', '?')} "
+          f"(regression: more than {threshold:.0%} slower at p50 or {threshold:.0%} more peak memory)")
+    if baseline['environment'].get('encoding') != current['environment']['encoding']:
+        print(f"  note: the baseline counted tokens with {baseline['environment'].get('encoding')}, "
+              f"this run with {current['environment']['encoding']}")
+
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f"  {name:<34} new case")
+            continue
+
+        latency_change = result['best_p50_ms'] / before['best_p50_ms'] - 1 if before['best_p50_ms'] else 0.0
+        memory_change = result['peak_kib'] / before['peak_kib'] - 1 if before['peak_kib'] else 0.0
+
+        flags = []
+        if latency_change > threshold and result['best_p50_ms'] - before['best_p50_ms'] > NOISE_FLOOR_MS:
+            flags.append("p50")
+        if memory_change > threshold and result['peak_kib'] - before['peak_kib'] >= 1.0:
+            flags.append("memory")
+        if flags:
+            regressions.append(name)
+
+        print(f"  {name:<34} p50 {latency_change:+7.1%}   peak {memory_change:+7.1%}"
+              f"{'   REGRESSION (' + ', '.join(flags) + ')' if flags else ''}")
+
+    for name in baseline['results']:
+        if name not in current['results']:
+            print(f"  {name:<34} not run")
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Latency, allocation and throughput of the context assembly and "
+                                                 "retrieval hot paths, compared against a stored baseline")
+    parser.add_argument("--iterations", type=int, default=300, help="timed calls per case")
+    parser.add_argument("--rounds", type=int, default=ROUNDS, help="rounds the timed calls are split into")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--alloc-iterations", type=int, default=10, help="calls per case traced by tracemalloc")
+    parser.add_argument("--filter", help="only run cases whose name contains this text")
+    parser.add_argument("--skip-retriever", action="store_true", help="skip the retriever cases (they index a corpus)")
+    parser.add_argument("--output", default=RESULTS_FILE, help="where to write this run's results")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed growth over the baseline, as a share of it")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--require-baseline", action="store_true",
+                        help="fail (exit 2) instead of skipping the comparison when no baseline is stored, for CI")
+    args = parser.parse_args()
+
+    current = run_suite(args)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(current, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to store one")
+        if args.require_baseline:
+            sys.exit(2)
+        return
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    regressions = compare(current, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} case(s) regressed: {', '.join(regressions)}")
+        sys.exit(1)
+    print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeLLM, FakeRetriever, synthetic_documents
+from pipeline import AsyncPipeline, Session
+
+
+QUESTIONS = [
+    "When do I need receipts for expenses?",
+    "What's the meal allowance for domestic travel?",
+    "Can I expense Uber rides during business travel?",
+    "What are all the rules for international travel including flights, hotels, and meals?",
+    "I'm traveling to London next week - what do I need to know?",
+    "Tell me about ground transportation including Uber, taxis, and rental cars",
+]
+
+
+def percentile(values, fraction):
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_session(pipeline, session, turns, rng, results):
+
+    for _ in range(turns):
+        start = time.perf_counter()
+        try:
+            result = await pipeline.answer_async(rng.choice(QUESTIONS), session)
+            results.append(('ok', time.perf_counter() - start, result['timings']))
+        except asyncio.TimeoutError:
+            results.append(('timeout', time.perf_counter() - start, {}))
+
+
+# MANY SIMULATED USERS SHARE ONE PIPELINE IN ONE PROCESS; THE FAKE BACKENDS ONLY SLEEP, SO THIS MEASURES THE
+# PIPELINE'S OWN OVERHEAD AND HOW WELL IT OVERLAPS WORK UNDER THE CONCURRENCY LIMIT
+async def main_async(args):
+
+    retriever = FakeRetriever(synthetic_documents(args.documents), k=6, delay=args.retrieval_delay)
+    model = FakeLLM(answer_tokens=args.answer_tokens, ttft=args.ttft, token_delay=0.0)
+    pipeline = AsyncPipeline(
+        retriever,
+        model,
+        max_concurrency=args.concurrency,
+        retrieval_timeout=args.timeout,
+        generation_timeout=args.timeout
+    )
+
+    rng = random.Random(0)
+    results = []
+    start = time.perf_counter()
+
+    await asyncio.gather(*[
+        run_session(pipeline, Session(f"session-{i}"), args.turns, rng, results)
+        for i in range(args.sessions)
+    ])
+
+    elapsed = time.perf_counter() - start
+    latencies = [latency for status, latency, _ in results if status == 'ok']
+    timeouts = sum(1 for status, _, _ in results if status == 'timeout')
+
+    print(f"Requests:    {len(results)} ({timeouts} timed out) across {args.sessions} sessions")
+    print(f"Wall time:   {elapsed:.2f}s   throughput {len(results) / elapsed:.1f} req/s")
+    if latencies:
+        print(f"Latency:     p50 {percentile(latencies, 0.50) * 1000:.0f} ms   "
+              f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms   p99 {percentile(latencies, 0.99) * 1000:.0f} ms")
+        for stage in ('retrieval_seconds', 'sections_seconds', 'assembly_seconds', 'generation_seconds'):
+            values = [timings[stage] for status, _, timings in results if status == 'ok' and stage in timings]
+            if values:
+                print(f"  {stage:<20} mean {statistics.mean(values) * 1000:7.1f} ms")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Load test the async pipeline with fake retriever and LLM")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--documents", type=int, default=500)
+    parser.add_argument("--retrieval-delay", type=float, default=0.05)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--answer-tokens", type=int, default=60)
+    parser.add_argument("--timeout", type=float, default=5.0)
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import argparse
+import re
+import statistics
+
+import context
+from models import model_counter
+
+
+# THE RETRIEVER'S k (vector_db.DEFAULT_CONFIG['k']): HOW MANY CHUNKS SHARE THE RETRIEVAL BUDGET
+RETRIEVAL_K = 6
+OVERLAP_SHARE = 0.125
+
+# THE "[Source i: ...]" LINE IS COSTED WITH THE LONGEST POLICY FILE NAME, SO ANY k CHUNKS FIT
+LONGEST_SOURCE = "international_travel_policy.txt"
+
+HEADING_PATTERN = re.compile(r"^#{1,6}\s")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?;:])\s+")
+
+
+# THE CHUNK SIZE (IN TOKENS) AT WHICH k RETRIEVED CHUNKS, EACH WITH ITS "[Source i: ...]" LINE AND SEPARATOR,
+# FILL THE RETRIEVAL BUDGET EXACTLY, SO build_retrieval NO LONGER HAS TO CUT ONE MID-CHUNK
+def target_chunk_tokens(budget=None, k=RETRIEVAL_K, counter=None):
+
+    counter = counter or model_counter()
+    budget = context.BUDGETS['retrieval'] if budget is None else budget
+
+    per_chunk = counter.count(f"[Source {k}: {LONGEST_SOURCE}]\n") + counter.count("\n\n")
+    return max(16, (budget - counter.count(context.RETRIEVAL_HEADER)) // k - per_chunk)
+
+
+# A POLICY FILE AS (HEADING, LINES) SECTIONS; TEXT BEFORE THE FIRST HEADING HAS NO HEADING
+def parse_sections(text):
+
+    sections = [(None, [])]
+
+    for line in text.splitlines():
+        if HEADING_PATTERN.match(line):
+            sections.append((line.rstrip(), []))
+        else:
+            sections[-1][1].append(line.rstrip())
+
+    return [(heading, trim(lines, str.strip)) for heading, lines in sections if heading or any(lines)]
+
+
+# WITHOUT THE BLANK ENTRIES AT EITHER END
+def trim(items, text=lambda unit: unit[0].strip()):
+
+    start, end = 0, len(items)
+    while start < end and not text(items[start]):
+        start += 1
+    while end > start and not text(items[end - 1]):
+        end -= 1
+    return items[start:end]
+
+
+# WE CUT POLICIES BY TOKENS, NOT CHARACTERS, ALONG THEIR STRUCTURE:
+#   - A SECTION (A MARKDOWN HEADING AND ITS LINES) THAT FITS IS KEPT WHOLE, AND SMALL NEIGHBOURING SECTIONS ARE
+#     MERGED UP TO target_tokens
+#   - A LONGER SECTION IS SPLIT BETWEEN LINES (BULLETS), EVERY PIECE STARTS WITH THE SECTION HEADING, AND THE
+#     LAST overlap_tokens OF LINES ARE REPEATED AT THE START OF THE NEXT PIECE
+#   - ONLY A SINGLE LINE LONGER THAN A CHUNK IS CUT INSIDE, AT SENTENCES AND THEN AT TOKEN BOUNDARIES
+# EVERY LINE IS COUNTED ONCE WITH THE CACHED TOKENIZER (ONE BATCHED CALL PER FILE), SO SPLITTING STAYS CHEAP
+class TokenChunker:
+
+    def __init__(self, target_tokens=None, overlap_tokens=None, counter=None):
+        self._counter = counter
+        self._target_tokens = target_tokens
+        self._overlap_tokens = overlap_tokens
+
+    # THE TOKENIZER AND THE SIZES DERIVED FROM IT ARE RESOLVED ON FIRST USE, SO A CHUNKER CREATED AT IMPORT TIME
+    # DOESN'T LOAD A TOKENIZER IN EVERY PROCESS THAT IMPORTS ingest
+    @property
+    def counter(self):
+        if self._counter is None:
+            self._counter = model_counter()
+        return self._counter
+
+    @property
+    def target_tokens(self):
+        if self._target_tokens is None:
+            self._target_tokens = target_chunk_tokens(counter=self.counter)
+        return self._target_tokens
+
+    @property
+    def overlap_tokens(self):
+        if self._overlap_tokens is None:
+            self._overlap_tokens = int(self.target_tokens * OVERLAP_SHARE)
+        return self._overlap_tokens
+
+    @staticmethod
+    def cost(units):
+        return sum(tokens for _, tokens in units) + max(0, len(units) - 1)
+
+    @staticmethod
+    def render(units):
+        return "\n".join(line for line, _ in units).strip("\n")
+
+    # A LINE THAT CAN'T FIT IN ONE CHUNK, AS PIECES OF AT MOST limit TOKENS
+    def split_line(self, line, limit):
+        pieces = []
+
+        for sentence in SENTENCE_PATTERN.split(line):
+            tokens = self.counter.encode(sentence)
+            if len(tokens) <= limit:
+                pieces.append((sentence, len(tokens)))
+            else:
+                pieces += [
+                    (self.counter.decode(tokens[start:start + limit]), len(tokens[start:start + limit]))
+                    for start in range(0, len(tokens), limit)
+                ]
+
+        return pieces
+
+    # THE UNITS A LONG SECTION IS PACKED FROM: WHOLE PARAGRAPHS (E.G. A LABEL AND ITS BULLETS) WHERE THEY FIT,
+    # OTHERWISE THEIR LINES, SEPARATED BY BLANK LINES
+    def section_units(self, lines, limit):
+        paragraphs = [[]]
+        for line, tokens in lines:
+            if line.strip():
+                paragraphs[-1].append((line, tokens))
+            elif paragraphs[-1]:
+                paragraphs.append([])
+
+        units = []
+        for paragraph in filter(None, paragraphs):
+            if units:
+                units.append(("", 0))
+
+            if self.cost(paragraph) <= limit:
+                units.append((self.render(paragraph), self.cost(paragraph)))
+                continue
+
+            for line, tokens in paragraph:
+                units += self.split_line(line, limit) if tokens > limit else [(line, tokens)]
+
+        return units
+
+    def split_section(self, heading, lines):
+        prefix = [heading] if heading else []
+        limit = self.target_tokens - self.cost(prefix) - 1
+        units = self.section_units(lines, limit)
+
+        pieces = []
+        body = []
+
+        for unit in units:
+            if not body and not unit[0].strip():
+                continue
+
+            if body and self.cost(prefix + body + [unit]) > self.target_tokens:
+                body = trim(body)
+
+                # A LABEL LINE ("Ground:") GOES WITH THE BULLETS AFTER IT, NOT AT THE END OF THIS PIECE
+                label = [body.pop()] if len(body) > 1 and body[-1][0].rstrip().endswith(":") else []
+                pieces.append(prefix + trim(body))
+
+                overlap = []
+                for previous in reversed(body):
+                    if label or self.cost([previous] + overlap) > self.overlap_tokens:
+                        break
+                    overlap.insert(0, previous)
+
+                overlap = trim(overlap) + label
+                body = overlap if self.cost(prefix + overlap + [unit]) <= self.target_tokens else []
+                if not body and not unit[0].strip():
+                    continue
+
+            body.append(unit)
+
+        if body:
+            pieces.append(prefix + body)
+
+        return pieces
+
+    # RETURNS (CHUNK TEXT, SECTION HEADING) PAIRS; THE HEADING IS THE FIRST ONE IN THE CHUNK (None BEFORE ANY)
+    def split(self, text):
+        sections = parse_sections(text)
+
+        lines = [line for heading, body in sections for line in ([heading] if heading else []) + body]
+        counts = iter(self.counter.count_many(lines))
+        sections = [
+            ((heading, next(counts)) if heading else None, [(line, next(counts)) for line in body])
+            for heading, body in sections
+        ]
+
+        chunks = []
+        current, current_heading = [], None
+
+        for heading, body in sections:
+            whole = ([heading] if heading else []) + body
+
+            # A SMALL SECTION JOINS THE CHUNK BEFORE IT (SEPARATED BY A BLANK LINE) WHEN BOTH FIT
+            if current and self.cost(current + [("", 0)] + whole) <= self.target_tokens:
+                current += [("", 0)] + whole
+                continue
+
+            name = heading[0] if heading else None
+            pieces = [whole] if self.cost(whole) <= self.target_tokens else self.split_section(heading, body)
+
+            # A CHUNK THAT IS ONLY HEADINGS (A DOCUMENT TITLE) LEADS THE NEXT PIECE INSTEAD OF STANDING ALONE
+            if current and all(HEADING_PATTERN.match(line) for line, _ in current if line) and \
+                    self.cost(current + [("", 0)] + pieces[0]) <= self.target_tokens:
+                pieces[0] = current + [("", 0)] + pieces[0]
+                name = current_heading
+            elif current:
+                chunks.append((self.render(current), current_heading))
+
+            chunks += [(self.render(piece), name) for piece in pieces[:-1]]
+            current, current_heading = pieces[-1], heading[0] if heading else None
+
+        if current:
+            chunks.append((self.render(current), current_heading))
+
+        return [(chunk, heading) for chunk, heading in chunks if chunk.strip()]
+
+    # THE SAME CALL LANGCHAIN'S TEXT SPLITTERS ANSWER
+    def split_text(self, text):
+        return [chunk for chunk, _ in self.split(text)]
+
+
+# THE DISTRIBUTION OF CHUNK SIZES (IN TOKENS) AGAINST THE TARGET
+def chunk_size_report(token_counts, target_tokens):
+
+    token_counts = sorted(token_counts)
+    if not token_counts:
+        return {'chunks': 0, 'target_tokens': target_tokens}
+
+    def percentile(fraction):
+        return token_counts[min(len(token_counts) - 1, int(fraction * len(token_counts)))]
+
+    return {
+        'chunks': len(token_counts),
+        'target_tokens': target_tokens,
+        'min': token_counts[0],
+        'p50': percentile(0.50),
+        'p90': percentile(0.90),
+        'max': token_counts[-1],
+        'mean': statistics.mean(token_counts),
+        'over_target': sum(1 for count in token_counts if count > target_tokens),
+        'total_tokens': sum(token_counts)
+    }
+
+
+def display_chunk_report(report, histogram=None):
+
+    print(f"\nCHUNKS: {report['chunks']} (target {report['target_tokens']} tokens)")
+
+    if report['chunks']:
+        print(f"  tokens: min {report['min']}, median {report['p50']}, p90 {report['p90']}, max {report['max']}, "
+              f"mean {report['mean']:.1f}")
+        print(f"  over target: {report['over_target']}, total: {report['total_tokens']} tokens")
+
+    for low, count in (histogram or {}).items():
+        print(f"  {low:>4}+ {'#' * count} {count}")
+
+
+def histogram(token_counts, width=10):
+
+    bins = {}
+    for count in token_counts:
+        bins[count // width * width] = bins.get(count // width * width, 0) + 1
+    return dict(sorted(bins.items()))
+
+
+# `python chunking.py` SHOWS HOW THE POLICIES FOLDER WOULD BE CHUNKED WITH THE CURRENT (OR GIVEN) SETTINGS
+if __name__ == "__main__":
+    import ingest
+
+    parser = argparse.ArgumentParser(description="Report the chunk size distribution of the policies folder")
+    parser.add_argument("--target", type=int, default=None, help="chunk size in tokens (default: from the retrieval budget)")
+    parser.add_argument("--overlap", type=int, default=None, help="overlap in tokens between pieces of one section")
+    parser.add_argument("--k", type=int, default=RETRIEVAL_K, help="chunks retrieved per question")
+    parser.add_argument("--folder", default="policies")
+    args = parser.parse_args()
+
+    chunker = TokenChunker(args.target or target_chunk_tokens(k=args.k), args.overlap)
+    chunks = [chunk for _, content in ingest.iter_policy_files(args.folder) for chunk in chunker.split_text(content)]
+    counts = chunker.counter.count_many(chunks)
+
+    display_chunk_report(chunk_size_report(counts, chunker.target_tokens), histogram(counts))
@@ -0,0 +1,154 @@
+import re
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+
+import packing
+from lexical import tokenize
+
+
+SENTENCE_PATTERN = re.compile(r"[^\n]*?(?:[.!?](?=\s)|$)", re.MULTILINE)
+# HEADINGS AND LABEL LINES ("Mandatory for:") ARE CONTEXT FOR THE LINES UNDER THEM, NOT CANDIDATES OF THEIR OWN
+CONTEXT_PATTERN = re.compile(r"#{1,6}\s|[^\n]{0,60}:\s*$")
+
+# A SMALL SHARE OF THE SCORE COMES FROM THE CHUNK'S OWN RELEVANCE, SO TIES (AND SENTENCES THAT SHARE NO TERM WITH
+# THE QUESTION) FAVOUR THE BETTER-RANKED CHUNKS
+CHUNK_PRIOR = 0.1
+
+# TOKENS HELD BACK FOR BPE MERGES ACROSS THE JOINS, SO THE COMPRESSED CHUNKS STILL FIT AFTER THEY ARE RE-COUNTED
+SAFETY_TOKENS = 8
+
+
+# (START, END) CHARACTER SPANS OF THE SENTENCES OF A CHUNK: EVERY LINE (BULLET) IS AT LEAST ONE, AND A LINE OF PROSE
+# IS CUT AFTER EACH . ! ?
+def sentence_spans(text):
+
+    spans = []
+    for match in SENTENCE_PATTERN.finditer(text):
+        start, end = match.span()
+        while start < end and text[start].isspace():
+            start += 1
+        if start < end:
+            spans.append((start, end))
+    return spans
+
+
+# THE KEPT SPANS OF A CHUNK, IN ORDER. SPANS FROM THE SAME LINE ARE JOINED BY A SPACE, OTHERS BY A NEWLINE
+def join_spans(text, spans):
+
+    parts = []
+    for i, (start, end) in enumerate(spans):
+        if i:
+            parts.append(" " if "\n" not in text[spans[i - 1][1]:start] else "\n")
+        parts.append(text[start:end])
+    return "".join(parts)
+
+
+# SENTENCE SCORES FOR THE WHOLE CANDIDATE POOL AT ONCE: A (SENTENCES x QUERY TERMS) MATCH MATRIX TIMES THE TERMS'
+# IDF OVER THE POOL, DAMPED BY SENTENCE LENGTH, PLUS THE CHUNK PRIOR
+def score_sentences(query, sentences, chunk_relevance):
+
+    query_terms = list(dict.fromkeys(tokenize(query)))
+    sentence_terms = [tokenize(sentence) for sentence in sentences]
+
+    scores = np.zeros(len(sentences), dtype=np.float32)
+    if query_terms and sentences:
+        column = {term: j for j, term in enumerate(query_terms)}
+        matches = np.zeros((len(sentences), len(query_terms)), dtype=np.float32)
+        for i, terms in enumerate(sentence_terms):
+            for term in terms:
+                if term in column:
+                    matches[i, column[term]] = 1.0
+
+        idf = np.log(1.0 + len(sentences) / (1.0 + matches.sum(axis=0)))
+        lengths = np.array([max(1, len(terms)) for terms in sentence_terms], dtype=np.float32)
+        scores = (matches @ idf) / np.sqrt(lengths)
+        scores = scores / (scores.max() or 1.0)
+
+    relevance = np.asarray(chunk_relevance, dtype=np.float32)
+    return (1 - CHUNK_PRIOR) * scores + CHUNK_PRIOR * relevance / (relevance.max() or 1.0)
+
+
+# EXTRACTIVE COMPRESSION FOR A RETRIEVAL THAT DOESN'T FIT: INSTEAD OF DROPPING WHOLE CHUNKS OR CUTTING ONE
+# MID-SENTENCE, WE KEEP THE SENTENCES THAT BEST MATCH THE QUESTION FROM ALL OF THEM
+#   1. EVERY CHUNK IS SPLIT INTO SENTENCES (BULLETS AND LINES COUNT AS SENTENCES); ALL ARE COUNTED IN ONE BATCH
+#   2. SENTENCES ARE SCORED BY IDF-WEIGHTED OVERLAP WITH THE QUESTION'S TERMS (ONE MATRIX PRODUCT)
+#   3. BEST FIRST, A SENTENCE IS KEPT IF IT STILL FITS; THE FIRST SENTENCE KEPT FROM A CHUNK ALSO PAYS FOR THE
+#      CHUNK'S SOURCE LINE (overheads[i]) AND ITS HEADINGS AND LABELS, WHICH ARE ALWAYS KEPT WITH IT
+#   4. EACH CHUNK KEEPS ITS SENTENCES IN THEIR ORIGINAL ORDER; CHUNKS LEFT WITH NOTHING ARE DROPPED
+# NO MODEL IS CALLED. RETURNS (DOCUMENTS, REPORT) WITH THE CHARACTER SPANS REMOVED FROM EACH CHUNK
+def compress(retrieved_docs, query, budget, overheads, counter):
+
+    start = time.perf_counter()
+
+    chunk_spans = [sentence_spans(document.page_content) for document in retrieved_docs]
+    owners = [i for i, spans in enumerate(chunk_spans) for _ in spans]
+    sentences = [document.page_content[a:b] for document, spans in zip(retrieved_docs, chunk_spans) for a, b in spans]
+
+    tokens = counter.count_many(sentences)
+    context_lines = [CONTEXT_PATTERN.match(sentence) is not None for sentence in sentences]
+    relevance = packing.relevance_scores(retrieved_docs)
+    scores = score_sentences(query, sentences, [relevance[owner] for owner in owners])
+
+    # A CHUNK'S HEADINGS AND LABELS COME WITH ITS FIRST KEPT SENTENCE
+    opening = [overheads[i] for i in range(len(retrieved_docs))]
+    for s, owner in enumerate(owners):
+        if context_lines[s]:
+            opening[owner] += tokens[s] + 1
+
+    available = budget - SAFETY_TOKENS
+    used = 0
+    kept = set()
+    opened = set()
+
+    for s in np.argsort(-scores, kind='stable'):
+        s = int(s)
+        if context_lines[s]:
+            continue
+
+        owner = owners[s]
+        cost = tokens[s] + 1 + (0 if owner in opened else opening[owner])
+        if used + cost <= available:
+            used += cost
+            kept.add(s)
+            opened.add(owner)
+
+    documents = []
+    removed = []
+    first = 0
+
+    for i, (document, spans) in enumerate(zip(retrieved_docs, chunk_spans)):
+        indices = range(first, first + len(spans))
+        first += len(spans)
+
+        if i not in opened:
+            removed.append({'chunk': i + 1, 'source': document.metadata.get('source', 'unknown'), 'spans': spans,
+                            'tokens': sum(tokens[s] for s in indices)})
+            continue
+
+        keep = [s for s in indices if s in kept or context_lines[s]]
+        drop = [s for s in indices if s not in keep]
+
+        if not drop:
+            documents.append(document)
+            continue
+
+        content = join_spans(document.page_content, [chunk_spans[i][s - indices[0]] for s in keep])
+        documents.append(Document(id=document.id, page_content=content, metadata={
+            **document.metadata,
+            'token_count': counter.count(content),
+            'token_encoding': counter.encoding_name,
+            'compressed': True
+        }))
+        removed.append({'chunk': i + 1, 'source': document.metadata.get('source', 'unknown'),
+                        'spans': [chunk_spans[i][s - indices[0]] for s in drop],
+                        'tokens': sum(tokens[s] for s in drop)})
+
+    return documents, {
+        'sentences_kept': len(kept),
+        'sentences_removed': sum(len(entry['spans']) for entry in removed),
+        'tokens_removed': sum(entry['tokens'] for entry in removed),
+        'removed_spans': removed,
+        'seconds': time.perf_counter() - start
+    }
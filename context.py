@@ -1,4 +1,7 @@
-import tiktoken
+import compress
+import dedup
+import models
+import packing
 
 
 BUDGETS = {
@@ -9,36 +12,41 @@ BUDGETS = {
     'tool_outputs': 855
 }
 
+# HOW build_retrieval CHOOSES CHUNKS WHEN THEY DON'T ALL FIT: 'greedy', 'density' OR 'knapsack'
+PACKING_STRATEGY = 'greedy'
 
+# MERGE NEIGHBOURING CHUNKS AND DROP REPEATS BEFORE PACKING (SEE dedup.py); A MMR_LAMBDA (E.G. 0.7) ALSO
+# REORDERS THE CHUNKS BY MAXIMAL MARGINAL RELEVANCE, None LEAVES THEM IN SIMILARITY ORDER
+DEDUPLICATE = True
+MMR_LAMBDA = None
 
-def count_tokens(text):
+# WHEN THE CHUNKS DON'T FIT AND THE QUESTION IS KNOWN, KEEP THEIR BEST-MATCHING SENTENCES (SEE compress.py)
+# INSTEAD OF DROPPING WHOLE CHUNKS OR CUTTING ONE MID-SENTENCE
+COMPRESS = True
 
-    encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(text))
+# HOW assemble_sections ORDERS THE SECTIONS:
+#   'prefix_stable' - INSTRUCTIONS FIRST (BYTE-IDENTICAL EVERY TURN), THEN MEMORY, RETRIEVAL AND TOOL OUTPUTS, AND
+#                     THE GOAL (HISTORY, THEN THE QUESTION) LAST. THE PROMPT OF EACH TURN STARTS WITH THE SAME TEXT
+#                     AS THE ONE BEFORE, SO THE BACKEND ONLY EVALUATES WHAT CHANGED AFTER IT (SEE generation.py)
+#   'classic'       - INSTRUCTIONS, GOAL, MEMORY, RETRIEVAL, TOOL OUTPUTS, WITH THE QUESTION REPEATED AT THE END
+PROMPT_LAYOUT = 'prefix_stable'
+
+
+
+def count_tokens(text, counter=None):
+
+    return (counter or models.model_counter()).count(text)
 
 
 # WE COUNT THE CURRENT TOKENS, AND IF THEY EXCEED THE MAXIMUM NUMBER OF TOKENS ALLOWED, WE DISCARD ALL TOKENS AFTER THE MAX NUMBER OF TOKENS
 # WE THEN RETURN (text, number of tokens used, T/F - if text was truncated)
-def truncate_to_budget(text, max_tokens):
-    
-    encoding = tiktoken.get_encoding("cl100k_base")
-    tokens = encoding.encode(text)
-    
-    if len(tokens) <= max_tokens:
-        return text, len(tokens), False
-    
-    truncated_tokens = tokens[:max_tokens]
-    truncated_text = encoding.decode(truncated_tokens)
+def truncate_to_budget(text, max_tokens, counter=None):
     
-    return truncated_text, max_tokens, True
+    return (counter or models.model_counter()).truncate(text, max_tokens)
 
 
 
-# INSTRUCTIONS WHICH TELLS THE AI AGENT HOW TO BEHAVE 
-# MUST TRUNCATE IF THEY EXCEED THE 255 MAXIMUM TOKEN CONSTRAINT
-def build_instructions():
-
-    instructions = """
+INSTRUCTIONS = """
     You are a helpful Travel & Expense Policy Assistant for Aurelius Consulting Group.
 
     Your role:
@@ -50,12 +58,19 @@ def build_instructions():
 
     Always base your answers on the provided policy documents. Do not make up policies.
     """
+
+
+# INSTRUCTIONS WHICH TELLS THE AI AGENT HOW TO BEHAVE 
+# MUST TRUNCATE IF THEY EXCEED THE 255 MAXIMUM TOKEN CONSTRAINT (OR THE BUDGET THE ALLOCATOR PASSES IN)
+def build_instructions(budget=None, counter=None):
+
+    instructions = INSTRUCTIONS
     
-    tokens = count_tokens(instructions)
-    budget = BUDGETS['instructions']
+    tokens = count_tokens(instructions, counter)
+    budget = BUDGETS['instructions'] if budget is None else budget
     
     if tokens > budget:
-        instructions, tokens, truncated = truncate_to_budget(instructions, budget)
+        instructions, tokens, truncated = truncate_to_budget(instructions, budget, counter)
     else:
         truncated = False
     
@@ -68,25 +83,38 @@ def build_instructions():
     }
 
 
-# THE USER'S CURRENT QUESTION AND RECENT CONVERSATION CONTEXT
-# IF OVER 1500 TOKENS, TRUNCATE AND KEEP ONLY THE CURRENT QUESTION
-def build_goal(user_question, conversation_history=None):
+# THE RAW TEXT OF EACH SECTION BEFORE ANY BUDGET IS APPLIED, SO THE ALLOCATOR CAN MEASURE ITS TRUE DEMAND
+# IN THE prefix_stable LAYOUT THE QUESTION COMES AFTER THE CONVERSATION, RIGHT BEFORE THE ANSWER CUE
+def goal_text(user_question, conversation_history=None, layout=None):
 
-    goal = f"Current Question: {user_question}\n\n"
+    question = f"Current Question: {user_question}\n\n"
+    conversation = ""
     
     if conversation_history and len(conversation_history) > 0:
-        goal += "Recent Conversation:\n"
+        conversation = "Recent Conversation:\n"
         for turn in conversation_history[-3:]:
             role = turn.get('role', 'user')
             content = turn.get('content', '')[:200]
-            goal += f"{role}: {content}\n"
+            conversation += f"{role}: {content}\n"
     
-    tokens = count_tokens(goal)
-    budget = BUDGETS['goal']
+    if (layout or PROMPT_LAYOUT) == 'prefix_stable':
+        return f"{conversation}\n{question}" if conversation else question
+    
+    return question + conversation
+
+
+# THE USER'S CURRENT QUESTION AND RECENT CONVERSATION CONTEXT
+# IF OVER 1500 TOKENS, TRUNCATE AND KEEP ONLY THE CURRENT QUESTION
+def build_goal(user_question, conversation_history=None, budget=None, counter=None, layout=None):
+
+    goal = goal_text(user_question, conversation_history, layout)
+    
+    tokens = count_tokens(goal, counter)
+    budget = BUDGETS['goal'] if budget is None else budget
     
     if tokens > budget:
         goal = f"Current Question: {user_question}"
-        tokens = count_tokens(goal)
+        tokens = count_tokens(goal, counter)
         truncated = True
     else:
         truncated = False
@@ -100,24 +128,29 @@ def build_goal(user_question, conversation_history=None):
     }
 
 
+def memory_text(memory_items=None):
+
+    if not memory_items or len(memory_items) == 0:
+        return "No prior conversation context."
+    
+    return "\n".join(memory_items)
+
+
 # STORED CONVERSATION FACTS
 # IF EXCEED THE 55 TOKEN LIMIT, KEEP ONLY THE LATEST 2 TO 3 KEY FACTS
-def build_memory(memory_items=None):
+def build_memory(memory_items=None, budget=None, counter=None):
 
-    if not memory_items or len(memory_items) == 0:
-        memory = "No prior conversation context."
-    else:
-        memory = "\n".join(memory_items)
+    memory = memory_text(memory_items)
     
-    tokens = count_tokens(memory)
-    budget = BUDGETS['memory']
+    tokens = count_tokens(memory, counter)
+    budget = BUDGETS['memory'] if budget is None else budget
     
     if tokens > budget:
         memory = "\n".join(memory_items[-2:])
-        tokens = count_tokens(memory)
+        tokens = count_tokens(memory, counter)
         
         if tokens > budget:
-            memory, tokens, _ = truncate_to_budget(memory, budget)
+            memory, tokens, _ = truncate_to_budget(memory, budget, counter)
         
         truncated = True
     else:
@@ -132,59 +165,132 @@ def build_memory(memory_items=None):
     }
 
 
+# TOKEN COUNTS FOR RETRIEVED CHUNKS
+# WE USE THE COUNT STORED AT INGEST TIME AND ONLY TOKENIZE CHUNKS THAT WERE INDEXED WITHOUT ONE (OR WITH ANOTHER ENCODING)
+def chunk_token_counts(retrieved_docs, counter=None):
+
+    counter = counter or models.model_counter()
+    counts = []
+    
+    for doc in retrieved_docs:
+        if doc.metadata.get('token_encoding') == counter.encoding_name and 'token_count' in doc.metadata:
+            counts.append(int(doc.metadata['token_count']))
+        else:
+            counts.append(None)
+    
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        missing_counts = counter.count_many([retrieved_docs[i].page_content for i in missing])
+        for i, count in zip(missing, missing_counts):
+            counts[i] = count
+    
+    return counts
+
+
+RETRIEVAL_HEADER = "=== RELEVANT POLICY SECTIONS ===\n\n"
+
+
+# A WRAPPED CHUNK COSTS ITS HEADER + ITS CONTENT + THE SEPARATOR. COUNTING THE PARTS SEPARATELY CAN ONLY
+# OVERESTIMATE SLIGHTLY WHERE BPE MERGES ACROSS A JOIN, AND THE SHORT HEADERS REPEAT ACROSS QUERIES SO THEY STAY CACHED
+# ONLY A PARTIAL CUT IN build_retrieval ACTUALLY ENCODES CHUNK CONTENT
+def retrieval_costs(retrieved_docs, counter=None):
+
+    counter = counter or models.model_counter()
+    
+    header_tokens = counter.count(RETRIEVAL_HEADER)
+    content_token_counts = chunk_token_counts(retrieved_docs, counter)
+    separator_tokens = counter.count("\n\n")
+    
+    headers = [f"[Source {i}: {doc.metadata.get('source', 'unknown')}]\n" for i, doc in enumerate(retrieved_docs, 1)]
+    costs = [
+        counter.count(header) + content_tokens + separator_tokens
+        for header, content_tokens in zip(headers, content_token_counts)
+    ]
+    
+    return header_tokens, headers, costs, content_token_counts
+
+
+# THE DEDUP STAGE, RUN ON WHAT THE RETRIEVER RETURNED BEFORE ANYTHING IS COSTED OR PACKED
+# RETURNS (DOCUMENTS, REPORT); THE REPORT IS None WHEN DEDUPLICATION IS OFF, OTHERWISE IT CARRIES THE tokens_saved
+def prepare_retrieval(retrieved_docs, counter=None):
+
+    if not DEDUPLICATE or not retrieved_docs:
+        return list(retrieved_docs or []), None
+
+    counter = counter or models.model_counter()
+    deduplicated, dedup_report = dedup.deduplicate(retrieved_docs, counter, MMR_LAMBDA)
+    
+    dedup_report['tokens_saved'] = 0
+    if dedup_report['chunks_merged'] or dedup_report['duplicates_removed']:
+        before = sum(retrieval_costs(retrieved_docs, counter)[2])
+        dedup_report['tokens_saved'] = before - sum(retrieval_costs(deduplicated, counter)[2])
+    
+    return deduplicated, dedup_report
+
+
 # VECTOR DATABASE RETRIEVAL RESULTS
+# REPEATED TEXT IS REMOVED FIRST (prepare_retrieval), AND THE TOKENS IT SAVED ARE REPORTED
+# A CALLER THAT ALREADY RAN prepare_retrieval PASSES deduplicated=True AND ITS dedup_report SO IT ISN'T RUN TWICE
+# IF THE CHUNKS STILL DON'T FIT AND WE HAVE THE query, THEY ARE COMPRESSED TO THEIR MOST RELEVANT SENTENCES
 # KEEP CHUNKS IN ORDER OF SIMILARITY SCORES
-# WHEN OVER 550 TOKENS THEN DROP LOWER RELEVANCE CHUNKS AND RETAIN THE TOP 2-3 MOST RELEVANT CHUNKS
-def build_retrieval(retrieved_docs):
+# WHEN OVER 550 TOKENS, THE PACKING STRATEGY DECIDES WHICH CHUNKS SURVIVE (SEE packing.py):
+#   greedy   - DROP LOWER RELEVANCE CHUNKS AND RETAIN THE TOP 2-3 MOST RELEVANT CHUNKS (DEFAULT)
+#   density  - PREFER THE MOST RELEVANCE PER TOKEN
+#   knapsack - MAXIMIZE TOTAL RELEVANCE UNDER THE BUDGET
+def build_retrieval(retrieved_docs, strategy=None, budget=None, counter=None, query=None, deduplicated=False,
+                    dedup_report=None):
+
+    strategy = strategy or PACKING_STRATEGY
+    budget = BUDGETS['retrieval'] if budget is None else budget
 
     if not retrieved_docs or len(retrieved_docs) == 0:
         return {
             'content': "No relevant policy documents found.",
             'tokens_used': 7,
-            'budget': BUDGETS['retrieval'],
+            'budget': budget,
             'truncated': False,
             'source': 'Vector database',
             'chunks_kept': 0,
             'chunks_dropped': 0
         }
     
-    budget = BUDGETS['retrieval']
+    counter = counter or models.model_counter()
+    if not deduplicated:
+        retrieved_docs, dedup_report = prepare_retrieval(retrieved_docs, counter)
     
-    retrieval_text = "=== RELEVANT POLICY SECTIONS ===\n\n"
-    current_tokens = count_tokens(retrieval_text)
+    retrieval_text = RETRIEVAL_HEADER
+    header_tokens, headers, costs, content_token_counts = retrieval_costs(retrieved_docs, counter)
     
-    chunks_kept = 0
-    chunks_dropped = 0
-    original_tokens = current_tokens
+    original_tokens = sum(content_token_counts)
+    chunks_retrieved = len(retrieved_docs)
     
-    for i, doc in enumerate(retrieved_docs, 1):
-        source = doc.metadata.get('source', 'unknown')
-        content = doc.page_content
-        
-        chunk_text = f"[Source {i}: {source}]\n{content}\n\n"
-        chunk_tokens = count_tokens(chunk_text)
-        
-        total_if_added = current_tokens + chunk_tokens
-        
-        if total_if_added <= budget:
-            retrieval_text += chunk_text
-            current_tokens = total_if_added
-            chunks_kept += 1
-        else:
+    compression_report = None
+    if COMPRESS and query and header_tokens + sum(costs) > budget:
+        overheads = [cost - content for cost, content in zip(costs, content_token_counts)]
+        retrieved_docs, compression_report = compress.compress(
+            retrieved_docs, query, budget - header_tokens, overheads, counter
+        )
+        header_tokens, headers, costs, content_token_counts = retrieval_costs(retrieved_docs, counter)
+    
+    packed = packing.pack(strategy, costs, packing.relevance_scores(retrieved_docs), budget - header_tokens)
+    selected = set(packed['selected'])
+    current_tokens = header_tokens + packed['tokens_selected']
+    
+    # CHUNKS ARE WRITTEN IN SIMILARITY ORDER WHATEVER ORDER THE STRATEGY PICKED THEM IN
+    for i, doc in enumerate(retrieved_docs):
+        if i in selected:
+            retrieval_text += f"{headers[i]}{doc.page_content}\n\n"
+        elif i == packed['partial']:
             remaining_budget = budget - current_tokens
-            
-            if remaining_budget > 100 and chunks_kept < 2:
-                partial_content, _, _ = truncate_to_budget(content, remaining_budget - 50)
-                retrieval_text += f"[Source {i}: {source}]\n{partial_content}...[TRUNCATED]\n\n"
-                current_tokens = budget
-                chunks_kept += 1
-                chunks_dropped = len(retrieved_docs) - chunks_kept
-                break
-            else:
-                chunks_dropped += 1
+            partial_content, _, _ = truncate_to_budget(doc.page_content, remaining_budget - packing.PARTIAL_MARGIN_TOKENS, counter)
+            retrieval_text += f"{headers[i]}{partial_content}...[TRUNCATED]\n\n"
     
-    original_tokens = sum(count_tokens(doc.page_content) for doc in retrieved_docs)
-    truncated = (chunks_dropped > 0)
+    if packed['partial'] is not None:
+        current_tokens = budget
+    
+    chunks_kept = len(retrieved_docs) - len(packed['dropped'])
+    chunks_dropped = chunks_retrieved - chunks_kept
+    truncated = chunks_dropped > 0 or packed['partial'] is not None or bool(compression_report)
     
     return {
         'content': retrieval_text,
@@ -194,24 +300,36 @@ def build_retrieval(retrieved_docs):
         'source': 'Vector database retrieval',
         'chunks_kept': chunks_kept,
         'chunks_dropped': chunks_dropped,
-        'original_tokens': original_tokens
+        'original_tokens': original_tokens,
+        'strategy': strategy,
+        'selected_chunks': [i + 1 for i in packed['selected']],
+        'partial_chunk': None if packed['partial'] is None else packed['partial'] + 1,
+        'dropped_chunks': [i + 1 for i in packed['dropped']],
+        'packing_seconds': packed['seconds'],
+        'dedup': dedup_report,
+        'compression': compression_report
     }
 
 
+def tool_outputs_text(tool_results=None):
+
+    if not tool_results or len(tool_results) == 0:
+        return "No recent tool outputs."
+    
+    return "\n\n".join(tool_results[-3:])
+
+
 # TOOL EXECUTION HISTORY
 # IF EXCEEDS THE 855 TOKENS LIMIT, THEN TRUNCATE OLDEST RESULTS
-def build_tool_outputs(tool_results=None):
+def build_tool_outputs(tool_results=None, budget=None, counter=None):
 
-    if not tool_results or len(tool_results) == 0:
-        tool_outputs = "No recent tool outputs."
-    else:
-        tool_outputs = "\n\n".join(tool_results[-3:]) 
+    tool_outputs = tool_outputs_text(tool_results)
     
-    tokens = count_tokens(tool_outputs)
-    budget = BUDGETS['tool_outputs']
+    tokens = count_tokens(tool_outputs, counter)
+    budget = BUDGETS['tool_outputs'] if budget is None else budget
     
     if tokens > budget:
-        tool_outputs, tokens, _ = truncate_to_budget(tool_outputs, budget)
+        tool_outputs, tokens, _ = truncate_to_budget(tool_outputs, budget, counter)
         truncated = True
     else:
         truncated = False
@@ -227,15 +345,50 @@ def build_tool_outputs(tool_results=None):
 
 # WE ASSEMBLE THE CONTEXT WITH ALL THE 5 SECTIONS (instructions, goal, memory, retrieval, recent tool outputs)
 # AND RETURN THE FULL CONTEXT STRING TO SEND TO LLM, DETAILED TOKEN USAGE FOR EACH SECTION, AND BOOLEAN TO INDICATE IF ANY TRUNCATION TOOK PLACE 
-def assemble_context(user_question, retrieved_docs, conversation_history=None, memory_items=None, tool_results=None):
-
-    instructions = build_instructions()
-    goal = build_goal(user_question, conversation_history)
-    memory = build_memory(memory_items)
-    retrieval = build_retrieval(retrieved_docs)
-    tool_outputs = build_tool_outputs(tool_results)
+# TOKENS ARE COUNTED WITH THE TOKENIZER OF THE MODEL THAT WILL READ THE PROMPT (SEE models.py; DEFAULTS TO models.DEFAULT_MODEL)
+# layout (DEFAULT PROMPT_LAYOUT) ORDERS THE SECTIONS; PASS THE SAME layout TO build_prompt
+def assemble_context(user_question, retrieved_docs, conversation_history=None, memory_items=None, tool_results=None, model=None,
+                     layout=None):
+
+    counter = models.model_counter(model)
+
+    instructions = build_instructions(counter=counter)
+    goal = build_goal(user_question, conversation_history, counter=counter, layout=layout)
+    memory = build_memory(memory_items, counter=counter)
+    retrieval = build_retrieval(retrieved_docs, counter=counter, query=user_question)
+    tool_outputs = build_tool_outputs(tool_results, counter=counter)
     
-    assembled = f"""
+    return assemble_sections(instructions, goal, memory, retrieval, tool_outputs, layout)
+
+
+# WE JOIN ALREADY-BUILT SECTIONS INTO THE FINAL CONTEXT, SO CALLERS CAN BUILD THE SECTIONS THAT DON'T
+# DEPEND ON RETRIEVAL WHILE THE VECTOR SEARCH IS STILL RUNNING
+# THE BREAKDOWN LISTS THE SECTIONS IN THE SAME ORDER WHATEVER THE LAYOUT
+def assemble_sections(instructions, goal, memory, retrieval, tool_outputs, layout=None):
+
+    if (layout or PROMPT_LAYOUT) == 'prefix_stable':
+        assembled = f"""
+    {instructions['content']}
+
+    ---
+
+    Memory:
+    {memory['content']}
+
+    ---
+
+    {retrieval['content']}
+
+    ---
+
+    Tool Outputs:
+    {tool_outputs['content']}
+
+    ---
+
+    {goal['content']}"""
+    else:
+        assembled = f"""
     {instructions['content']}
 
     ---
@@ -273,7 +426,28 @@ def assemble_context(user_question, retrieved_docs, conversation_history=None, m
 
 
 
-def display_breakdown(breakdown, total_tokens):
+# THE FINAL PROMPT SENT TO THE LLM: THE ASSEMBLED CONTEXT FOLLOWED BY THE QUESTION
+# IN THE prefix_stable LAYOUT THE CONTEXT ALREADY ENDS WITH THE QUESTION, SO ONLY THE ANSWER CUE IS ADDED
+def build_prompt(assembled_context, user_question, layout=None):
+
+    if (layout or PROMPT_LAYOUT) == 'prefix_stable':
+        return f"""{assembled_context.rstrip()}
+
+    Answer (be concise and cite relevant policies):
+    """
+
+    return f"""{assembled_context}
+
+    ---
+
+    Question: {user_question}
+
+    Answer (be concise and cite relevant policies):
+    """
+
+
+
+def display_breakdown(breakdown, total_tokens, cache_hit=None):
 
     print("\n" + "="*70)
     print("CONTEXT BUDGET BREAKDOWN")
@@ -282,11 +456,12 @@ def display_breakdown(breakdown, total_tokens):
     for section_name, data in breakdown.items():
         used = data['tokens_used']
         budget = data['budget']
-        percentage = (used / budget) * 100
+        percentage = (used / budget) * 100 if budget else 100
         
+        # A BUDGET SET BY THE ALLOCATOR IS SIZED TO THE SECTION, SO BEING FULL IS EXPECTED THERE
         if data['truncated']:
             status = "⚠ TRUNCATED"
-        elif percentage > 90:
+        elif percentage > 90 and 'fixed_budget' not in data:
             status = "⚠ NEAR LIMIT"
         else:
             status = "✓ OK"
@@ -294,13 +469,26 @@ def display_breakdown(breakdown, total_tokens):
         print(f"\n{section_name.upper()}: {used}/{budget} tokens ({percentage:.0f}%) {status}")
         print(f"  Source: {data['source']}")
         
+        if data.get('dedup') and data['dedup']['tokens_saved']:
+            print(f"  → Dedup saved {data['dedup']['tokens_saved']} tokens (merged {data['dedup']['chunks_merged']} "
+                  f"chunks, removed {data['dedup']['duplicates_removed']} duplicates)")
+        
         if data['truncated']:
             if section_name == 'retrieval' and 'chunks_dropped' in data:
                 print(f"  → Kept {data['chunks_kept']} chunks, dropped {data['chunks_dropped']} chunks")
                 print(f"  → Original retrieval: {data['original_tokens']} tokens")
+                if data.get('compression'):
+                    print(f"  → Compressed: removed {data['compression']['sentences_removed']} sentences "
+                          f"({data['compression']['tokens_removed']} tokens) in "
+                          f"{data['compression']['seconds'] * 1000:.2f} ms")
+                if 'strategy' in data:
+                    print(f"  → Packing: {data['strategy']} kept {data['selected_chunks']}, dropped {data['dropped_chunks']} "
+                          f"({data['packing_seconds'] * 1000:.2f} ms)")
             else:
                 print(f"  → Content was truncated to fit budget")
     
     print("\n" + "="*70)
     print(f"TOTAL CONTEXT: {total_tokens} tokens")
+    if cache_hit:
+        print(f"ANSWER CACHE: ✓ {cache_hit.upper()} HIT (LLM call skipped)")
     print("="*70)
\ No newline at end of file
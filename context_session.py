@@ -0,0 +1,89 @@
+import context
+import models
+
+
+# THE DOCUMENTS AS build_retrieval SEES THEM, COMPARED (NOT HASHED) WITH THE PREVIOUS TURN'S
+def retrieval_key(retrieved_docs):
+
+    return [(doc.id, doc.page_content, dict(doc.metadata)) for doc in retrieved_docs or []]
+
+
+# assemble_context FOR ONE CONVERSATION THAT REMEMBERS WHAT IT BUILT LAST TURN. EACH SECTION KEEPS ITS RENDERED
+# TEXT AND TOKEN COUNT WITH THE INPUTS IT WAS BUILT FROM, AND IS ONLY REBUILT WHEN THOSE INPUTS CHANGE:
+#   - INSTRUCTIONS ARE BUILT ONCE PER BUDGET
+#   - MEMORY, RETRIEVAL AND TOOL OUTPUTS ARE REBUILT WHEN THEIR ITEMS (OR THE QUESTION, FOR RETRIEVAL) CHANGE
+#   - THE GOAL CHANGES EVERY TURN, SO IT IS BUILT STATELESSLY (context.build_goal). COUNTING IT LINE BY LINE WAS
+#     SLOWER THAN ONE COUNT OF THE JOINED TEXT AND ONLY EXACT FOR TOKENIZERS THAT NEVER MERGE ACROSS A NEWLINE
+# THE RESULT IS IDENTICAL TO context.assemble_context WITH THE SAME ARGUMENTS. A SESSION IS NOT THREAD-SAFE;
+# TURNS OF ONE CONVERSATION RUN ONE AT A TIME (pipeline.Session HOLDS A LOCK FOR THAT)
+class ContextSession:
+
+    def __init__(self, model=None, counter=None, layout=None):
+        self.counter = counter or models.model_counter(model)
+        self.layout = layout
+        self._sections = {}
+        self.built = {}
+        self.reused = {}
+
+    def _cached(self, section, key, build):
+        entry = self._sections.get(section)
+        if entry is not None and entry[0] == key:
+            self.reused[section] = self.reused.get(section, 0) + 1
+            return dict(entry[1])
+
+        built = build()
+        self._sections[section] = (key, built)
+        self.built[section] = self.built.get(section, 0) + 1
+        return dict(built)
+
+    def instructions(self, budget=None):
+        budget = context.BUDGETS['instructions'] if budget is None else budget
+        return self._cached(
+            'instructions', (context.INSTRUCTIONS, budget),
+            lambda: context.build_instructions(budget, self.counter)
+        )
+
+    # THE SAME SECTION AS context.build_goal
+    def goal(self, user_question, conversation_history=None, budget=None):
+        self.built['goal'] = self.built.get('goal', 0) + 1
+        return context.build_goal(user_question, conversation_history, budget, self.counter, self.layout)
+
+    def memory(self, memory_items=None, budget=None):
+        budget = context.BUDGETS['memory'] if budget is None else budget
+        return self._cached(
+            'memory', (list(memory_items or []), budget),
+            lambda: context.build_memory(memory_items, budget, self.counter)
+        )
+
+    def retrieval(self, retrieved_docs, user_question=None, budget=None, strategy=None):
+        budget = context.BUDGETS['retrieval'] if budget is None else budget
+        key = (retrieval_key(retrieved_docs), user_question, budget, strategy or context.PACKING_STRATEGY,
+               context.DEDUPLICATE, context.MMR_LAMBDA, context.COMPRESS)
+        return self._cached(
+            'retrieval', key,
+            lambda: context.build_retrieval(retrieved_docs, strategy, budget, self.counter, query=user_question)
+        )
+
+    def tool_outputs(self, tool_results=None, budget=None):
+        budget = context.BUDGETS['tool_outputs'] if budget is None else budget
+        return self._cached(
+            'tool_outputs', (list(tool_results or []), budget),
+            lambda: context.build_tool_outputs(tool_results, budget, self.counter)
+        )
+
+    # THE SAME (assembled, breakdown, overflow, total_tokens) AS context.assemble_context
+    def assemble(self, user_question, retrieved_docs, conversation_history=None, memory_items=None, tool_results=None):
+        return context.assemble_sections(
+            self.instructions(),
+            self.goal(user_question, conversation_history),
+            self.memory(memory_items),
+            self.retrieval(retrieved_docs, user_question),
+            self.tool_outputs(tool_results),
+            self.layout
+        )
+
+    def stats(self):
+        return {
+            'built': dict(self.built),
+            'reused': dict(self.reused)
+        }
@@ -0,0 +1,191 @@
+import time
+import zlib
+
+import numpy as np
+from langchain_core.documents import Document
+
+import packing
+from lexical import tokenize
+
+
+MIN_OVERLAP_CHARS = 20
+MMR_LAMBDA = 0.7
+TERM_DIMENSION = 1024
+
+
+# THE LONGEST SUFFIX OF first THAT IS ALSO A PREFIX OF second (AT LEAST minimum CHARACTERS), E.G. THE TEXT A
+# SPLITTER REPEATED AT THE START OF THE NEXT CHUNK. ONLY POSITIONS WHERE second'S OPENING REAPPEARS ARE TRIED
+def overlap_length(first, second, minimum=MIN_OVERLAP_CHARS):
+
+    if len(first) < minimum or len(second) < minimum:
+        return 0
+
+    probe = second[:minimum]
+    start = first.find(probe, max(0, len(first) - len(second)))
+
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(probe, start + 1)
+
+    return 0
+
+
+# second WITHOUT WHAT IT REPEATS OF first: THE SECTION HEADING THE CHUNKER PUTS ON EVERY PIECE OF A SECTION, AND
+# THE OVERLAPPING LINES. RETURNS (REMAINING TEXT, SEPARATOR TO JOIN IT WITH)
+def continuation(first, second):
+
+    text = second.page_content
+    section = second.metadata.get('section')
+    separator = "\n\n"
+
+    if section and section == first.metadata.get('section') and text.startswith(section + "\n"):
+        text = text[len(section) + 1:]
+        separator = "\n"
+
+    # AFTER AN OVERLAP THE REST CONTINUES THE TEXT EXACTLY, INCLUDING ITS OWN LEADING WHITESPACE
+    overlap = overlap_length(first.page_content, text)
+    if overlap:
+        return text[overlap:], ""
+
+    return text, separator
+
+
+# ONE DOCUMENT FOR A RUN OF CONSECUTIVE CHUNKS OF THE SAME FILE. IT TAKES THE BEST RELEVANCE IN THE RUN
+def merge_run(run, counter):
+
+    first = run[0]
+    content = first.page_content
+
+    for previous, document in zip(run, run[1:]):
+        text, separator = continuation(previous, document)
+        if text.strip():
+            content += separator + text
+
+    scores = [document.metadata.get('relevance_score') for document in run]
+    scores = [score for score in scores if score is not None]
+
+    metadata = {
+        **first.metadata,
+        'chunk_ids': [document.metadata.get('chunk_id', document.id) for document in run],
+        'token_count': counter.count(content),
+        'token_encoding': counter.encoding_name
+    }
+    if scores:
+        metadata['relevance_score'] = max(scores)
+
+    return Document(id=first.id, page_content=content, metadata=metadata)
+
+
+# MERGES CONSECUTIVE CHUNKS (chunk_index i, i + 1, ...) OF THE SAME source. THE MERGED CHUNK TAKES THE RANK OF
+# ITS BEST-RANKED PART. RETURNS (DOCUMENTS, NUMBER OF CHUNKS MERGED AWAY)
+def merge_adjacent(retrieved_docs, counter):
+
+    positions = {}
+    for rank, document in enumerate(retrieved_docs):
+        if 'chunk_index' in document.metadata and 'source' in document.metadata:
+            positions[(document.metadata['source'], int(document.metadata['chunk_index']))] = rank
+
+    merged = {}
+    absorbed = set()
+
+    for (source, index), rank in sorted(positions.items()):
+        if rank in absorbed or (source, index - 1) in positions:
+            continue
+
+        run = [rank]
+        while (source, index + len(run)) in positions:
+            run.append(positions[(source, index + len(run))])
+
+        if len(run) > 1:
+            merged[min(run)] = merge_run([retrieved_docs[i] for i in run], counter)
+            absorbed.update(run)
+
+    documents = []
+    for rank, document in enumerate(retrieved_docs):
+        if rank in merged:
+            documents.append(merged[rank])
+        elif rank not in absorbed:
+            documents.append(document)
+
+    return documents, len(retrieved_docs) - len(documents)
+
+
+# DROPS A CHUNK WHOSE TEXT (WHITESPACE-NORMALIZED) IS CONTAINED IN A BETTER-RANKED ONE
+def drop_duplicates(retrieved_docs):
+
+    kept, texts = [], []
+
+    for document in retrieved_docs:
+        text = " ".join(document.page_content.split())
+        if not any(text in other for other in texts):
+            kept.append(document)
+            texts.append(text)
+
+    return kept, len(retrieved_docs) - len(kept)
+
+
+# HASHED BAG-OF-WORDS VECTORS (UNIT LENGTH): SIMILARITY WITHOUT AN EMBEDDING CALL
+# TERMS ARE BUCKETED WITH CRC32, NOT hash(): PYTHON SALTS STRING HASHES PER PROCESS, WHICH WOULD CHANGE THE
+# COLLISIONS (AND SO THE NEAR-DUPLICATE DECISIONS AND THE MMR ORDER) FROM ONE RUN TO THE NEXT
+def term_vectors(texts, dimension=TERM_DIMENSION):
+
+    vectors = np.zeros((len(texts), dimension), dtype=np.float32)
+
+    for row, text in enumerate(texts):
+        columns = [zlib.crc32(term.encode('utf-8')) % dimension for term in tokenize(text)]
+        np.add.at(vectors[row], columns, 1.0)
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+# MAXIMAL MARGINAL RELEVANCE: REPEATEDLY TAKE THE CHUNK WITH THE BEST
+#   mmr_lambda * RELEVANCE - (1 - mmr_lambda) * MAX SIMILARITY TO THE CHUNKS ALREADY TAKEN
+# ONE SIMILARITY MATRIX FOR ALL PAIRS, THEN ONE VECTOR UPDATE PER STEP. RETURNS THE NEW ORDER (INDICES)
+def mmr_order(relevance, similarity, mmr_lambda=MMR_LAMBDA):
+
+    relevance = np.asarray(relevance, dtype=np.float32)
+    relevance = relevance / (relevance.max() or 1.0)
+
+    order = []
+    closest = np.zeros(len(relevance), dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+
+    for _ in range(len(relevance)):
+        scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * closest, -np.inf)
+        best = int(np.argmax(scores))
+        order.append(best)
+        available[best] = False
+        closest = np.maximum(closest, similarity[best])
+
+    return order
+
+
+# THE DEDUP STAGE BETWEEN THE RETRIEVER AND THE PACKER. RETRIEVED CHUNKS OFTEN REPEAT EACH OTHER (NEIGHBOURING
+# CHUNKS OF ONE FILE SHARE THEIR SECTION HEADING AND OVERLAP LINES), AND EVERY REPEAT IS PAID FOR TWICE IN THE
+# RETRIEVAL BUDGET:
+#   1. CONSECUTIVE CHUNKS OF THE SAME FILE ARE MERGED INTO ONE, WITHOUT THE REPEATED HEADING AND OVERLAP
+#   2. A CHUNK CONTAINED IN A BETTER-RANKED ONE IS DROPPED
+#   3. OPTIONALLY (mmr_lambda), CHUNKS ARE REORDERED BY MMR SO THE PACKER MEETS DIVERSE ONES FIRST
+# THE INPUT DOCUMENTS ARE NEVER MODIFIED (THE RETRIEVAL CACHE SHARES THEM). RETURNS (DOCUMENTS, REPORT)
+def deduplicate(retrieved_docs, counter, mmr_lambda=None):
+
+    start = time.perf_counter()
+
+    documents, chunks_merged = merge_adjacent(list(retrieved_docs), counter)
+    documents, duplicates_removed = drop_duplicates(documents)
+
+    reordered = False
+    if mmr_lambda is not None and len(documents) > 2:
+        vectors = term_vectors([document.page_content for document in documents])
+        order = mmr_order(packing.relevance_scores(documents), vectors @ vectors.T, mmr_lambda)
+        reordered = order != sorted(order)
+        documents = [documents[i] for i in order]
+
+    return documents, {
+        'chunks_merged': chunks_merged,
+        'duplicates_removed': duplicates_removed,
+        'mmr_reordered': reordered,
+        'seconds': time.perf_counter() - start
+    }
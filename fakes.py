@@ -0,0 +1,180 @@
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.outputs import GenerationChunk
+import asyncio
+import hashlib
+import math
+import re
+import time
+
+
+# DETERMINISTIC LOCAL STAND-INS FOR THE OLLAMA MODELS, USED BY BENCHMARKS AND LOAD TESTS
+# THE SAME TEXT ALWAYS GETS THE SAME UNIT VECTOR, AND TEXTS SHARING WORDS GET SIMILAR VECTORS
+
+
+class FakeEmbeddings(Embeddings):
+
+    def __init__(self, dimensions=64, delay=0.0, fail_every=0):
+        self.dimensions = dimensions
+        self.delay = delay
+        self.fail_every = fail_every
+        self.calls = 0
+        self.texts_embedded = 0
+
+    def _embed(self, text):
+        vector = [0.0] * self.dimensions
+
+        for word in text.lower().split():
+            digest = hashlib.md5(word.encode('utf-8')).digest()
+            index = int.from_bytes(digest[:4], 'little') % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts):
+        self.calls += 1
+
+        # fail_every=N MAKES EVERY NTH CALL RAISE, TO EXERCISE THE RETRY PATH
+        if self.fail_every and self.calls % self.fail_every == 0:
+            raise ConnectionError("fake embedding backend unavailable")
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        self.texts_embedded += len(texts)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        if self.delay:
+            time.sleep(self.delay)
+        return self._embed(text)
+
+
+# RANKS DOCUMENTS BY WORD OVERLAP WITH THE QUERY AND SIMULATES SEARCH LATENCY
+class FakeRetriever:
+
+    def __init__(self, documents, k=6, delay=0.0):
+        self.documents = documents
+        self.k = k
+        self.delay = delay
+        self._words = [set(document.page_content.lower().split()) for document in documents]
+
+    def _search(self, query):
+        query_words = set(query.lower().split())
+        scores = [len(query_words & words) / (len(query_words) or 1) for words in self._words]
+        ranked = sorted(range(len(self.documents)), key=lambda i: -scores[i])[:self.k]
+        return [
+            Document(page_content=self.documents[i].page_content,
+                     metadata={**self.documents[i].metadata, 'relevance_score': scores[i]})
+            for i in ranked
+        ]
+
+    def invoke(self, query):
+        if self.delay:
+            time.sleep(self.delay)
+        return self._search(query)
+
+    async def ainvoke(self, query):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self._search(query)
+
+
+def evaluated_seconds(info):
+
+    return info['prompt_eval_duration'] / 1e9
+
+
+# EMITS A FIXED ANSWER WORD BY WORD, WITH A TIME-TO-FIRST-TOKEN DELAY (PROMPT EVAL) AND A PER-TOKEN DELAY
+# prompt_token_delay ADDS A COST PER EVALUATED PROMPT TOKEN, WITH THE BACKEND'S PROMPT CACHE: LIKE A LOADED OLLAMA
+# MODEL, IT KEEPS THE TOKENS OF THE LAST CALL AND ONLY EVALUATES THE PROMPT FROM THE FIRST TOKEN THAT DIFFERS
+# (keep_alive=0 UNLOADS IT AFTER THE CALL). WORDS, SPACES AND PUNCTUATION STAND IN FOR TOKENS
+class FakeLLM:
+
+    def __init__(self, answer_tokens=40, ttft=0.0, token_delay=0.0, prompt_token_delay=0.0):
+        self.answer_tokens = answer_tokens
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.prompt_token_delay = prompt_token_delay
+        self.calls = 0
+        self._cached = []
+
+    def _tokens(self, prompt):
+        digest = hashlib.md5(prompt.encode('utf-8')).hexdigest()
+        return [f"{digest[i % len(digest)]}{i} " for i in range(self.answer_tokens)]
+
+    # HOW MANY PROMPT TOKENS ARE EVALUATED, AFTER REUSING THE CACHED PREFIX
+    def _evaluate(self, prompt, keep_alive=None, context=None):
+        tokens = list(context or []) + re.findall(r"\w+|\s+|[^\w\s]", prompt)
+
+        reused = 0
+        for cached, token in zip(self._cached, tokens):
+            if cached != token:
+                break
+            reused += 1
+
+        evaluated = len(tokens) - reused
+        answer = self._tokens(prompt)
+        self._cached = [] if keep_alive == 0 else tokens + answer
+
+        return answer, {
+            'done': True,
+            'prompt_eval_count': evaluated,
+            'prompt_eval_duration': int(evaluated * self.prompt_token_delay * 1e9),
+            'eval_count': len(answer),
+            'context': tokens + answer,
+            'cached_tokens': reused
+        }
+
+    # THE SAME CHUNKS AS LANGCHAIN'S OllamaLLM._stream: THE LAST ONE CARRIES THE FINAL RESPONSE
+    def _stream(self, prompt, stop=None, **kwargs):
+        self.calls += 1
+        answer, info = self._evaluate(prompt, kwargs.get('keep_alive'), kwargs.get('context'))
+        time.sleep(self.ttft + evaluated_seconds(info))
+
+        for token in answer:
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield GenerationChunk(text=token)
+        yield GenerationChunk(text="", generation_info=info)
+
+    def stream(self, prompt, **kwargs):
+        for chunk in self._stream(prompt, **kwargs):
+            if chunk.text:
+                yield chunk.text
+
+    def invoke(self, prompt, **kwargs):
+        return "".join(self.stream(prompt, **kwargs))
+
+    async def astream(self, prompt, **kwargs):
+        self.calls += 1
+        answer, info = self._evaluate(prompt, kwargs.get('keep_alive'), kwargs.get('context'))
+        await asyncio.sleep(self.ttft + evaluated_seconds(info))
+        for token in answer:
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield token
+
+    async def ainvoke(self, prompt, **kwargs):
+        return "".join([token async for token in self.astream(prompt, **kwargs)])
+
+
+def synthetic_documents(count, words_per_chunk=80, seed=0):
+
+    import random
+
+    vocabulary = (
+        "travel expense policy receipt hotel flight meal allowance per diem approval manager "
+        "reimbursement international domestic taxi rental car mileage luggage booking economy "
+        "business class cancellation exception regional london tokyo nairobi invoice currency"
+    ).split()
+    rng = random.Random(seed)
+
+    return [
+        Document(
+            page_content=" ".join(rng.choice(vocabulary) for _ in range(words_per_chunk)),
+            metadata={'source': f"synthetic_{i % 15}.txt", 'chunk_id': f"synthetic_{i}", 'chunk_index': i}
+        )
+        for i in range(count)
+    ]
@@ -0,0 +1,381 @@
+import json
+import os
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+
+MIN_CAPACITY = 1024
+COMPACT_RATIO = 0.25
+
+
+def normalize(vectors):
+
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+# EXACT TOP-k OF EVERY QUERY OVER THE LIVE ROWS OF matrix, WITH ONE MATRIX PRODUCT FOR THE WHOLE BATCH
+# RETURNS, PER QUERY, (ROW INDICES, COSINE SIMILARITIES), BEST FIRST
+def exact_top_k(matrix, alive, queries, k):
+
+    live_count = int(alive.sum())
+    if not live_count:
+        return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+
+    scores = queries @ matrix[:len(alive)].T
+    scores[:, ~alive] = -np.inf
+
+    k = min(k, live_count)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+
+    return [(top[i][order[i]], top_scores[i][order[i]]) for i in range(len(queries))]
+
+
+# EXACT TOP-k OVER JUST THE GIVEN (LIVE) ROWS, E.G. ONE METADATA PARTITION; ONLY THOSE ROWS ARE READ
+def subset_top_k(matrix, rows, queries, k):
+
+    if not len(rows):
+        return [(rows, np.empty(0, dtype=np.float32)) for _ in queries]
+
+    scores = queries @ matrix[rows].T
+
+    k = min(k, len(rows))
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+
+    return [(rows[top[i][order[i]]], top_scores[i][order[i]]) for i in range(len(queries))]
+
+
+# A VECTOR STORE WITH NO CLIENT OR SERVER: ONE MEMORY-MAPPED .npy MATRIX OF NORMALIZED float32 EMBEDDINGS
+# PLUS A JSON SIDECAR WITH THE ROW IDS, TEXTS, METADATA AND TOMBSTONES. A SEARCH IS A MATRIX-VECTOR PRODUCT
+# AND AN argpartition, ON PAGES THE OS SHARES BETWEEN EVERY PROCESS THAT MAPS THE SAME FILE
+#   - APPENDS WRITE INTO SPARE CAPACITY IN PLACE; THE FILE IS REWRITTEN ONLY WHEN IT HAS TO GROW (DOUBLING)
+#   - DELETES ONLY MARK ROWS AS TOMBSTONES; ONCE OVER COMPACT_RATIO OF ROWS ARE DEAD THE MATRIX IS COMPACTED
+#   - THE SIDECAR IS REPLACED ATOMICALLY AFTER THE VECTORS ARE FLUSHED, AND READERS RELOAD WHEN IT CHANGES,
+#     SO A RE-INDEX BY `python vector_db.py` IS PICKED UP BY RUNNING APPS. A REWRITTEN MATRIX GOES TO A NEW
+#     GENERATION FILE NAMED IN THE SIDECAR, SO A READER NEVER PAIRS OLD METADATA WITH REORDERED ROWS
+# IT ANSWERS THE SAME CALLS THE REST OF THE APP MAKES ON CHROMA (upsert/update/delete/get/reset_collection,
+# similarity_search_by_vector_with_relevance_scores) AND as_retriever() COMES FROM LANGCHAIN'S VectorStore
+class FlatVectorStore(VectorStore):
+
+    def __init__(self, collection_name, persist_directory, embedding_function):
+        self.collection_name = collection_name
+        self.persist_directory = persist_directory
+        self._embedding_function = embedding_function
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._matrix = None
+        self._meta = None
+        self._alive = None
+        self._rows_by_id = {}
+        self._partitions = {}
+
+        os.makedirs(persist_directory, exist_ok=True)
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    def vectors_file(self, generation):
+        return os.path.join(self.persist_directory, f"{self.collection_name}.vectors.{generation}.npy")
+
+    @property
+    def meta_file(self):
+        return os.path.join(self.persist_directory, f"{self.collection_name}.meta.json")
+
+    @staticmethod
+    def _empty_meta():
+        return {'dimension': None, 'generation': 0, 'rows': 0, 'ids': [], 'documents': [], 'metadatas': [], 'deleted': []}
+
+    # ONE stat() PER CALL; THE SIDECAR AND THE MAPPING ARE ONLY RE-READ WHEN ANOTHER WRITER REPLACED THEM
+    def _refresh(self):
+        try:
+            stat = os.stat(self.meta_file)
+            stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except FileNotFoundError:
+            stamp = None
+
+        if stamp == self._stamp and self._meta is not None:
+            return
+
+        if stamp is None:
+            meta = self._empty_meta()
+        else:
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+
+        self._meta = meta
+        path = self.vectors_file(meta['generation'])
+        self._matrix = np.load(path, mmap_mode='r') if os.path.exists(path) else None
+        self._alive = np.ones(meta['rows'], dtype=bool)
+        self._alive[meta['deleted']] = False
+        self._rows_by_id = {
+            chunk_id: row for row, chunk_id in enumerate(meta['ids']) if self._alive[row]
+        }
+        self._partitions = {}
+        self._stamp = stamp
+        self._after_load()
+
+    def _save_meta(self):
+        tmp_file = self.meta_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self._meta, f)
+        os.replace(tmp_file, self.meta_file)
+        self._stamp = None
+        self._refresh()
+
+    # HOOKS FOR INDEXES LAYERED ON THE MATRIX (SEE ivf_store.py). EACH RUNS UNDER THE LOCK; _after_append AND
+    # _after_compact RUN BEFORE THE NEW SIDECAR IS SAVED, SO READERS NEVER SEE ROWS THE INDEX DOESN'T KNOW YET
+    def _after_load(self):
+        pass
+
+    def _after_append(self, start, vectors):
+        pass
+
+    def _after_compact(self, live, old_generation):
+        pass
+
+    def _after_reset(self):
+        pass
+
+    # WRITES A NEW GENERATION OF THE MATRIX WITH ROOM FOR capacity ROWS, KEEPING ONLY keep_rows (IN ORDER)
+    # THE CALLER SAVES THE SIDECAR POINTING AT IT; THE OLD FILE IS REMOVED, BUT PROCESSES THAT STILL MAP IT KEEP
+    # READING IT UNTIL THEY SEE THE NEW SIDECAR
+    def _rewrite(self, keep_rows, capacity, dimension):
+        old_file = self.vectors_file(self._meta['generation'])
+        self._meta['generation'] += 1
+
+        matrix = np.lib.format.open_memmap(
+            self.vectors_file(self._meta['generation']), mode='w+', dtype=np.float32, shape=(capacity, dimension)
+        )
+        if len(keep_rows):
+            matrix[:len(keep_rows)] = self._matrix[keep_rows]
+        matrix.flush()
+        del matrix
+
+        return old_file
+
+    def _remove(self, path):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def upsert(self, ids, embeddings, metadatas=None, documents=None):
+        vectors = normalize(embeddings)
+
+        with self._lock:
+            self._refresh()
+            try:
+                self._append(ids, vectors, metadatas, documents)
+            except BaseException:
+                # THE IN-MEMORY SIDECAR MAY BE HALF UPDATED; THE NEXT CALL RE-READS THE LAST SAVED ONE
+                self._stamp = None
+                raise
+
+    def _append(self, ids, vectors, metadatas, documents):
+        meta = self._meta
+
+        if meta['dimension'] is None:
+            meta['dimension'] = int(vectors.shape[1])
+        elif vectors.shape[1] != meta['dimension']:
+            raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the store ({meta['dimension']})")
+
+        # AN EXISTING ID IS REPLACED: ITS OLD ROW BECOMES A TOMBSTONE AND THE NEW VECTOR IS APPENDED
+        replaced = [self._rows_by_id[chunk_id] for chunk_id in ids if chunk_id in self._rows_by_id]
+        meta['deleted'].extend(replaced)
+
+        rows = meta['rows']
+        capacity = self._matrix.shape[0] if self._matrix is not None else 0
+        old_file = None
+        if rows + len(ids) > capacity:
+            old_file = self._rewrite(np.arange(rows), max(MIN_CAPACITY, 2 * capacity, rows + len(ids)), meta['dimension'])
+
+        # ROWS PAST meta['rows'] ARE INVISIBLE TO READERS UNTIL THE NEW SIDECAR IS SAVED
+        matrix = np.lib.format.open_memmap(self.vectors_file(meta['generation']), mode='r+')
+        matrix[rows:rows + len(ids)] = vectors
+        matrix.flush()
+        del matrix
+
+        meta['ids'].extend(ids)
+        meta['documents'].extend(documents or [""] * len(ids))
+        meta['metadatas'].extend(metadatas or [{}] * len(ids))
+        meta['rows'] = rows + len(ids)
+
+        self._after_append(rows, vectors)
+        self._save_meta()
+        self._remove(old_file)
+        self._compact_if_needed()
+
+    def update(self, ids, metadatas):
+        with self._lock:
+            self._refresh()
+            for chunk_id, metadata in zip(ids, metadatas):
+                if chunk_id in self._rows_by_id:
+                    self._meta['metadatas'][self._rows_by_id[chunk_id]] = metadata
+            self._save_meta()
+
+    def delete(self, ids=None, **kwargs):
+        with self._lock:
+            self._refresh()
+            self._meta['deleted'].extend(self._rows_by_id[chunk_id] for chunk_id in ids or [] if chunk_id in self._rows_by_id)
+            self._save_meta()
+            self._compact_if_needed()
+
+        return True
+
+    def _compact_if_needed(self):
+        meta = self._meta
+        if not meta['deleted'] or len(meta['deleted']) < COMPACT_RATIO * meta['rows']:
+            return
+
+        self.compact()
+
+    # DROPS TOMBSTONED ROWS FROM THE MATRIX AND THE SIDECAR
+    def compact(self):
+        with self._lock:
+            self._refresh()
+            meta = self._meta
+            live = np.flatnonzero(self._alive)
+
+            old_generation = meta['generation']
+            old_file = self._rewrite(live, max(MIN_CAPACITY, len(live)), meta['dimension'] or 1)
+            self._after_compact(live, old_generation)
+
+            self._meta = {
+                'dimension': meta['dimension'],
+                'generation': meta['generation'],
+                'rows': len(live),
+                'ids': [meta['ids'][row] for row in live],
+                'documents': [meta['documents'][row] for row in live],
+                'metadatas': [meta['metadatas'][row] for row in live],
+                'deleted': []
+            }
+            self._save_meta()
+            self._remove(old_file)
+
+    def reset_collection(self):
+        with self._lock:
+            prefix = f"{self.collection_name}.vectors."
+            for name in os.listdir(self.persist_directory):
+                if name.startswith(prefix):
+                    self._remove(os.path.join(self.persist_directory, name))
+            self._remove(self.meta_file)
+            self._after_reset()
+            self._stamp = None
+            self._meta = None
+            self._refresh()
+
+    def get(self, ids=None, include=None, **kwargs):
+        with self._lock:
+            self._refresh()
+            rows = [self._rows_by_id[chunk_id] for chunk_id in ids if chunk_id in self._rows_by_id] if ids else \
+                list(self._rows_by_id.values())
+            meta = self._meta
+
+            stored = {
+                'ids': [meta['ids'][row] for row in rows],
+                'documents': [meta['documents'][row] for row in rows],
+                'metadatas': [meta['metadatas'][row] for row in rows]
+            }
+            if include and 'embeddings' in include:
+                stored['embeddings'] = np.array(self._matrix[rows]) if rows else np.empty((0, meta['dimension'] or 0))
+
+            return stored
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._rows_by_id)
+
+    # LIVE ROWS WHOSE METADATA field EQUALS ONE OF values. EACH (field, value) PARTITION IS COLLECTED ONCE PER
+    # SIDECAR, SO A FILTERED SEARCH DOESN'T WALK THE METADATA AGAIN
+    def _partition_rows(self, field, values):
+        rows = []
+        for value in values:
+            if (field, value) not in self._partitions:
+                self._partitions[(field, value)] = np.array([
+                    row for row in self._rows_by_id.values() if self._meta['metadatas'][row].get(field) == value
+                ], dtype=np.int64)
+            rows.append(self._partitions[(field, value)])
+
+        return np.unique(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+
+    # THE SUBSET OF CHROMA'S where SYNTAX THE APP USES: {field: value} OR {field: {'$in': [values]}}
+    def _filter_rows(self, where):
+        if len(where) != 1:
+            raise ValueError(f"Filters must name exactly one metadata field, got {where!r}")
+
+        (field, condition), = where.items()
+        if isinstance(condition, dict):
+            if set(condition) != {'$in'}:
+                raise ValueError(f"Unsupported filter operator in {where!r}; only '$in' is supported")
+            return self._partition_rows(field, condition['$in'])
+
+        return self._partition_rows(field, [condition])
+
+    # WHAT A SEARCH NEEDS, TAKEN UNDER THE LOCK SO A CONCURRENT WRITE CAN'T CHANGE IT HALFWAY THROUGH
+    def _snapshot(self):
+        return {'matrix': self._matrix, 'alive': self._alive, 'meta': self._meta}
+
+    def _top_k(self, snapshot, queries, k):
+        return exact_top_k(snapshot['matrix'], snapshot['alive'], queries, k)
+
+    # TOP-k FOR A WHOLE BATCH OF QUERIES. RETURNS, PER QUERY, (Document, cosine similarity) PAIRS, BEST FIRST
+    # WITH A filter ONLY THE MATCHING ROWS ARE SCANNED (EXACTLY: A PARTITION IS SMALL ENOUGH NOT TO NEED AN INDEX)
+    def search_batch(self, query_embeddings, k=4, filter=None):
+        with self._lock:
+            self._refresh()
+            snapshot = self._snapshot()
+            rows = self._filter_rows(filter) if filter else None
+
+        meta = snapshot['meta']
+        queries = normalize(query_embeddings)
+
+        if rows is not None:
+            results = subset_top_k(snapshot['matrix'], rows, queries, k)
+        else:
+            results = self._top_k(snapshot, queries, k)
+
+        return [
+            [(self._document(meta, row), float(score)) for row, score in zip(rows, scores)]
+            for rows, scores in results
+        ]
+
+    @staticmethod
+    def _document(meta, row):
+        return Document(id=meta['ids'][row], page_content=meta['documents'][row], metadata=dict(meta['metadatas'][row]))
+
+    # DISTANCES ARE SQUARED L2 BETWEEN UNIT VECTORS (2 - 2 * COSINE), THE SAME SCALE CHROMA'S DEFAULT l2 SPACE USES
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4, filter=None, **kwargs):
+        return [(document, 2.0 - 2.0 * score) for document, score in self.search_batch([embedding], k, filter)[0]]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [document for document, _ in self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector_with_relevance_scores(self.embeddings.embed_query(query), k, filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        return self._euclidean_relevance_score_fn
+
+    def add_texts(self, texts, metadatas=None, *, ids=None, **kwargs):
+        texts = list(texts)
+        ids = ids or [str(i) for i in range(len(self), len(self) + len(texts))]
+        self.upsert(ids, self.embeddings.embed_documents(texts), metadatas, texts)
+        return ids
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, *, ids=None, collection_name="flat",
+                   persist_directory="./flat_db", **kwargs):
+        store = cls(collection_name, persist_directory, embedding)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
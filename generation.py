@@ -0,0 +1,117 @@
+import time
+
+
+# PER-CONVERSATION HANDLES FOR THE LLM BACKEND, PASSED FROM ONE TURN TO THE NEXT:
+#   keep_alive   - HOW LONG OLLAMA KEEPS THE MODEL (AND THE KV CACHE OF THE LAST PROMPT) LOADED; None LEAVES THE
+#                  MODEL'S OWN SETTING (models.KEEP_ALIVE). A PROMPT THAT STARTS WITH THE SAME TOKENS AS THE LAST ONE
+#                  ONLY EVALUATES THE REST, WHICH IS WHAT context.PROMPT_LAYOUT = 'prefix_stable' IS FOR
+#   context      - THE HANDLE OLLAMA RETURNS WITH EACH ANSWER (THE TOKENS OF PROMPT + ANSWER). IT IS ONLY SENT BACK
+#                  WITH send_context, FOR CALLERS THAT SEND JUST THE NEW PART OF THE CONVERSATION; SENT WITH A FULL
+#                  PROMPT IT WOULD REPEAT THE CONVERSATION
+# EVERY CALL ALSO RECORDS THE BACKEND'S PROMPT-EVAL STATISTICS, SO CACHE REUSE CAN BE SEEN TURN BY TURN
+class BackendSession:
+
+    def __init__(self, keep_alive=None, send_context=False):
+        self.keep_alive = keep_alive
+        self.send_context = send_context
+        self.context = None
+        self.turns = []
+
+    def request_kwargs(self):
+        kwargs = {}
+        if self.keep_alive is not None:
+            kwargs['keep_alive'] = self.keep_alive
+        if self.send_context and self.context:
+            kwargs['context'] = self.context
+        return kwargs
+
+    # info IS THE FINAL RESPONSE OF A CALL (OLLAMA REPORTS DURATIONS IN NANOSECONDS)
+    def record(self, info):
+        info = info or {}
+        if info.get('context'):
+            self.context = info['context']
+
+        stats = {
+            'prompt_eval_count': info.get('prompt_eval_count'),
+            'prompt_eval_seconds': info['prompt_eval_duration'] / 1e9 if info.get('prompt_eval_duration') else None,
+            'eval_count': info.get('eval_count'),
+            'load_seconds': info['load_duration'] / 1e9 if info.get('load_duration') else None
+        }
+        self.turns.append(stats)
+        return stats
+
+    @property
+    def last(self):
+        return self.turns[-1] if self.turns else None
+
+
+# WE WRAP THE LLM'S STREAMING INTERFACE SO CALLERS CAN RENDER TOKENS AS THEY ARRIVE
+# WHILE WE RECORD TIME-TO-FIRST-TOKEN AND TOTAL GENERATION TIME FOR THE REQUEST
+# WITH A BackendSession WE READ THE CHUNKS THEMSELVES (LANGCHAIN'S _stream): THE LAST ONE CARRIES THE BACKEND'S
+# FINAL RESPONSE (PROMPT-EVAL STATISTICS AND THE context HANDLE), WHICH THE PUBLIC stream() DROPS
+class TimedStream:
+
+    def __init__(self, model, prompt, backend=None):
+        self.model = model
+        self.prompt = prompt
+        self.backend = backend
+        self.parts = []
+        self.ttft = None
+        self.total = None
+        self.backend_stats = None
+
+    def _chunks(self):
+        if self.backend is None or not hasattr(self.model, '_stream'):
+            yield from self.model.stream(self.prompt, **(self.backend.request_kwargs() if self.backend else {}))
+            return
+
+        info = None
+        for chunk in self.model._stream(self.prompt, **self.backend.request_kwargs()):
+            if chunk.generation_info and chunk.generation_info.get('done'):
+                info = chunk.generation_info
+            yield chunk.text
+
+        self.backend_stats = self.backend.record(info)
+
+    def __iter__(self):
+        start = time.perf_counter()
+
+        for chunk in self._chunks():
+            if self.ttft is None:
+                self.ttft = time.perf_counter() - start
+            self.parts.append(chunk)
+            yield chunk
+
+        self.total = time.perf_counter() - start
+        if self.ttft is None:
+            self.ttft = self.total
+
+    @property
+    def answer(self):
+        return "".join(self.parts)
+
+    def timings(self):
+        timings = {
+            'ttft_seconds': self.ttft,
+            'generation_seconds': self.total,
+            'chunks': len(self.parts)
+        }
+        if self.backend_stats:
+            timings.update(self.backend_stats)
+        return timings
+
+
+def stream_answer(model, prompt, backend=None):
+
+    return TimedStream(model, prompt, backend)
+
+
+def format_timings(timings):
+
+    if not timings or timings.get('generation_seconds') is None:
+        return "answered from cache"
+
+    text = f"first token {timings['ttft_seconds']:.2f}s | total {timings['generation_seconds']:.2f}s"
+    if timings.get('prompt_eval_seconds') is not None:
+        text += f" | prompt eval {timings['prompt_eval_seconds']:.2f}s ({timings['prompt_eval_count']} tokens)"
+    return text
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from langchain_core.documents import Document
+
+
+RRF_K = 60
+LATENCY_BUDGET = 3.0
+FAST_PATH_MARGIN = 2.0
+VECTOR_WORKERS = 4
+
+
+# RECIPROCAL RANK FUSION: EACH LIST CONTRIBUTES 1 / (rrf_k + rank) FOR EVERY DOCUMENT IT RANKS, SO A CHUNK NEAR
+# THE TOP OF BOTH LISTS BEATS ONE THAT ONLY A SINGLE RETRIEVER LIKES, AND RAW SCORE SCALES NEVER HAVE TO AGREE
+# A DOCUMENT FOUND BY SEVERAL RETRIEVERS KEEPS THE METADATA EACH OF THEM ADDED (E.G. THE VECTOR SEARCH'S route)
+def reciprocal_rank_fusion(ranked_lists, k, rrf_k=RRF_K):
+
+    scores = {}
+    documents = {}
+    metadatas = {}
+    sources = {}
+
+    for name, ranked in ranked_lists.items():
+        for rank, document in enumerate(ranked, 1):
+            key = document.metadata.get('chunk_id') or document.id or document.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            documents.setdefault(key, document)
+            metadatas.setdefault(key, {}).update(document.metadata)
+            sources.setdefault(key, []).append(name)
+
+    fused = []
+    for key in sorted(scores, key=lambda key: -scores[key])[:k]:
+        document = documents[key]
+        fused.append(Document(
+            id=document.id,
+            page_content=document.page_content,
+            metadata={**metadatas[key], 'relevance_score': scores[key], 'retrieved_by': "+".join(sources[key])}
+        ))
+
+    return fused
+
+
+# WE COMBINE THE DENSE RETRIEVER WITH THE BM25 INDEX, SO EXACT TERMS (PER-DIEM AMOUNTS, CITY NAMES, RECEIPT
+# THRESHOLDS) RANK WELL EVEN WHEN THEIR EMBEDDINGS DON'T:
+#   - THE LEXICAL SEARCH ALWAYS RUNS (IT IS IN-PROCESS AND TAKES WELL UNDER A MILLISECOND)
+#   - FAST PATH: IF THE BEST LEXICAL MATCH CONTAINS EVERY QUERY TERM AND SCORES fast_path_margin TIMES THE
+#     RUNNER-UP, THE ANSWER IS CLEAR AND WE SKIP THE EMBEDDING CALL ENTIRELY
+#   - OTHERWISE THE VECTOR SEARCH GETS latency_budget SECONDS; WHAT ARRIVES IN TIME IS FUSED WITH RRF, AND IF IT
+#     IS LATE WE ANSWER FROM THE LEXICAL RESULTS (THE VECTOR SEARCH STILL FINISHES AND WARMS THE CACHE)
+# index_fn RETURNS THE CURRENT BM25Index, SO A RE-INDEX IS PICKED UP WITHOUT REBUILDING THE RETRIEVER
+class HybridRetriever:
+
+    def __init__(self, retriever, index_fn, k=6, latency_budget=LATENCY_BUDGET, fast_path_margin=FAST_PATH_MARGIN,
+                 rrf_k=RRF_K, candidates=None):
+        self.retriever = retriever
+        self.index_fn = index_fn
+        self.k = k
+        self.latency_budget = latency_budget
+        self.fast_path_margin = fast_path_margin
+        self.rrf_k = rrf_k
+        self.candidates = candidates or 2 * k
+        self._executor = ThreadPoolExecutor(max_workers=VECTOR_WORKERS, thread_name_prefix="vector-search")
+        self._lock = threading.Lock()
+        self.counts = {'hybrid': 0, 'fast_path': 0, 'lexical_fallback': 0}
+
+    @property
+    def vector_store(self):
+        return self.retriever.vector_store
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def lexical_search(self, query):
+        return self.index_fn().search(query, self.candidates)
+
+    def is_strong_match(self, lexical):
+        if self.fast_path_margin is None or not lexical:
+            return False
+
+        _, best_score, coverage = lexical[0]
+        runner_up = lexical[1][1] if len(lexical) > 1 else 0.0
+
+        return coverage == 1.0 and best_score >= self.fast_path_margin * runner_up
+
+    def fuse(self, lexical, vector):
+        ranked_lists = {'bm25': [document for document, _, _ in lexical]}
+        if vector is not None:
+            ranked_lists['vector'] = vector
+        return reciprocal_rank_fusion(ranked_lists, self.k, self.rrf_k)
+
+    # RESULTS WE CAN RETURN WITHOUT CALLING THE EMBEDDING MODEL: A LEXICAL FAST-PATH HIT, OR A CACHED VECTOR RESULT
+    def cached_results(self, query):
+        lexical = self.lexical_search(query)
+
+        if self.is_strong_match(lexical):
+            self._count('fast_path')
+            return self.fuse(lexical, None)
+
+        vector = self.retriever.cached_results(query)
+        if vector is None:
+            return None
+
+        self._count('hybrid')
+        return self.fuse(lexical, vector)
+
+    def cached_embedding(self, query):
+        return self.retriever.cached_embedding(query)
+
+    def store_embedding(self, query, embedding):
+        self.retriever.store_embedding(query, embedding)
+
+    def embed_query(self, query):
+        return self.retriever.embed_query(query)
+
+    # SEARCHES WITH AN EMBEDDING THE CALLER ALREADY HAS (E.G. FROM THE SERVER'S BATCHED EMBEDDING CALL)
+    def search(self, query, embedding):
+        self._count('hybrid')
+        return self.fuse(self.lexical_search(query), self.retriever.search(query, embedding))
+
+    # THE FUSED DOCUMENTS AND THE QUERY EMBEDDING THE VECTOR SEARCH USED. THE FAST PATH AND THE LEXICAL FALLBACK
+    # DON'T WAIT FOR ONE: THEY RETURN AN EMBEDDING ONLY IF IT WAS ALREADY CACHED, OTHERWISE None
+    def invoke_with_embedding(self, query):
+        lexical = self.lexical_search(query)
+
+        if self.is_strong_match(lexical):
+            self._count('fast_path')
+            return self.fuse(lexical, None), self.cached_embedding(query)
+
+        future = self._executor.submit(self.retriever.invoke_with_embedding, query)
+
+        # WITH NO LEXICAL MATCHES THERE IS NOTHING TO FALL BACK ON, SO WE WAIT FOR THE VECTOR SEARCH
+        try:
+            vector, embedding = future.result(timeout=self.latency_budget if lexical else None)
+        except TimeoutError:
+            self._count('lexical_fallback')
+            return self.fuse(lexical, None), self.cached_embedding(query)
+
+        self._count('hybrid')
+        return self.fuse(lexical, vector), embedding
+
+    def invoke(self, query):
+        return self.invoke_with_embedding(query)[0]
+
+    async def ainvoke(self, query):
+        return await asyncio.to_thread(self.invoke, query)
+
+    def clear(self):
+        self.retriever.clear()
+
+    def cache_stats(self):
+        stats = self.retriever.cache_stats() if hasattr(self.retriever, 'cache_stats') else {}
+
+        with self._lock:
+            return {**stats, 'hybrid': dict(self.counts)}
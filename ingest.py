@@ -0,0 +1,212 @@
+from langchain_core.documents import Document
+from chunking import TokenChunker
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from models import model_counter
+import hashlib
+import json
+import os
+import glob
+import time
+
+
+# CHUNK SIZES ARE IN TOKENS. None DERIVES THEM FROM THE RETRIEVAL BUDGET: k CHUNKS OF THE TARGET SIZE FILL IT
+# EXACTLY, AND PIECES OF ONE SECTION OVERLAP BY AN EIGHTH OF A CHUNK (SEE chunking.py)
+CHUNK_TOKENS = None
+CHUNK_OVERLAP_TOKENS = None
+
+EMBED_BATCH_SIZE = 32
+EMBED_WORKERS = 4
+SPLIT_WORKERS = os.cpu_count() or 1
+MAX_RETRIES = 3
+RETRY_DELAY = 1.0
+
+
+# WE BREAK LONG DOCUMENTS INTO SMALLER CHUNKS SO WE CAN RETRIEVE RELEVANT PARTS AND NOT ENTIRE DOCUMENTS
+text_splitter = TokenChunker(CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+
+
+def content_hash(text):
+
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# WE SPLIT ONE POLICY FILE INTO DOCUMENTS WHOSE IDS ARE DERIVED FROM THE CHUNK CONTENT
+# SO AN UNCHANGED CHUNK KEEPS ITS ID (AND ITS EMBEDDING) EVEN IF AN EDIT ABOVE IT SHIFTS ITS POSITION
+def split_policy_file(filename, content):
+
+    chunks, sections = zip(*text_splitter.split(content)) if content.strip() else ((), ())
+
+    # WE STORE EACH CHUNK'S TOKEN COUNT SO RETRIEVAL CAN BUDGET WITHOUT RE-TOKENIZING AT QUERY TIME
+    counter = model_counter()
+    token_counts = counter.count_many(list(chunks))
+
+    documents = []
+    occurrences = {}
+
+    for i, chunk_text in enumerate(chunks):
+        digest = content_hash(chunk_text)[:16]
+        occurrence = occurrences.get(digest, 0)
+        occurrences[digest] = occurrence + 1
+
+        chunk_id = f"{filename}_{digest}"
+        if occurrence:
+            chunk_id += f"_{occurrence}"
+
+        documents.append(Document(
+            id=chunk_id,
+            page_content=chunk_text,
+            metadata={
+                "source": filename,
+                "chunk_id": chunk_id,
+                "chunk_index": i,
+                "section": sections[i] or "",
+                "token_count": token_counts[i],
+                "token_encoding": counter.encoding_name
+            }
+        ))
+
+    return documents
+
+
+# WE STREAM THE POLICY FILES ONE AT A TIME SO ONLY THE FILES THAT NEED SPLITTING ARE HELD IN MEMORY
+def iter_policy_files(policies_folder):
+
+    for policy_file in sorted(glob.glob(os.path.join(policies_folder, "*.txt"))):
+        with open(policy_file, 'r', encoding='utf-8') as f:
+            yield os.path.basename(policy_file), f.read()
+
+
+# WE SPLIT FILES IN A PROCESS POOL; SMALL BATCHES STAY IN-PROCESS BECAUSE STARTING WORKERS COSTS MORE THAN THE SPLIT
+def split_files(files, workers=SPLIT_WORKERS):
+
+    files = list(files)
+    start = time.perf_counter()
+
+    if workers <= 1 or len(files) < 2:
+        results = [split_policy_file(filename, content) for filename, content in files]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+            results = list(executor.map(
+                split_policy_file,
+                [filename for filename, _ in files],
+                [content for _, content in files],
+                chunksize=max(1, len(files) // (workers * 4))
+            ))
+
+    elapsed = time.perf_counter() - start
+    chunks = sum(len(documents) for documents in results)
+
+    stats = {
+        'files': len(files),
+        'chunks': chunks,
+        'seconds': elapsed,
+        'chunks_per_sec': chunks / elapsed if elapsed > 0 else 0.0
+    }
+
+    return {filename: documents for (filename, _), documents in zip(files, results)}, stats
+
+
+# CHROMA IS WRITTEN THROUGH ITS UNDERLYING COLLECTION; THE FLAT BACKEND (flat_store.py) TAKES THE SAME CALLS ITSELF
+def collection_of(vector_store):
+
+    return getattr(vector_store, '_collection', vector_store)
+
+
+def embed_with_retry(embeddings, texts, retries=MAX_RETRIES, delay=RETRY_DELAY):
+
+    for attempt in range(retries + 1):
+        try:
+            return embeddings.embed_documents(texts), attempt
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(delay * (2 ** attempt))
+
+
+# THE CHECKPOINT IS AN APPEND-ONLY FILE WITH ONE LINE PER STORED BATCH
+# IT IS ONLY TRUSTED WHEN IT WAS WRITTEN FOR THE SAME INDEX SIGNATURE
+def load_checkpoint(checkpoint_file, signature):
+
+    if not os.path.exists(checkpoint_file):
+        return set()
+
+    done = set()
+
+    with open(checkpoint_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if entry.get('signature') != signature:
+                return set()
+            done.update(entry['ids'])
+
+    return done
+
+
+def clear_checkpoint(checkpoint_file):
+
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+
+# WE EMBED IN FIXED-SIZE BATCHES WITH A BOUNDED NUMBER OF CONCURRENT EMBEDDING CALLS
+# BATCHES ARE WRITTEN TO THE STORE (AND CHECKPOINTED) FROM THIS THREAD AS SOON AS THEY FINISH,
+# SO AN INTERRUPTED INGEST RESUMES WITHOUT RE-EMBEDDING WHAT WAS ALREADY STORED
+def embed_and_store(vector_store, documents, checkpoint_file, signature,
+                    batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS, retries=MAX_RETRIES):
+
+    done = load_checkpoint(checkpoint_file, signature)
+    pending = [document for document in documents if document.id not in done]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    embeddings = vector_store.embeddings
+    start = time.perf_counter()
+    embedded = 0
+    total_retries = 0
+
+    os.makedirs(os.path.dirname(checkpoint_file) or ".", exist_ok=True)
+
+    with open(checkpoint_file, 'a', encoding='utf-8') as checkpoint, \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+
+        futures = {
+            executor.submit(embed_with_retry, embeddings, [document.page_content for document in batch], retries): batch
+            for batch in batches
+        }
+
+        try:
+            for future in as_completed(futures):
+                batch = futures[future]
+                vectors, attempts = future.result()
+                ids = [document.id for document in batch]
+
+                collection_of(vector_store).upsert(
+                    ids=ids,
+                    embeddings=vectors,
+                    metadatas=[document.metadata for document in batch],
+                    documents=[document.page_content for document in batch]
+                )
+
+                checkpoint.write(json.dumps({'signature': signature, 'ids': ids}) + "\n")
+                checkpoint.flush()
+
+                embedded += len(batch)
+                total_retries += attempts
+        except BaseException:
+            # A BATCH THAT KEEPS FAILING STOPS THE INGEST; BATCHES NOT YET STARTED ARE CANCELLED AND RESUME NEXT RUN
+            for future in futures:
+                future.cancel()
+            raise
+
+    elapsed = time.perf_counter() - start
+
+    return {
+        'embedded': embedded,
+        'skipped': len(documents) - len(pending),
+        'batches': len(batches),
+        'retries': total_retries,
+        'seconds': elapsed,
+        'embeddings_per_sec': embedded / elapsed if elapsed > 0 else 0.0
+    }
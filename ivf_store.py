@@ -0,0 +1,177 @@
+import math
+import os
+
+import numpy as np
+
+from flat_store import FlatVectorStore, exact_top_k, normalize
+
+
+NPROBE = 8
+MIN_TRAIN_ROWS = 1024
+RETRAIN_GROWTH = 2.0
+KMEANS_ITERATIONS = 15
+KMEANS_SAMPLE_PER_LIST = 64
+ASSIGN_BATCH = 16384
+
+
+def default_nlist(rows):
+
+    return max(1, int(4 * math.sqrt(rows)))
+
+
+# NEAREST CENTROID (BY COSINE) FOR EVERY ROW, IN BATCHES SO THE SCORE MATRIX STAYS SMALL
+def assign(vectors, centroids):
+
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BATCH):
+        labels[start:start + ASSIGN_BATCH] = np.argmax(vectors[start:start + ASSIGN_BATCH] @ centroids.T, axis=1)
+    return labels
+
+
+# SPHERICAL k-MEANS ON A SAMPLE OF THE (UNIT) VECTORS. EMPTY LISTS ARE RESEEDED WITH RANDOM SAMPLE POINTS
+def train_kmeans(vectors, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * KMEANS_SAMPLE_PER_LIST)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+    nlist = min(nlist, len(sample))
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = assign(sample, centroids)
+        counts = np.bincount(labels, minlength=nlist)
+
+        order = np.argsort(labels, kind='stable')
+        filled = np.flatnonzero(counts)
+        sums = np.add.reduceat(sample[order], np.concatenate([[0], np.cumsum(counts[filled])[:-1]]), axis=0)
+
+        centroids[filled] = normalize(sums)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+
+    return centroids
+
+
+# AN INVERTED-FILE (IVF) INDEX ON TOP OF THE FLAT STORE. k-MEANS SPLITS THE EMBEDDINGS INTO nlist LISTS; A QUERY
+# ONLY SCORES THE ROWS IN ITS nprobe NEAREST LISTS, SO THE WORK PER QUERY IS ROUGHLY nprobe / nlist OF AN EXACT
+# SCAN. nprobe IS THE RECALL / LATENCY KNOB (nprobe = nlist IS EXACT) AND CAN BE CHANGED AT ANY TIME
+#   - NEW ROWS ARE ASSIGNED TO THEIR NEAREST EXISTING CENTROID; ONCE THE STORE HAS GROWN RETRAIN_GROWTH TIMES
+#     SINCE THE LAST TRAINING, THE CENTROIDS ARE RETRAINED
+#   - BELOW min_train_rows THE STORE SEARCHES EXACTLY (AN INDEX WOULD ONLY COST RECALL)
+#   - CENTROIDS AND ASSIGNMENTS ARE PERSISTED PER MATRIX GENERATION NEXT TO THE VECTORS
+class IVFVectorStore(FlatVectorStore):
+
+    def __init__(self, collection_name, persist_directory, embedding_function, nlist=None, nprobe=NPROBE,
+                 min_train_rows=MIN_TRAIN_ROWS):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_rows = min_train_rows
+        self._ivf = None
+        super().__init__(collection_name, persist_directory, embedding_function)
+
+    def ivf_file(self, generation):
+        return os.path.join(self.persist_directory, f"{self.collection_name}.ivf.{generation}.npz")
+
+    def _after_load(self):
+        path = self.ivf_file(self._meta['generation'])
+        self._ivf = None
+
+        if os.path.exists(path):
+            with np.load(path) as data:
+                self._ivf = self._lists(data['centroids'], data['assignments'], int(data['trained_rows']))
+
+    # THE LISTS ARE ONE ARGSORT OF THE ASSIGNMENTS: LIST c IS order[offsets[c]:offsets[c + 1]]
+    @staticmethod
+    def _lists(centroids, assignments, trained_rows):
+        counts = np.bincount(assignments, minlength=len(centroids))
+        return {
+            'centroids': centroids,
+            'assignments': assignments,
+            'trained_rows': trained_rows,
+            'order': np.argsort(assignments, kind='stable'),
+            'offsets': np.concatenate([[0], np.cumsum(counts)])
+        }
+
+    def _save_ivf(self, centroids, assignments, trained_rows):
+        path = self.ivf_file(self._meta['generation'])
+        tmp_file = path + ".tmp.npz"
+        np.savez(tmp_file, centroids=centroids, assignments=assignments, trained_rows=trained_rows)
+        os.replace(tmp_file, path)
+        self._ivf = self._lists(centroids, assignments, trained_rows)
+        self._remove_ivf_files(keep=path)
+
+    # A READER STILL ON AN OLDER SIDECAR JUST FALLS BACK TO AN EXACT SCAN UNTIL IT SEES THE NEW ONE
+    def _remove_ivf_files(self, keep=None):
+        prefix = f"{self.collection_name}.ivf."
+        for name in os.listdir(self.persist_directory):
+            path = os.path.join(self.persist_directory, name)
+            if name.startswith(prefix) and name.endswith(".npz") and path != keep:
+                self._remove(path)
+
+    def _train(self, rows):
+        matrix = np.load(self.vectors_file(self._meta['generation']), mmap_mode='r')[:rows]
+        centroids = train_kmeans(matrix, self.nlist or default_nlist(rows))
+        self._save_ivf(centroids, assign(matrix, centroids), rows)
+
+    def _after_append(self, start, vectors):
+        rows = start + len(vectors)
+
+        if self._ivf is None or rows >= RETRAIN_GROWTH * self._ivf['trained_rows']:
+            if rows >= self.min_train_rows:
+                self._train(rows)
+            return
+
+        assignments = np.concatenate([self._ivf['assignments'][:start], assign(vectors, self._ivf['centroids'])])
+        self._save_ivf(self._ivf['centroids'], assignments, self._ivf['trained_rows'])
+
+    def _after_compact(self, live, old_generation):
+        if self._ivf is not None:
+            self._save_ivf(self._ivf['centroids'], self._ivf['assignments'][live], self._ivf['trained_rows'])
+        else:
+            self._remove(self.ivf_file(old_generation))
+
+    def _after_reset(self):
+        self._remove_ivf_files()
+        self._ivf = None
+
+    # RETRAINS THE CENTROIDS ON EVERYTHING STORED (E.G. AFTER CHANGING nlist)
+    def train(self):
+        with self._lock:
+            self._refresh()
+            if self._meta['rows']:
+                self._train(self._meta['rows'])
+
+    def _snapshot(self):
+        return {**super()._snapshot(), 'ivf': self._ivf}
+
+    def _top_k(self, snapshot, queries, k):
+        ivf, matrix, alive = snapshot['ivf'], snapshot['matrix'], snapshot['alive']
+
+        if ivf is None or len(alive) < self.min_train_rows:
+            return exact_top_k(matrix, alive, queries, k)
+
+        nprobe = min(self.nprobe, len(ivf['centroids']))
+        probes = np.argpartition(-(queries @ ivf['centroids'].T), nprobe - 1, axis=1)[:, :nprobe]
+
+        # ROWS ADDED BY A WRITER AFTER THESE ASSIGNMENTS WERE SAVED ARE SCANNED EXACTLY
+        unassigned = np.arange(len(ivf['assignments']), len(alive))
+        order, offsets = ivf['order'], ivf['offsets']
+
+        results = []
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe] + [unassigned])
+            candidates = candidates[candidates < len(alive)]
+            candidates = np.sort(candidates[alive[candidates]])
+
+            if len(candidates) == 0:
+                results.append((candidates, np.empty(0, dtype=np.float32)))
+                continue
+
+            scores = matrix[candidates] @ query
+            top = min(k, len(candidates))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best], kind='stable')]
+            results.append((candidates[best], scores[best]))
+
+        return results
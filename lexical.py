@@ -0,0 +1,124 @@
+import json
+import math
+import os
+import re
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from how i if in is it me my of on or our should that the their
+this to was what when where which who will with you your
+""".split())
+
+
+# LOWERCASE WORDS AND NUMBERS ("$75.50" -> "75.50", "per-diem" -> "per", "diem"), WITHOUT STOPWORDS
+def tokenize(text):
+
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+# AN IN-PROCESS INVERTED INDEX SCORED WITH OKAPI BM25. FOR EVERY TERM WE KEEP THE DOCUMENTS IT APPEARS IN AND ITS
+# PRECOMPUTED BM25 WEIGHT IN EACH, SO A QUERY IS ONE VECTORIZED SCATTER-ADD PER QUERY TERM
+class BM25Index:
+
+    def __init__(self, documents, postings, doc_lengths, k1=BM25_K1, b=BM25_B, version=None):
+        self.documents = documents
+        self.doc_lengths = np.asarray(doc_lengths, dtype=np.float32)
+        self.k1 = k1
+        self.b = b
+        self.version = version
+        self.postings = postings
+
+        count = len(documents)
+        average_length = float(self.doc_lengths.mean()) if count else 0.0
+        norms = self.k1 * (1 - self.b + self.b * self.doc_lengths / (average_length or 1.0))
+
+        # term -> (DOCUMENT INDICES, idf * BM25 TERM-FREQUENCY WEIGHT)
+        self._terms = {}
+        for term, entries in postings.items():
+            doc_ids = np.fromiter((doc_id for doc_id, _ in entries), dtype=np.int32, count=len(entries))
+            frequencies = np.fromiter((tf for _, tf in entries), dtype=np.float32, count=len(entries))
+            idf = math.log(1 + (count - len(entries) + 0.5) / (len(entries) + 0.5))
+            self._terms[term] = (doc_ids, idf * frequencies * (self.k1 + 1) / (frequencies + norms[doc_ids]))
+
+    @classmethod
+    def build(cls, documents, k1=BM25_K1, b=BM25_B, version=None):
+        postings = {}
+        doc_lengths = []
+
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize(document.page_content)
+            doc_lengths.append(len(tokens))
+
+            frequencies = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for term, tf in frequencies.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+
+        return cls(list(documents), postings, doc_lengths, k1, b, version)
+
+    def __len__(self):
+        return len(self.documents)
+
+    # RETURNS UP TO k (Document, score, coverage) TUPLES, BEST FIRST. coverage IS THE FRACTION OF THE
+    # QUERY'S TERMS THAT APPEAR IN THE DOCUMENT
+    def search(self, query, k=6):
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.documents:
+            return []
+
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        matched = np.zeros(len(self.documents), dtype=np.int32)
+
+        for term in terms:
+            if term in self._terms:
+                doc_ids, weights = self._terms[term]
+                scores[doc_ids] += weights
+                matched[doc_ids] += 1
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+        return [
+            (self.documents[i], float(scores[i]), matched[i] / len(terms))
+            for i in candidates
+        ]
+
+    def save(self, path):
+        tmp_file = path + ".tmp"
+        content = {
+            'version': self.version,
+            'k1': self.k1,
+            'b': self.b,
+            'documents': [
+                {'id': document.id, 'page_content': document.page_content, 'metadata': document.metadata}
+                for document in self.documents
+            ],
+            'doc_lengths': self.doc_lengths.astype(int).tolist(),
+            'postings': self.postings
+        }
+
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(content, f)
+
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            content = json.load(f)
+
+        documents = [Document(**document) for document in content['documents']]
+        postings = {term: [tuple(entry) for entry in entries] for term, entries in content['postings'].items()}
+
+        return cls(documents, postings, content['doc_lengths'], content['k1'], content['b'], content['version'])
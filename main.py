@@ -1,19 +1,46 @@
 from langchain_ollama import OllamaLLM
-from langchain_ollama import OllamaEmbeddings
-from langchain_chroma import Chroma
-from vector_db import retriever
+from answer_cache import AnswerCache, answer_scope
+from generation import BackendSession, stream_answer, format_timings
+from allocator import ContextAllocator, display_allocation
+from context_session import ContextSession
+from memory_store import MemoryStore
+import vector_db
 import context
+import models
+import time
 
 
 
 LLM_MODEL = "llama3.2:1b"
+MODEL_PARAMS = {'model': LLM_MODEL, 'temperature': 0.1}
 
-model = OllamaLLM(model=LLM_MODEL, temperature=0.1)
+# WITH DYNAMIC BUDGETS, BUDGET A SECTION DOESN'T NEED (E.G. NO TOOL OUTPUTS) GOES TO THE POLICY TEXT INSTEAD
+DYNAMIC_BUDGETS = False
+allocator = ContextAllocator.for_model(LLM_MODEL) if DYNAMIC_BUDGETS else None
 
+# THE PROFILE FOR LLM_MODEL (models.py) SETS ITS TOKENIZER, CONTEXT WINDOW AND THE TOKENS KEPT FOR THE ANSWER
+model = OllamaLLM(model=LLM_MODEL, temperature=0.1, **models.ollama_options(LLM_MODEL))
+answer_cache = AnswerCache()
 
-# STRORE CONVERSATION HISTORY AND MEMORY ITEMS
-conversation_history = []
-memory_items = []
+
+# WE OPEN THE PERSISTED VECTOR STORE ONCE; STARTUP TIME DOES NOT DEPEND ON HOW MANY POLICIES ARE INDEXED
+startup_start = time.perf_counter()
+retriever = vector_db.get_retriever()
+print(f"   ✓ Retriever ready in {time.perf_counter() - startup_start:.2f}s")
+
+
+# THE CONVERSATION HISTORY AND THE FACTS LEARNED FROM IT ARE KEPT IN SQLITE (SEE memory_store.py), SO THE CLI
+# CONTINUES THE SAME CONVERSATION AFTER A RESTART
+SESSION_ID = "cli"
+memory_store = MemoryStore()
+memory = memory_store.session(SESSION_ID)
+
+# THE MODEL STAYS LOADED BETWEEN TURNS, AND WITH THE PREFIX-STABLE PROMPT LAYOUT (context.PROMPT_LAYOUT) EACH TURN
+# ONLY EVALUATES THE PART OF THE PROMPT THAT CHANGED; THE SESSION RECORDS THE BACKEND'S PROMPT-EVAL TIMES
+backend_session = BackendSession()
+
+# SECTIONS WHOSE INPUTS DIDN'T CHANGE SINCE THE LAST TURN (INSTRUCTIONS, MEMORY, MOST OF THE HISTORY) ARE REUSED
+context_session = ContextSession(LLM_MODEL)
 
 
 
@@ -28,57 +55,77 @@ while True:
     if question.lower() in ['quit', 'exit']:
         print("\n👋 Goodbye!\n")
         break
+    
+    # "reset" STARTS A NEW CONVERSATION
+    if question.lower() == 'reset':
+        memory_store.delete(SESSION_ID)
+        memory = memory_store.session(SESSION_ID)
+        print("\n🧹 Conversation memory cleared")
+        continue
 
     
     print("\n" + "="*70)
     
     # WE RETRIEVE RELEVANT DOCUMENTS/CHUNKS BASED ON QUESTION
-    retrieved_docs = retriever.invoke(question)
+    # THE RETRIEVER HANDS BACK THE QUERY EMBEDDING IT SEARCHED WITH (None WHEN A KEYWORD MATCH SKIPPED THE
+    # EMBEDDING CALL), WHICH THE ANSWER CACHE REUSES BELOW
+    if hasattr(retriever, 'invoke_with_embedding'):
+        retrieved_docs, query_embedding = retriever.invoke_with_embedding(question)
+    else:
+        retrieved_docs, query_embedding = retriever.invoke(question), None
     
     print(f"   ✓ Retrieved {len(retrieved_docs)} relevant chunks")
     
     # WE THEN ASSEMBLE THE CONTEXT WITH THE BUDGET
-    assembled_context, breakdown, overflow_occurred, total_tokens = context.assemble_context(
-        user_question=question,
-        retrieved_docs=retrieved_docs,
-        conversation_history=conversation_history,
-        memory_items=memory_items,
-        tool_results=None
-    )
-    
-    context.display_breakdown(breakdown, total_tokens)
-    
+    allocation = None
+    if allocator:
+        assembled_context, breakdown, overflow_occurred, total_tokens, allocation = allocator.assemble(
+            user_question=question,
+            retrieved_docs=retrieved_docs,
+            conversation_history=memory.conversation_history,
+            memory_items=memory.memory_items,
+            tool_results=None
+        )
+    else:
+        assembled_context, breakdown, overflow_occurred, total_tokens = context_session.assemble(
+            user_question=question,
+            retrieved_docs=retrieved_docs,
+            conversation_history=memory.conversation_history,
+            memory_items=memory.memory_items,
+            tool_results=None
+        )
     
     # WE CREATE THE FINAL PROMPT USING THE QUESTION PLUS THE RETRIVED RELEVANT CHUNKS AND WE SEND THAT TO THE LLM TO GET AN ANSWER
-    prompt = f"""{assembled_context}
-
-    ---
-
-    Question: {question}
-
-    Answer (be concise and cite relevant policies):
-    """
+    prompt = context.build_prompt(assembled_context, question)
     
-    answer = model.invoke(prompt)
+    # AN IDENTICAL PROMPT (OR A NEAR-IDENTICAL QUESTION OVER THE SAME CONTEXT) IS ANSWERED FROM THE CACHE
+    scope = answer_scope(MODEL_PARAMS, breakdown)
+    answer, cache_hit = answer_cache.get(prompt, MODEL_PARAMS, query_embedding, scope)
     
+    context.display_breakdown(breakdown, total_tokens, cache_hit)
+    if allocation:
+        display_allocation(allocation)
     
     print("\n" + "="*70)
     print("💡 ANSWER")
     print("="*70)
-    print(answer)
-    print("="*70)
     
-    # WE ADD TO THE CONVERSATION HISTORY
-    conversation_history.append({
-        'role': 'user',
-        'content': question
-    })
-    conversation_history.append({
-        'role': 'assistant',
-        'content': answer[:200]
-    })
+    # WE STREAM THE ANSWER TO THE TERMINAL AS IT IS GENERATED INSTEAD OF WAITING FOR THE FULL RESPONSE
+    timings = None
+    if answer is None:
+        stream = stream_answer(model, prompt, backend_session)
+        for chunk in stream:
+            print(chunk, end="", flush=True)
+        print()
+        answer = stream.answer
+        timings = stream.timings()
+        answer_cache.put(prompt, MODEL_PARAMS, answer, question, query_embedding, scope)
+    else:
+        print(answer)
     
-    # WE KEEP HISTORY MANAGEABLE BY STORING ONLY THE MOST RECENT TURNS
-    if len(conversation_history) > 6:
-        conversation_history = conversation_history[-6:]
+    print("="*70)
+    print(f"⏱  {format_timings(timings)}")
     
+    # WE ADD THE TURN TO THE CONVERSATION MEMORY: IT KEEPS THE MOST RECENT TURNS AND THE FACTS LEARNED FROM THEM,
+    # SUMMARIZING OLDER FACTS ONCE THEY NO LONGER FIT THE MEMORY BUDGET
+    memory.record_turn(question, answer)
@@ -0,0 +1,449 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+import context
+import models
+
+
+MEMORY_PATH = "./cache/memory.sqlite3"
+
+# HISTORY ENTRIES KEPT FOR THE GOAL SECTION (3 QUESTIONS AND 3 ANSWERS), EACH CUT TO HISTORY_CHARS
+HISTORY_TURNS = 6
+HISTORY_CHARS = 200
+
+MAX_FACTS = 32
+FACTS_PER_ANSWER = 1
+FACT_CHARS = 120
+
+# THE SHARE OF THE MEMORY BUDGET THE ROLLING SUMMARY OF OLDER FACTS MAY TAKE
+SUMMARY_SHARE = 0.4
+
+# A STATEMENT ABOUT THE USER ("I'm flying to London on Monday") IS A FACT; A QUESTION ISN'T
+CLAUSE_PATTERN = re.compile(r"(?<=[.!?])\s+|\s+[-–—]\s+|;\s*")
+FIRST_PERSON = re.compile(r"\b(?:I|I'm|I'll|I've|my|me|we|we're|our)\b", re.IGNORECASE)
+QUESTION_START = re.compile(
+    r"(?:what|when|where|who|which|why|how|can|could|do|does|did|is|are|should|would|will|may)\b", re.IGNORECASE
+)
+THIRD_PERSON = [
+    (re.compile(r"\bI'm\b|\bI am\b"), "the user is"),
+    (re.compile(r"\bI'll\b|\bI will\b"), "the user will"),
+    (re.compile(r"\bI've\b|\bI have\b"), "the user has"),
+    (re.compile(r"\bI\b"), "the user"),
+    (re.compile(r"\bwe're\b|\bwe are\b", re.IGNORECASE), "they are"),
+    (re.compile(r"\bwe\b", re.IGNORECASE), "they"),
+    (re.compile(r"\b(?:my|our)\b", re.IGNORECASE), "their"),
+    (re.compile(r"\bme\b", re.IGNORECASE), "them")
+]
+
+# AN ANSWER SENTENCE WITH AN AMOUNT OR A LIMIT ("$75 per day", "within 30 days") IS WORTH REMEMBERING
+ANSWER_SENTENCE = re.compile(r"[^.!?\n]+[.!?]?")
+AMOUNT_PATTERN = re.compile(
+    r"[$€£]\s?\d|\d+(?:[.,]\d+)?\s?(?:%|usd|eur|gbp|per\b|days?\b|hours?\b|nights?\b|miles?\b|km\b)",
+    re.IGNORECASE
+)
+
+# WORDS LEFT OUT WHEN A FACT IS FOLDED INTO THE SUMMARY
+SUMMARY_STOPWORDS = {
+    'the', 'a', 'an', 'is', 'are', 'was', 'were', 'be', 'to', 'of', 'for', 'and', 'or', 'in', 'on', 'at', 'by',
+    'user', 'they', 'their', 'them', 'will', 'has', 'have', 'that', 'this', 'with', 'policy:'
+}
+
+
+# A FIXED-CAPACITY RING: APPENDING TO A FULL BUFFER OVERWRITES (AND RETURNS) THE OLDEST ITEM IN O(1)
+class RingBuffer:
+
+    __slots__ = ('_items', '_start', '_size')
+
+    def __init__(self, capacity):
+        self._items = [None] * capacity
+        self._start = 0
+        self._size = 0
+
+    @property
+    def capacity(self):
+        return len(self._items)
+
+    def append(self, item):
+        if self._size < len(self._items):
+            self._items[(self._start + self._size) % len(self._items)] = item
+            self._size += 1
+            return None
+
+        evicted = self._items[self._start]
+        self._items[self._start] = item
+        self._start = (self._start + 1) % len(self._items)
+        return evicted
+
+    def popleft(self):
+        item = self._items[self._start]
+        self._items[self._start] = None
+        self._start = (self._start + 1) % len(self._items)
+        self._size -= 1
+        return item
+
+    def remove(self, item):
+        items = [current for current in self if current is not item]
+        self.clear()
+        for current in items:
+            self.append(current)
+
+    def clear(self):
+        self._items = [None] * len(self._items)
+        self._start = 0
+        self._size = 0
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self._items[(self._start + i) % len(self._items)]
+
+    def __len__(self):
+        return self._size
+
+
+# ONE HISTORY ENTRY; tokens IS THE COST OF ITS LINE IN THE GOAL ("role: content\n")
+class Turn:
+
+    __slots__ = ('seq', 'role', 'content', 'tokens')
+
+    def __init__(self, seq, role, content, tokens):
+        self.seq = seq
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+
+
+class Fact:
+
+    __slots__ = ('seq', 'kind', 'text', 'tokens')
+
+    def __init__(self, seq, kind, text, tokens):
+        self.seq = seq
+        self.kind = kind
+        self.text = text
+        self.tokens = tokens
+
+
+def shorten(text, limit=FACT_CHARS):
+
+    text = " ".join(text.split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0].rstrip(",;:") + "..."
+
+
+# WHAT THE USER SAID ABOUT THEMSELVES, IN THE THIRD PERSON: "I'm traveling to London next week - what do I need to
+# know?" GIVES "The user is traveling to London next week."
+def user_facts(question):
+
+    facts = []
+
+    for clause in CLAUSE_PATTERN.split(question):
+        clause = clause.strip()
+        if not clause or clause.endswith("?") or QUESTION_START.match(clause) or not FIRST_PERSON.search(clause):
+            continue
+
+        for pattern, replacement in THIRD_PERSON:
+            clause = pattern.sub(replacement, clause)
+        clause = shorten(clause.rstrip(".!"))
+        facts.append(clause[0].upper() + clause[1:] + ".")
+
+    return facts
+
+
+# THE FIRST SENTENCES OF AN ANSWER THAT STATE AN AMOUNT OR A LIMIT
+def answer_facts(answer, limit=FACTS_PER_ANSWER):
+
+    facts = []
+
+    for match in ANSWER_SENTENCE.finditer(answer):
+        sentence = match.group().strip(" -*\t")
+        if sentence and AMOUNT_PATTERN.search(sentence):
+            facts.append("Policy: " + shorten(sentence))
+            if len(facts) == limit:
+                break
+
+    return facts
+
+
+# A FACT AS A FEW KEY WORDS, FOR THE SUMMARY
+def key_phrase(text):
+
+    return " ".join(word for word in text.rstrip(".").split() if word.lower() not in SUMMARY_STOPWORDS)
+
+
+# ONE CONVERSATION'S MEMORY, REPLACING THE LISTS main.py, THE STREAMLIT APP AND pipeline.Session USED TO KEEP:
+#   - HISTORY: THE LAST history_turns ENTRIES IN A RING BUFFER, ALREADY CUT TO HISTORY_CHARS AND COUNTED
+#   - FACTS: EXTRACTED FROM EACH TURN AS IT IS RECORDED (STATEMENTS THE USER MADE, AMOUNTS AND LIMITS FROM THE
+#     ANSWER), NO MODEL CALL; A REPEATED FACT MOVES TO THE END INSTEAD OF BEING STORED TWICE
+#   - SUMMARY: WHEN THE FACTS NO LONGER FIT THE MEMORY BUDGET, THE OLDEST (ANSWER FACTS FIRST) ARE FOLDED INTO ONE
+#     ROLLING "Earlier: ..." LINE OF KEY WORDS, WHICH ITSELF KEEPS ONLY ITS NEWEST PHRASES WITHIN SUMMARY_SHARE OF
+#     THE BUDGET
+# EVERY ITEM CARRIES ITS TOKEN COUNT AND THE TOTAL IS KEPT RUNNING, SO RECORDING A TURN COSTS THE SAME ON THE
+# HUNDREDTH TURN AS ON THE FIRST, AND memory_items ALWAYS FITS build_memory's BUDGET WITHOUT A CUT
+# WITH A store, EVERY CHANGE IS WRITTEN TO SQLITE AS IT HAPPENS (SEE MemoryStore)
+class ConversationMemory:
+
+    def __init__(self, session_id=None, budget=None, counter=None, store=None, history_turns=HISTORY_TURNS):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.budget = context.BUDGETS['memory'] if budget is None else budget
+        self.counter = counter or models.model_counter()
+        self.store = store
+        self.history = RingBuffer(history_turns)
+        self.facts = RingBuffer(MAX_FACTS)
+        self.summary = []
+        self.summary_text = ""
+        self.summary_tokens = 0
+        self.fact_tokens = 0
+        self.next_seq = 0
+        self.turns_recorded = 0
+        self.facts_compacted = 0
+
+    @property
+    def summary_budget(self):
+        return int(self.budget * SUMMARY_SHARE)
+
+    # THE ITEMS AS build_memory JOINS THEM: ONE LINE EACH, SO EVERY LINE BREAK COSTS A TOKEN
+    @property
+    def tokens(self):
+        items = len(self.facts) + (1 if self.summary_text else 0)
+        return self.fact_tokens + self.summary_tokens + max(0, items - 1)
+
+    @property
+    def conversation_history(self):
+        return [{'role': turn.role, 'content': turn.content} for turn in self.history]
+
+    @property
+    def memory_items(self):
+        return ([self.summary_text] if self.summary_text else []) + [fact.text for fact in self.facts]
+
+    def _seq(self):
+        self.next_seq += 1
+        return self.next_seq
+
+    # FACTS PUSHED OUT OF A FULL RING ARE FOLDED LIKE ANY OTHER AND ADDED TO folded
+    def _add_fact(self, kind, text, tokens, folded):
+        for fact in self.facts:
+            if fact.text == text:
+                self.facts.remove(fact)
+                self.fact_tokens -= fact.tokens
+                break
+
+        fact = Fact(self._seq(), kind, text, tokens)
+        evicted = self.facts.append(fact)
+        self.fact_tokens += tokens
+        if evicted is not None:
+            self.fact_tokens -= evicted.tokens
+            self._fold(evicted)
+            folded.append(evicted)
+        return fact
+
+    def _fold(self, fact):
+        phrase = key_phrase(fact.text)
+        if phrase:
+            self.summary.append(phrase)
+        self.facts_compacted += 1
+
+        while True:
+            self.summary_text = "Earlier: " + "; ".join(self.summary)
+            self.summary_tokens = self.counter.count(self.summary_text)
+            if self.summary_tokens <= self.summary_budget or len(self.summary) <= 1:
+                break
+            self.summary.pop(0)
+
+        # A SINGLE PHRASE TOO LONG FOR THE SUMMARY IS CUT
+        if self.summary_tokens > self.summary_budget:
+            self.summary_text, self.summary_tokens, _ = self.counter.truncate(self.summary_text, self.summary_budget)
+            self.summary = [self.summary_text[len("Earlier: "):]]
+
+    # FOLDS THE OLDEST FACTS INTO THE SUMMARY UNTIL EVERYTHING FITS THE BUDGET. WHAT THE USER SAID ABOUT THEMSELVES
+    # IS KEPT LONGER THAN WHAT AN ANSWER SAID, WHICH RETRIEVAL CAN FIND AGAIN
+    def compact(self, folded=None):
+        folded = [] if folded is None else folded
+        while self.facts and self.tokens > self.budget:
+            fact = next((fact for fact in self.facts if fact.kind == 'answer'), None)
+            if fact is None:
+                fact = self.facts.popleft()
+            else:
+                self.facts.remove(fact)
+            self.fact_tokens -= fact.tokens
+            self._fold(fact)
+            folded.append(fact)
+        return folded
+
+    def record_turn(self, question, answer):
+        entries = [('user', question[:HISTORY_CHARS]), ('assistant', answer[:HISTORY_CHARS])]
+        extracted = list(dict.fromkeys(
+            [('user', text) for text in user_facts(question)] + [('answer', text) for text in answer_facts(answer)]
+        ))
+
+        counts = self.counter.count_many(
+            [f"{role}: {content}\n" for role, content in entries] + [text for _, text in extracted]
+        )
+
+        turns, dropped = [], []
+        for (role, content), tokens in zip(entries, counts):
+            turn = Turn(self._seq(), role, content, tokens)
+            evicted = self.history.append(turn)
+            turns.append(turn)
+            if evicted is not None:
+                dropped.append(evicted)
+
+        folded = []
+        added = [
+            self._add_fact(kind, text, tokens, folded) for (kind, text), tokens in zip(extracted, counts[len(entries):])
+        ]
+        self.compact(folded)
+        self.turns_recorded += 1
+
+        if self.store is not None:
+            self.store.save_turn(self, turns, dropped, added, folded)
+
+        return {'facts_added': [fact.text for fact in added], 'facts_compacted': len(folded)}
+
+    def stats(self):
+        return {
+            'turns_recorded': self.turns_recorded,
+            'history_entries': len(self.history),
+            'history_tokens': sum(turn.tokens for turn in self.history),
+            'facts': len(self.facts),
+            'facts_compacted': self.facts_compacted,
+            'memory_tokens': self.tokens,
+            'budget': self.budget
+        }
+
+
+# PER-SESSION MEMORY IN SQLITE (./cache/memory.sqlite3), SO A CONVERSATION SURVIVES A RESTART. A TURN WRITES ONLY
+# WHAT IT CHANGED: THE NEW HISTORY ENTRIES AND FACTS IN, THE DROPPED AND FOLDED ONES OUT, AND THE SUMMARY, IN ONE
+# TRANSACTION. TOKEN COUNTS ARE NOT STORED; THE FEW ROWS OF A SESSION ARE RE-COUNTED WHEN IT IS LOADED, WITH
+# WHATEVER TOKENIZER IS IN USE THEN
+class MemoryStore:
+
+    def __init__(self, path=MEMORY_PATH, budget=None, counter=None):
+        self.path = path
+        self.budget = budget
+        self.counter = counter
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS turns (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS facts (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                next_seq INTEGER NOT NULL,
+                turns_recorded INTEGER NOT NULL,
+                facts_compacted INTEGER NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self._db.commit()
+
+    # THE MEMORY OF A SESSION, AS IT WAS AFTER ITS LAST RECORDED TURN (EMPTY FOR A NEW ONE)
+    def session(self, session_id=None):
+        memory = ConversationMemory(session_id, self.budget, self.counter, store=self)
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT summary, next_seq, turns_recorded, facts_compacted FROM sessions WHERE session_id = ?",
+                (memory.session_id,)
+            ).fetchone()
+            if row is None:
+                return memory
+
+            turns = self._db.execute(
+                "SELECT seq, role, content FROM turns WHERE session_id = ? ORDER BY seq", (memory.session_id,)
+            ).fetchall()
+            facts = self._db.execute(
+                "SELECT seq, kind, text FROM facts WHERE session_id = ? ORDER BY seq", (memory.session_id,)
+            ).fetchall()
+
+        counts = memory.counter.count_many(
+            [f"{role}: {content}\n" for _, role, content in turns] + [text for _, _, text in facts]
+        )
+        for (seq, role, content), tokens in zip(turns, counts):
+            memory.history.append(Turn(seq, role, content, tokens))
+        for (seq, kind, text), tokens in zip(facts, counts[len(turns):]):
+            memory.facts.append(Fact(seq, kind, text, tokens))
+            memory.fact_tokens += tokens
+
+        memory.summary = json.loads(row[0])
+        if memory.summary:
+            memory.summary_text = "Earlier: " + "; ".join(memory.summary)
+            memory.summary_tokens = memory.counter.count(memory.summary_text)
+        memory.next_seq, memory.turns_recorded, memory.facts_compacted = row[1], row[2], row[3]
+
+        # A SMALLER BUDGET (OR ANOTHER TOKENIZER) THAN THE SESSION WAS SAVED WITH
+        if memory.tokens > memory.budget:
+            folded = memory.compact()
+            self.save_turn(memory, [], [], [], folded)
+
+        return memory
+
+    def save_turn(self, memory, turns, dropped, added, folded):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO turns (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(memory.session_id, turn.seq, turn.role, turn.content) for turn in turns]
+            )
+            self._db.executemany(
+                "DELETE FROM turns WHERE session_id = ? AND seq = ?",
+                [(memory.session_id, turn.seq) for turn in dropped]
+            )
+
+            # A REPEATED FACT WAS MOVED TO THE END WITH A NEW seq; ITS OLD ROW IS REPLACED
+            self._db.executemany(
+                "DELETE FROM facts WHERE session_id = ? AND text = ?",
+                [(memory.session_id, fact.text) for fact in added]
+            )
+            self._db.executemany(
+                "INSERT INTO facts (session_id, seq, kind, text) VALUES (?, ?, ?, ?)",
+                [(memory.session_id, fact.seq, fact.kind, fact.text) for fact in added]
+            )
+            self._db.executemany(
+                "DELETE FROM facts WHERE session_id = ? AND seq = ?",
+                [(memory.session_id, fact.seq) for fact in folded]
+            )
+
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, summary, next_seq, turns_recorded, facts_compacted, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (memory.session_id, json.dumps(memory.summary), memory.next_seq, memory.turns_recorded,
+                 memory.facts_compacted, time.time())
+            )
+            self._db.commit()
+
+    def delete(self, session_id):
+        with self._lock:
+            for table in ('turns', 'facts', 'sessions'):
+                self._db.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,141 @@
+import importlib.util
+import os
+from functools import lru_cache
+
+from tokenizer import ENCODING_NAME, get_counter, is_tokenizer_file
+
+
+DEFAULT_MODEL = "llama3.2:1b"
+# NEXT TO THIS MODULE, NOT THE WORKING DIRECTORY, SO THE FILES ARE FOUND WHEREVER THE APP IS STARTED FROM
+TOKENIZER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tokenizers")
+
+# TOKENS KEPT FREE FOR THE PART OF THE PROMPT OUTSIDE THE ASSEMBLED CONTEXT (THE QUESTION LINE AND ANSWER CUE)
+PROMPT_OVERHEAD_TOKENS = 128
+
+# WHEN A MODEL'S OWN TOKENIZER FILE ISN'T AVAILABLE WE COUNT WITH THE FALLBACK ENCODING, WHICH CAN DISAGREE
+# WITH THE REAL TOKENIZER BY A FEW PERCENT, SO WE GIVE UP THIS FRACTION OF THE WINDOW AS A SAFETY MARGIN
+APPROXIMATE_MARGIN = 0.10
+
+# HOW LONG OLLAMA KEEPS THE MODEL LOADED AFTER A CALL (ITS DEFAULT IS 5 MINUTES). WHILE IT IS LOADED THE KV CACHE
+# OF THE LAST PROMPT IS KEPT TOO, SO THE NEXT TURN ONLY EVALUATES THE PART OF ITS PROMPT THAT CHANGED
+KEEP_ALIVE = "30m"
+
+
+# EACH PROFILE BINDS A MODEL NAME TO:
+#   tokenizer              - A tiktoken ENCODING NAME OR A LOCAL tokenizer.json (DOWNLOADED INTO TOKENIZER_DIR)
+#   fallback_tokenizer     - THE tiktoken ENCODING TO USE IF THAT FILE (OR THE tokenizers PACKAGE) IS MISSING
+#   context_length         - THE WINDOW WE RUN THE MODEL WITH (PASSED TO OLLAMA AS num_ctx)
+#   reserved_output_tokens - TOKENS LEFT FREE FOR THE ANSWER (PASSED TO OLLAMA AS num_predict)
+MODEL_PROFILES = {
+    'llama3.2:1b': {
+        'tokenizer': os.path.join(TOKENIZER_DIR, 'llama3.2.json'),
+        'fallback_tokenizer': ENCODING_NAME,
+        'context_length': 8192,
+        'reserved_output_tokens': 1024
+    },
+    'llama3.2:3b': {
+        'tokenizer': os.path.join(TOKENIZER_DIR, 'llama3.2.json'),
+        'fallback_tokenizer': ENCODING_NAME,
+        'context_length': 8192,
+        'reserved_output_tokens': 1024
+    },
+    'llama3.1:8b': {
+        'tokenizer': os.path.join(TOKENIZER_DIR, 'llama3.1.json'),
+        'fallback_tokenizer': ENCODING_NAME,
+        'context_length': 8192,
+        'reserved_output_tokens': 1024
+    },
+    'mistral:7b': {
+        'tokenizer': os.path.join(TOKENIZER_DIR, 'mistral.json'),
+        'fallback_tokenizer': ENCODING_NAME,
+        'context_length': 8192,
+        'reserved_output_tokens': 1024
+    }
+}
+
+# UNKNOWN MODELS GET OLLAMA'S DEFAULT WINDOW AND THE ENCODING WE HAVE ALWAYS USED
+DEFAULT_PROFILE = {
+    'tokenizer': ENCODING_NAME,
+    'fallback_tokenizer': ENCODING_NAME,
+    'context_length': 4096,
+    'reserved_output_tokens': 512
+}
+
+
+@lru_cache(maxsize=None)
+def _tokenizers_installed():
+
+    return importlib.util.find_spec('tokenizers') is not None
+
+
+def _tokenizer_available(encoding_name):
+
+    if not is_tokenizer_file(encoding_name):
+        return True
+
+    return os.path.exists(encoding_name) and _tokenizers_installed()
+
+
+# OLLAMA NAMES ARE name[:tag]; "llama3.2" AND "llama3.2:latest" FALL BACK TO THE FIRST PROFILE OF THAT NAME
+@lru_cache(maxsize=None)
+def _profile(model):
+
+    if model in MODEL_PROFILES:
+        return MODEL_PROFILES[model]
+
+    name = model.split(':')[0]
+    matches = [key for key in MODEL_PROFILES if key.split(':')[0] == name]
+    return MODEL_PROFILES[matches[0]] if matches else DEFAULT_PROFILE
+
+
+# THE RESOLVED PROFILE IS CACHED PER (MODEL, TOKENIZER AVAILABLE), SO A tokenizer.json DOWNLOADED WHILE THE
+# PROCESS IS RUNNING IS PICKED UP ON THE NEXT LOOKUP INSTEAD OF KEEPING THE FALLBACK AND ITS MARGIN FOREVER
+def _resolve(model):
+
+    profile = _profile(model)
+
+    return _resolve_profile(model, _tokenizer_available(profile['tokenizer']))
+
+
+@lru_cache(maxsize=None)
+def _resolve_profile(model, available):
+
+    profile = _profile(model)
+    approximate = not available
+    encoding_name = profile['fallback_tokenizer'] if approximate else profile['tokenizer']
+
+    input_tokens = profile['context_length'] - profile['reserved_output_tokens'] - PROMPT_OVERHEAD_TOKENS
+    if approximate:
+        input_tokens = int(input_tokens * (1 - APPROXIMATE_MARGIN))
+
+    return {
+        **profile,
+        'model': model,
+        'encoding_name': encoding_name,
+        'approximate': approximate,
+        'input_tokens': input_tokens
+    }
+
+
+# THE PROFILE FOR A MODEL, WITH THE ENCODING ACTUALLY IN USE AND THE TOKENS AVAILABLE FOR THE ASSEMBLED CONTEXT
+def get_profile(model=None):
+
+    return dict(_resolve(model or DEFAULT_MODEL))
+
+
+# THE SHARED (CACHED) TOKEN COUNTER FOR A MODEL'S TOKENIZER
+def model_counter(model=None):
+
+    return get_counter(_resolve(model or DEFAULT_MODEL)['encoding_name'])
+
+
+# KEYWORD ARGUMENTS THAT RUN AN OLLAMA MODEL WITH THE WINDOW ITS PROFILE WAS BUDGETED FOR, KEPT LOADED BETWEEN TURNS
+def ollama_options(model=None):
+
+    profile = _resolve(model or DEFAULT_MODEL)
+
+    return {
+        'num_ctx': profile['context_length'],
+        'num_predict': profile['reserved_output_tokens'],
+        'keep_alive': KEEP_ALIVE
+    }
@@ -0,0 +1,138 @@
+import time
+
+import numpy as np
+
+
+PARTIAL_MIN_TOKENS = 100
+PARTIAL_MARGIN_TOKENS = 50
+KNAPSACK_EXACT_CELLS = 2_000_000
+
+
+# WE DECIDE WHICH RETRIEVED CHUNKS FIT IN THE RETRIEVAL BUDGET. EVERY STRATEGY TAKES THE SAME INPUTS:
+#   costs  - TOKENS EACH CHUNK WOULD ADD (HEADER INCLUDED), IN SIMILARITY ORDER
+#   scores - RELEVANCE OF EACH CHUNK (HIGHER IS BETTER), IN THE SAME ORDER
+#   budget - TOKENS AVAILABLE FOR CHUNKS
+# AND RETURNS THE INDICES IT SELECTED, PLUS OPTIONALLY ONE CHUNK TO CUT INTO THE SPACE LEFT OVER
+
+
+def relevance_scores(retrieved_docs):
+
+    # THE RETRIEVER ATTACHES A SIMILARITY WHEN IT HAS ONE; OTHERWISE RANK ORDER IS ALL WE KNOW, SO SCORES DECAY BY RANK
+    scores = []
+    for rank, doc in enumerate(retrieved_docs):
+        score = doc.metadata.get('relevance_score')
+        scores.append(float(score) if score is not None else 1.0 / (rank + 1))
+    return scores
+
+
+# THE ORIGINAL BEHAVIOUR: WALK IN SIMILARITY ORDER AND KEEP WHATEVER STILL FITS. THE FIRST CHUNK THAT DOESN'T FIT
+# IS CUT INTO THE REMAINING SPACE IF FEWER THAN 2 CHUNKS WERE KEPT AND OVER 100 TOKENS ARE LEFT, AND THE WALK STOPS
+def pack_greedy(costs, scores, budget):
+
+    selected = []
+    used = 0
+
+    for i, cost in enumerate(costs):
+        if used + cost <= budget:
+            selected.append(i)
+            used += cost
+        elif budget - used > PARTIAL_MIN_TOKENS and len(selected) < 2:
+            return selected, i
+
+    return selected, None
+
+
+# TAKE CHUNKS BY RELEVANCE PER TOKEN, SO SEVERAL SHORT RELEVANT CHUNKS CAN BEAT ONE LONG ONE
+def pack_density(costs, scores, budget):
+
+    order = sorted(range(len(costs)), key=lambda i: (-scores[i] / max(costs[i], 1), i))
+    selected = []
+    used = 0
+
+    for i in order:
+        if used + costs[i] <= budget:
+            selected.append(i)
+            used += costs[i]
+
+    return sorted(selected), best_partial(costs, scores, budget - used, selected)
+
+
+# 0/1 KNAPSACK OVER THE TOKEN BUDGET, MAXIMIZING TOTAL RELEVANCE. THE DP ROW OVER ALL CAPACITIES IS UPDATED
+# WITH ONE VECTORIZED OPERATION PER CHUNK. WHEN chunks x budget GETS VERY LARGE, COSTS ARE ROUNDED UP TO A
+# COARSER TOKEN GRANULARITY (APPROXIMATE, BUT NEVER OVER BUDGET)
+def pack_knapsack(costs, scores, budget):
+
+    n = len(costs)
+    if n == 0 or budget <= 0:
+        return [], None
+
+    granularity = max(1, int(np.ceil(n * (budget + 1) / KNAPSACK_EXACT_CELLS)))
+    capacity = budget // granularity
+    weights = [-(-cost // granularity) for cost in costs]
+
+    best = np.zeros(capacity + 1)
+    taken = np.zeros((n, capacity + 1), dtype=bool)
+
+    for i in range(n):
+        weight = weights[i]
+        if weight > capacity:
+            continue
+        candidate = best[:capacity + 1 - weight] + scores[i]
+        improved = candidate > best[weight:]
+        taken[i, weight:] = improved
+        best[weight:] = np.where(improved, candidate, best[weight:])
+
+    selected = []
+    remaining = capacity
+    for i in range(n - 1, -1, -1):
+        if taken[i, remaining]:
+            selected.append(i)
+            remaining -= weights[i]
+
+    selected.sort()
+    used = sum(costs[i] for i in selected)
+
+    return selected, best_partial(costs, scores, budget - used, selected)
+
+
+# WITH ENOUGH SPACE LEFT, THE MOST RELEVANT CHUNK THAT DIDN'T FIT IS CUT INTO IT
+def best_partial(costs, scores, remaining, selected):
+
+    if remaining <= PARTIAL_MIN_TOKENS:
+        return None
+
+    chosen = set(selected)
+    dropped = [i for i in range(len(costs)) if i not in chosen]
+
+    return max(dropped, key=lambda i: scores[i]) if dropped else None
+
+
+STRATEGIES = {
+    'greedy': pack_greedy,
+    'density': pack_density,
+    'knapsack': pack_knapsack
+}
+
+
+def pack(strategy, costs, scores, budget):
+
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown packing strategy {strategy!r}; expected one of {sorted(STRATEGIES)}")
+
+    start = time.perf_counter()
+    selected, partial = STRATEGIES[strategy](costs, scores, budget)
+    elapsed = time.perf_counter() - start
+
+    chosen = set(selected)
+    if partial is not None:
+        chosen.add(partial)
+
+    return {
+        'strategy': strategy,
+        'selected': selected,
+        'partial': partial,
+        'dropped': [i for i in range(len(costs)) if i not in chosen],
+        'tokens_selected': sum(costs[i] for i in selected),
+        'score_selected': sum(scores[i] for i in selected),
+        'seconds': elapsed
+    }
@@ -0,0 +1,200 @@
+import asyncio
+import time
+import uuid
+
+import context
+import models
+from answer_cache import answer_scope
+from context_session import ContextSession
+from memory_store import ConversationMemory
+
+
+LLM_MODEL = "llama3.2:1b"
+MODEL_PARAMS = {'model': LLM_MODEL, 'temperature': 0.1}
+
+MAX_CONCURRENCY = 8
+RETRIEVAL_TIMEOUT = 10.0
+GENERATION_TIMEOUT = 120.0
+
+
+# PER-SESSION CONVERSATION STATE. TURNS WITHIN ONE SESSION ARE SERIALIZED; DIFFERENT SESSIONS RUN CONCURRENTLY
+# HISTORY AND FACTS LIVE IN A ConversationMemory (memory_store.py); WITH A MemoryStore THEY ARE LOADED FROM AND
+# SAVED TO SQLITE, SO A SESSION ID PICKS UP WHERE IT LEFT OFF AFTER A RESTART
+class Session:
+
+    def __init__(self, session_id=None, memory_store=None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.memory = memory_store.session(self.session_id) if memory_store else ConversationMemory(self.session_id)
+        self.tool_results = []
+        self.lock = asyncio.Lock()
+        self.context_session = None
+
+    # THE SECTIONS BUILT FOR THIS CONVERSATION, REUSED ON ITS NEXT TURN WHEN THEIR INPUTS HAVEN'T CHANGED
+    def sections(self, counter=None):
+        if self.context_session is None:
+            self.context_session = ContextSession(counter=counter)
+        return self.context_session
+
+    @property
+    def conversation_history(self):
+        return self.memory.conversation_history
+
+    @property
+    def memory_items(self):
+        return self.memory.memory_items
+
+    def record_turn(self, question, answer):
+        return self.memory.record_turn(question, answer)
+
+
+# THE DOCUMENTS AND, WHEN THE RETRIEVER EXPOSES IT, THE QUERY EMBEDDING THEY WERE FOUND WITH (FOR THE ANSWER
+# CACHE'S SEMANTIC TIER); OTHERWISE THE EMBEDDING IS None
+async def _retrieve(retriever, question):
+
+    if hasattr(retriever, 'ainvoke_with_embedding'):
+        return await retriever.ainvoke_with_embedding(question)
+    if hasattr(retriever, 'invoke_with_embedding'):
+        return await asyncio.to_thread(retriever.invoke_with_embedding, question)
+    if hasattr(retriever, 'ainvoke'):
+        return await retriever.ainvoke(question), None
+    return await asyncio.to_thread(retriever.invoke, question), None
+
+
+async def _generate(model, prompt):
+
+    if hasattr(model, 'ainvoke'):
+        return await model.ainvoke(prompt)
+    return await asyncio.to_thread(model.invoke, prompt)
+
+
+async def _timed(coroutine, timings, name):
+
+    start = time.perf_counter()
+    try:
+        return await coroutine
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+# INSTRUCTIONS, GOAL, MEMORY AND TOOL OUTPUTS DON'T DEPEND ON RETRIEVAL, SO THEY ARE BUILT WHILE THE SEARCH RUNS
+def build_static_sections(question, session, counter=None):
+
+    sections = session.sections(counter)
+
+    return (
+        sections.instructions(),
+        sections.goal(question, session.conversation_history),
+        sections.memory(session.memory_items),
+        sections.tool_outputs(session.tool_results)
+    )
+
+
+# RETRIEVE -> ASSEMBLE -> GENERATE, WITH THE INDEPENDENT CONTEXT SECTIONS OVERLAPPING THE VECTOR SEARCH
+# A SEMAPHORE BOUNDS HOW MANY REQUESTS ARE IN FLIGHT, AND EACH BACKEND CALL HAS ITS OWN TIMEOUT
+class AsyncPipeline:
+
+    def __init__(self, retriever, model, max_concurrency=MAX_CONCURRENCY, retrieval_timeout=RETRIEVAL_TIMEOUT,
+                 generation_timeout=GENERATION_TIMEOUT, answer_cache=None, model_params=None):
+        self.retriever = retriever
+        self.model = model
+        self.retrieval_timeout = retrieval_timeout
+        self.generation_timeout = generation_timeout
+        self.answer_cache = answer_cache
+        self.model_params = model_params or MODEL_PARAMS
+        self.counter = models.model_counter(self.model_params.get('model'))
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _assemble(self, question, session, timings):
+        (retrieved_docs, query_embedding), static_sections = await asyncio.gather(
+            _timed(
+                asyncio.wait_for(_retrieve(self.retriever, question), self.retrieval_timeout),
+                timings, 'retrieval_seconds'
+            ),
+            _timed(asyncio.to_thread(build_static_sections, question, session, self.counter), timings, 'sections_seconds')
+        )
+
+        # DEDUP, COMPRESSION AND PACKING ARE CPU WORK, SO THEY STAY OFF THE SHARED EVENT LOOP TOO
+        assembly_start = time.perf_counter()
+        instructions, goal, memory, tool_outputs = static_sections
+        retrieval = await asyncio.to_thread(session.sections(self.counter).retrieval, retrieved_docs, question)
+        assembled_context, breakdown, overflow_occurred, total_tokens = context.assemble_sections(
+            instructions, goal, memory, retrieval, tool_outputs
+        )
+        timings['assembly_seconds'] = time.perf_counter() - assembly_start
+
+        return query_embedding, {
+            'session_id': session.session_id,
+            'question': question,
+            'retrieved_docs': retrieved_docs,
+            'assembled_context': assembled_context,
+            'breakdown': breakdown,
+            'overflow': overflow_occurred,
+            'total_tokens': total_tokens,
+            'timings': timings
+        }
+
+    # RETRIEVE AND ASSEMBLE ONLY, WITHOUT CALLING THE LLM OR CHANGING THE SESSION
+    async def assemble_async(self, question, session):
+        async with self.semaphore, session.lock:
+            start = time.perf_counter()
+            _, result = await self._assemble(question, session, {})
+            result['timings']['total_seconds'] = time.perf_counter() - start
+            return result
+
+    async def answer_async(self, question, session):
+        async with self.semaphore, session.lock:
+            start = time.perf_counter()
+            query_embedding, result = await self._assemble(question, session, {})
+            timings = result['timings']
+            prompt = context.build_prompt(result['assembled_context'], question)
+
+            # THE ANSWER CACHE IS SQLITE, SO ITS LOOKUPS AND WRITES RUN IN A WORKER THREAD LIKE THE SESSION SAVE BELOW
+            answer, cache_hit = None, None
+            if self.answer_cache is not None:
+                scope = answer_scope(self.model_params, result['breakdown'])
+                answer, cache_hit = await asyncio.to_thread(
+                    self.answer_cache.get, prompt, self.model_params, query_embedding, scope
+                )
+
+            if answer is None:
+                answer = await _timed(
+                    asyncio.wait_for(_generate(self.model, prompt), self.generation_timeout),
+                    timings, 'generation_seconds'
+                )
+                if self.answer_cache is not None:
+                    await asyncio.to_thread(
+                        self.answer_cache.put, prompt, self.model_params, answer, question, query_embedding, scope
+                    )
+
+            await asyncio.to_thread(session.record_turn, question, answer)
+            timings['total_seconds'] = time.perf_counter() - start
+
+            result['answer'] = answer
+            result['cache_hit'] = cache_hit
+            return result
+
+
+_default_pipeline = None
+
+
+# THE DEFAULT PIPELINE USES THE CACHED RETRIEVER AND THE SAME OLLAMA MODEL AS THE CLI AND STREAMLIT APP
+def get_pipeline():
+
+    global _default_pipeline
+
+    if _default_pipeline is None:
+        from langchain_ollama import OllamaLLM
+        import vector_db
+
+        _default_pipeline = AsyncPipeline(
+            vector_db.get_retriever(),
+            OllamaLLM(model=LLM_MODEL, temperature=0.1, **models.ollama_options(LLM_MODEL))
+        )
+
+    return _default_pipeline
+
+
+async def answer_async(question, session, pipeline=None):
+
+    return await (pipeline or get_pipeline()).answer_async(question, session)
@@ -0,0 +1,204 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+CACHE_SIZE = 1024
+CACHE_TTL = 3600
+
+
+# A SMALL THREAD-SAFE LRU CACHE WHOSE ENTRIES ALSO EXPIRE AFTER ttl SECONDS
+class TTLCache:
+
+    def __init__(self, max_entries=CACHE_SIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'max_entries': self.max_entries
+            }
+
+
+def normalize_query(query):
+
+    return " ".join(query.split()).casefold()
+
+
+# WE WRAP THE VECTOR STORE SO A REPEATED QUESTION NEVER REACHES THE EMBEDDING MODEL OR THE INDEX
+# QUERY EMBEDDINGS ARE CACHED BY NORMALIZED TEXT (THEY ONLY DEPEND ON THE EMBEDDING MODEL), AND TOP-K
+# RESULTS BY (NORMALIZED TEXT, k, INDEX VERSION) SO A RE-INDEX INVALIDATES THEM AUTOMATICALLY
+# WITH A router_fn (RETURNING THE CURRENT SourceRouter, SEE router.py) THE SEARCH IS FILTERED TO THE ROUTED
+# POLICY FILES; IF THEY HOLD FEWER THAN k CHUNKS THE REST ARE FILLED FROM A SEARCH OVER EVERYTHING
+class CachedRetriever:
+
+    def __init__(self, vector_store, k=6, version_fn=None, max_entries=CACHE_SIZE, ttl=CACHE_TTL, router_fn=None):
+        self.vector_store = vector_store
+        self.k = k
+        self.version_fn = version_fn or (lambda: None)
+        self.router_fn = router_fn
+        self.embedding_cache = TTLCache(max_entries, ttl)
+        self.result_cache = TTLCache(max_entries, ttl)
+        self._version = None
+        self._version_lock = threading.Lock()
+        self.routes = {'keyword': 0, 'centroid': 0, 'global': 0, 'topped_up': 0}
+
+    def _current_version(self):
+        version = self.version_fn()
+
+        with self._version_lock:
+            if version != self._version:
+                self.result_cache.clear()
+                self._version = version
+
+        return version
+
+    def cached_embedding(self, query):
+        return self.embedding_cache.get(normalize_query(query))
+
+    def store_embedding(self, query, embedding):
+        self.embedding_cache.put(normalize_query(query), embedding)
+
+    def embed_query(self, query):
+        embedding = self.cached_embedding(query)
+
+        if embedding is None:
+            embedding = self.vector_store.embeddings.embed_query(normalize_query(query))
+            self.store_embedding(query, embedding)
+
+        return embedding
+
+    def cached_results(self, query):
+        documents = self.result_cache.get((normalize_query(query), self.k, self._current_version()))
+        return None if documents is None else list(documents)
+
+    # SEARCHES WITH AN EMBEDDING THE CALLER ALREADY HAS (E.G. FROM A BATCHED EMBEDDING CALL) AND CACHES THE RESULT
+    # EACH DOCUMENT CARRIES A relevance_score (HIGHER IS MORE SIMILAR) FOR THE RETRIEVAL PACKING STRATEGIES
+    def search(self, query, embedding):
+        key = (normalize_query(query), self.k, self._current_version())
+
+        documents = []
+        for document, distance in self._routed_search(query, embedding):
+            document.metadata['relevance_score'] = 1.0 / (1.0 + distance)
+            documents.append(document)
+
+        self.result_cache.put(key, documents)
+        return list(documents)
+
+    # WITH A ROUTER, EVERY DOCUMENT IS TAGGED WITH HOW IT WAS FOUND: THE ROUTING METHOD, 'global' OR 'topped_up'
+    def _routed_search(self, query, embedding):
+        if self.router_fn is None:
+            return self.vector_store.similarity_search_by_vector_with_relevance_scores(embedding, k=self.k)
+
+        route = self.router_fn().route(query, embedding)
+
+        if not route['sources']:
+            self._count_route('global')
+            results = self.vector_store.similarity_search_by_vector_with_relevance_scores(embedding, k=self.k)
+            return self._tagged(results, 'global')
+
+        from router import source_filter
+
+        results = self._tagged(self.vector_store.similarity_search_by_vector_with_relevance_scores(
+            embedding, k=self.k, filter=source_filter(route['sources'])
+        ), route['method'])
+        self._count_route(route['method'])
+
+        if len(results) >= self.k:
+            return results
+
+        # THE ROUTED FILES HOLD FEWER THAN k CHUNKS: THEY STAY FIRST AND THE BEST OTHER CHUNKS FILL THE REST
+        self._count_route('topped_up')
+        found = {document.id for document, _ in results}
+        extra = self.vector_store.similarity_search_by_vector_with_relevance_scores(embedding, k=self.k + len(results))
+        results += [(document, distance) for document, distance in self._tagged(extra, 'topped_up')
+                    if document.id not in found][:self.k - len(results)]
+
+        return results
+
+    @staticmethod
+    def _tagged(results, route):
+        for document, _ in results:
+            document.metadata['route'] = route
+        return results
+
+    def _count_route(self, method):
+        with self._version_lock:
+            self.routes[method] += 1
+
+    # THE DOCUMENTS AND THE QUERY EMBEDDING THEY WERE FOUND WITH, SO A CALLER THAT ALSO NEEDS THE EMBEDDING (THE
+    # ANSWER CACHE'S SEMANTIC TIER) DOESN'T EMBED THE QUESTION AGAIN. A CACHED RESULT COMES WITH THE CACHED EMBEDDING,
+    # OR None IF THAT HAS EXPIRED
+    def invoke_with_embedding(self, query):
+        documents = self.cached_results(query)
+
+        if documents is not None:
+            return documents, self.cached_embedding(query)
+
+        embedding = self.embed_query(query)
+        return self.search(query, embedding), embedding
+
+    def invoke(self, query):
+        return self.invoke_with_embedding(query)[0]
+
+    # THE CHROMA CLIENT IS SYNCHRONOUS, SO THE ASYNC PATH RUNS THE SAME LOOKUP IN A WORKER THREAD
+    async def ainvoke(self, query):
+        return await asyncio.to_thread(self.invoke, query)
+
+    def clear(self):
+        self.embedding_cache.clear()
+        self.result_cache.clear()
+
+    def cache_stats(self):
+        stats = {
+            'embeddings': self.embedding_cache.stats(),
+            'results': self.result_cache.stats()
+        }
+        if self.router_fn:
+            with self._version_lock:
+                stats['routing'] = dict(self.routes)
+
+        return stats
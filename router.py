@@ -0,0 +1,133 @@
+import json
+import os
+
+import numpy as np
+
+from lexical import tokenize
+
+
+MAX_SOURCES = 3
+KEYWORD_MAX_SOURCES = 2
+MIN_COVERAGE = 1.0
+CENTROID_MARGIN = 0.05
+
+
+# WE ROUTE A QUESTION TO THE FEW POLICY FILES (`source` METADATA) IT IS ABOUT, SO THE VECTOR SEARCH ONLY SCANS
+# THOSE PARTITIONS AND OFF-TOPIC CHUNKS DON'T EAT THE RETRIEVAL BUDGET. TWO CHEAP SIGNALS, NO MODEL CALL:
+#   - KEYWORDS: A TERM THAT ONLY APPEARS IN keyword_max_sources FILES ("london", "luggage") VOTES FOR THEM
+#   - CENTROIDS: OTHERWISE, THE MEAN EMBEDDING OF EACH FILE IS COMPARED WITH THE QUERY EMBEDDING; THE BEST FILES
+#     MUST BEAT THE REST BY centroid_margin
+# EITHER WAY EVERY QUERY TERM THE CORPUS KNOWS MUST OCCUR IN THE CHOSEN FILES (min_coverage), OR THE ROUTE IS
+# NOT CONFIDENT AND WE SEARCH GLOBALLY. BOTH TABLES ARE REBUILT AFTER EVERY SYNC, LIKE THE BM25 INDEX
+class SourceRouter:
+
+    def __init__(self, sources, term_sources, centroids, version=None, max_sources=MAX_SOURCES,
+                 keyword_max_sources=KEYWORD_MAX_SOURCES, min_coverage=MIN_COVERAGE, centroid_margin=CENTROID_MARGIN):
+        self.sources = sources
+        self.term_sources = term_sources
+        self.centroids = np.asarray(centroids, dtype=np.float32).reshape(len(sources), -1)
+        self.version = version
+        self.max_sources = max_sources
+        self.keyword_max_sources = keyword_max_sources
+        self.min_coverage = min_coverage
+        self.centroid_margin = centroid_margin
+
+    # term_sources MAPS EVERY TERM TO THE (SORTED) INDICES OF THE FILES IT APPEARS IN; A CENTROID IS THE
+    # NORMALIZED MEAN OF A FILE'S NORMALIZED CHUNK EMBEDDINGS
+    @classmethod
+    def build(cls, texts, metadatas, embeddings, version=None, **kwargs):
+        names = [(metadata or {}).get('source', '') for metadata in metadatas]
+        sources = sorted(set(names))
+        position = {source: i for i, source in enumerate(sources)}
+        labels = np.array([position[name] for name in names], dtype=np.int64)
+
+        term_sources = {}
+        for text, label in zip(texts, labels):
+            for term in set(tokenize(text)):
+                term_sources.setdefault(term, set()).add(int(label))
+        term_sources = {term: sorted(owners) for term, owners in term_sources.items()}
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if len(vectors):
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            sums = np.zeros((len(sources), vectors.shape[1]), dtype=np.float32)
+            np.add.at(sums, labels, vectors)
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        else:
+            centroids = np.empty((len(sources), 0), dtype=np.float32)
+
+        return cls(sources, term_sources, centroids, version, **kwargs)
+
+    def coverage(self, terms, chosen):
+        chosen = set(chosen)
+        return sum(1 for term in terms if chosen.intersection(self.term_sources[term])) / len(terms)
+
+    def keyword_candidates(self, terms):
+        votes = np.zeros(len(self.sources), dtype=np.float32)
+
+        for term in terms:
+            owners = self.term_sources[term]
+            if len(owners) <= self.keyword_max_sources:
+                votes[owners] += 1.0 / len(owners)
+
+        voted = np.flatnonzero(votes)
+        return [int(i) for i in voted[np.argsort(-votes[voted], kind='stable')][:self.max_sources]]
+
+    # THE FILES WITHIN centroid_margin OF THE BEST ONE, AND HOW FAR THE WEAKEST OF THEM IS AHEAD OF THE REST
+    def centroid_candidates(self, embedding):
+        query = np.asarray(embedding, dtype=np.float32).ravel()
+        scores = self.centroids @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        order = np.argsort(-scores, kind='stable')
+
+        chosen = [int(i) for i in order[:self.max_sources] if scores[i] >= scores[order[0]] - self.centroid_margin]
+        runner_up = scores[order[len(chosen)]] if len(chosen) < len(order) else -np.inf
+
+        return chosen, float(scores[chosen[-1]] - runner_up)
+
+    # RETURNS {'sources': [FILE NAMES] OR None FOR A GLOBAL SEARCH, 'method', 'confidence'}
+    def route(self, query, embedding=None):
+        terms = [term for term in dict.fromkeys(tokenize(query)) if term in self.term_sources]
+
+        if not terms or len(self.sources) <= 1:
+            return {'sources': None, 'method': 'global', 'confidence': 0.0}
+
+        chosen = self.keyword_candidates(terms)
+        if chosen:
+            confidence = self.coverage(terms, chosen)
+            if confidence >= self.min_coverage:
+                return {'sources': [self.sources[i] for i in chosen], 'method': 'keyword', 'confidence': confidence}
+
+        elif embedding is not None and self.centroids.shape[1]:
+            chosen, separation = self.centroid_candidates(embedding)
+            confidence = self.coverage(terms, chosen)
+            if separation >= self.centroid_margin and confidence >= self.min_coverage:
+                return {'sources': [self.sources[i] for i in chosen], 'method': 'centroid', 'confidence': separation}
+
+        return {'sources': None, 'method': 'global', 'confidence': 0.0}
+
+    def save(self, path):
+        tmp_file = path + ".tmp"
+        content = {
+            'version': self.version,
+            'sources': self.sources,
+            'term_sources': self.term_sources,
+            'centroids': self.centroids.tolist()
+        }
+
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(content, f)
+
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path, 'r', encoding='utf-8') as f:
+            content = json.load(f)
+
+        return cls(content['sources'], content['term_sources'], content['centroids'], content['version'], **kwargs)
+
+
+# THE CHROMA-STYLE METADATA FILTER FOR A ROUTE (THE FLAT STORES ACCEPT THE SAME SYNTAX)
+def source_filter(sources):
+
+    return {'source': {'$in': list(sources)}}
@@ -0,0 +1,435 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from retrieval_cache import normalize_query
+from pipeline import AsyncPipeline, Session
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import threading
+import time
+
+
+HOST = "127.0.0.1"
+PORT = 8000
+
+MAX_PENDING = 64
+MAX_CONCURRENCY = 16
+MAX_BATCH = 16
+BATCH_WAIT = 0.01
+BACKEND_CONNECTIONS = 16
+REQUEST_TIMEOUT = 180.0
+SESSION_TTL = 3600
+MAX_SESSIONS = 10000
+
+
+# WE COLLECT QUERY TEXTS FROM CONCURRENT REQUESTS FOR UP TO max_wait SECONDS (OR max_batch TEXTS)
+# AND EMBED THEM WITH ONE CALL TO THE EMBEDDING BACKEND INSTEAD OF ONE CALL PER REQUEST
+class EmbeddingBatcher:
+
+    def __init__(self, embeddings, max_batch=MAX_BATCH, max_wait=BATCH_WAIT):
+        self.embeddings = embeddings
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self.batches = 0
+        self.texts = 0
+        self.largest_batch = 0
+
+    async def embed(self, text):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush_now)
+
+        return await future
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._embed_batch(batch))
+
+    async def _embed_batch(self, batch):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+
+        try:
+            if hasattr(self.embeddings, 'aembed_documents'):
+                vectors = await self.embeddings.aembed_documents(texts)
+            else:
+                vectors = await asyncio.to_thread(self.embeddings.embed_documents, texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
+
+        self.batches += 1
+        self.texts += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'texts': self.texts,
+            'largest_batch': self.largest_batch,
+            'mean_batch': self.texts / self.batches if self.batches else 0.0
+        }
+
+
+# SERVES FROM THE RETRIEVAL CACHE WHEN POSSIBLE AND OTHERWISE SENDS THE QUERY THROUGH THE EMBEDDING BATCHER
+class BatchingRetriever:
+
+    def __init__(self, retriever, batcher):
+        self.retriever = retriever
+        self.batcher = batcher
+
+    def invoke(self, query):
+        return self.retriever.invoke(query)
+
+    # THE DOCUMENTS AND THE QUERY EMBEDDING THEY WERE FOUND WITH, WHICH THE PIPELINE HANDS TO THE ANSWER CACHE
+    async def ainvoke_with_embedding(self, query):
+        documents = self.retriever.cached_results(query)
+        if documents is not None:
+            return documents, self.retriever.cached_embedding(query)
+
+        embedding = self.retriever.cached_embedding(query)
+        if embedding is None:
+            embedding = await self.batcher.embed(normalize_query(query))
+            self.retriever.store_embedding(query, embedding)
+
+        return await asyncio.to_thread(self.retriever.search, query, embedding), embedding
+
+    async def ainvoke(self, query):
+        return (await self.ainvoke_with_embedding(query))[0]
+
+
+# PER-SESSION CONVERSATION STATE, ONLY TOUCHED FROM THE EVENT LOOP THREAD
+# IDLE SESSIONS EXPIRE AFTER ttl SECONDS AND THE OLDEST ARE DROPPED BEYOND max_sessions; WITH A memory_store AN
+# EXPIRED SESSION'S HISTORY AND FACTS ARE RELOADED WHEN ITS ID COMES BACK. THAT LOAD IS A SQLITE READ, SO A NEW
+# Session IS CREATED IN A WORKER THREAD (AS batch.py DOES) RATHER THAN BLOCKING EVERY REQUEST ON THE LOOP
+class SessionStore:
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS, memory_store=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.memory_store = memory_store
+        self._sessions = {}
+
+    async def get(self, session_id=None, create=True):
+        now = time.monotonic()
+        self._expire(now)
+
+        entry = self._sessions.get(session_id) if session_id else None
+        if entry is None:
+            if not create:
+                return None
+            session = await asyncio.to_thread(Session, session_id, self.memory_store)
+
+            # ANOTHER REQUEST FOR THE SAME ID MAY HAVE CREATED IT WHILE THIS ONE WAS LOADING; THE FIRST ONE WINS, SO
+            # BOTH SHARE ONE SESSION (AND ITS LOCK)
+            entry = self._sessions.setdefault(session.session_id, [session, now])
+
+        entry[1] = time.monotonic()
+        return entry[0]
+
+    def _expire(self, now):
+        expired = [session_id for session_id, (_, last_used) in self._sessions.items() if now - last_used > self.ttl]
+        for session_id in expired:
+            del self._sessions[session_id]
+
+        if len(self._sessions) >= self.max_sessions:
+            oldest = sorted(self._sessions, key=lambda session_id: self._sessions[session_id][1])
+            for session_id in oldest[:len(self._sessions) - self.max_sessions + 1]:
+                del self._sessions[session_id]
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+# A DEEPER LISTEN BACKLOG THAN THE STDLIB DEFAULT OF 5, SO BURSTS ARE ANSWERED (OR REJECTED WITH 503), NOT RESET
+class APIHTTPServer(ThreadingHTTPServer):
+
+    request_queue_size = 256
+    daemon_threads = True
+
+
+def serialize_documents(documents):
+
+    return [{'content': document.page_content, 'metadata': document.metadata} for document in documents]
+
+
+def serialize_result(result):
+
+    payload = {key: value for key, value in result.items() if key != 'retrieved_docs'}
+    payload['retrieved_docs'] = serialize_documents(result['retrieved_docs'])
+    return payload
+
+
+# THE HTTP SIDE IS A THREADED STDLIB SERVER; ALL PIPELINE WORK RUNS ON ONE SHARED EVENT LOOP IN A BACKGROUND THREAD
+# WHEN max_pending REQUESTS ARE ALREADY IN FLIGHT, NEW ONES ARE REJECTED WITH 503 INSTEAD OF QUEUEING WITHOUT BOUND
+class AssistantServer:
+
+    def __init__(self, pipeline, batcher=None, sessions=None, max_pending=MAX_PENDING, request_timeout=REQUEST_TIMEOUT):
+        self.pipeline = pipeline
+        self.batcher = batcher
+        self.sessions = sessions or SessionStore()
+        self.max_pending = max_pending
+        self.request_timeout = request_timeout
+        self.pending = 0
+        self.rejected = 0
+        self.completed = 0
+        self._pending_lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._loop_thread.start()
+
+    def try_acquire(self):
+        with self._pending_lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self._pending_lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(self.request_timeout)
+
+    # RUNS THE PIPELINE WORK OF A REQUEST THAT HOLDS A PENDING SLOT (try_acquire). THE SLOT IS GIVEN BACK WHEN THE
+    # TASK ITSELF FINISHES, NOT WHEN THE HANDLER STOPS WAITING: A REQUEST THAT TIMES OUT IS CANCELLED, AND ITS SLOT
+    # ONLY FREES UP ONCE THE CANCELLATION HAS RELEASED THE PIPELINE SEMAPHORE AND THE BACKEND CALL IT HELD
+    def run_pending(self, coroutine):
+        outcome = concurrent.futures.Future()
+
+        def finished(task):
+            self.release()
+            try:
+                if task.cancelled():
+                    outcome.cancel()
+                elif task.exception() is not None:
+                    outcome.set_exception(task.exception())
+                else:
+                    outcome.set_result(task.result())
+            except concurrent.futures.InvalidStateError:
+                pass
+
+        def start():
+            # THE HANDLER GAVE UP BEFORE THE LOOP GOT TO THE REQUEST
+            if outcome.cancelled():
+                coroutine.close()
+                self.release()
+                return
+
+            task = self.loop.create_task(coroutine)
+            task.add_done_callback(finished)
+            outcome.add_done_callback(lambda _: self.loop.call_soon_threadsafe(task.cancel))
+
+        self.loop.call_soon_threadsafe(start)
+        try:
+            return outcome.result(self.request_timeout)
+        except concurrent.futures.TimeoutError:
+            outcome.cancel()
+            raise
+
+    async def ask(self, question, session_id=None):
+        session = await self.sessions.get(session_id)
+        return serialize_result(await self.pipeline.answer_async(question, session))
+
+    async def assemble(self, question, session_id=None):
+        session = await self.sessions.get(session_id)
+        return serialize_result(await self.pipeline.assemble_async(question, session))
+
+    async def retrieve(self, question):
+        start = time.perf_counter()
+        documents = await asyncio.wait_for(
+            self.pipeline.retriever.ainvoke(question),
+            self.pipeline.retrieval_timeout
+        )
+        return {
+            'question': question,
+            'retrieved_docs': serialize_documents(documents),
+            'timings': {'retrieval_seconds': time.perf_counter() - start}
+        }
+
+    async def session_state(self, session_id):
+        session = await self.sessions.get(session_id, create=False)
+        if session is None:
+            return None
+        return {
+            'session_id': session.session_id,
+            'conversation_history': session.conversation_history,
+            'memory_items': session.memory_items,
+            'tool_results': session.tool_results,
+            'memory': session.memory.stats(),
+            'sections': session.context_session.stats() if session.context_session else None
+        }
+
+    def stats(self):
+        stats = {
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'max_pending': self.max_pending,
+            'sessions': len(self.sessions)
+        }
+        if self.batcher is not None:
+            stats['embedding_batches'] = self.batcher.stats()
+        if hasattr(self.pipeline.retriever, 'retriever') and hasattr(self.pipeline.retriever.retriever, 'cache_stats'):
+            stats['retrieval_cache'] = self.pipeline.retriever.retriever.cache_stats()
+        return stats
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _send(self, status, payload, headers=None):
+                body = json.dumps(payload, default=str).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            # THE BODY MUST BE A JSON OBJECT; VALID JSON OF ANY OTHER KIND ([], "x", 1) IS REJECTED LIKE INVALID JSON
+            def _read_json(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(body, dict):
+                    raise ValueError("request body is not a JSON object")
+                return body
+
+            def do_GET(self):
+                if self.path == "/health":
+                    self._send(200, {'status': 'ok'})
+                elif self.path == "/stats":
+                    self._send(200, server.stats())
+                elif self.path.startswith("/sessions/"):
+                    state = server.run(server.session_state(self.path[len("/sessions/"):]))
+                    if state is None:
+                        self._send(404, {'error': 'unknown session'})
+                    else:
+                        self._send(200, state)
+                else:
+                    self._send(404, {'error': 'not found'})
+
+            def do_POST(self):
+                routes = {'/ask': server.ask, '/assemble': server.assemble, '/retrieve': server.retrieve}
+                handler = routes.get(self.path)
+
+                if handler is None:
+                    self._send(404, {'error': 'not found'})
+                    return
+
+                try:
+                    body = self._read_json()
+                except (ValueError, UnicodeDecodeError):
+                    self._send(400, {'error': 'request body must be a JSON object'})
+                    return
+
+                question = str(body.get('question', '')).strip()
+                if not question:
+                    self._send(400, {'error': "'question' is required"})
+                    return
+
+                if not server.try_acquire():
+                    self._send(503, {'error': 'server busy'}, {'Retry-After': '1'})
+                    return
+
+                # FROM HERE THE PENDING SLOT BELONGS TO THE TASK, WHICH GIVES IT BACK WHEN IT FINISHES (run_pending)
+                try:
+                    if self.path == '/retrieve':
+                        result = server.run_pending(handler(question))
+                    else:
+                        result = server.run_pending(handler(question, body.get('session_id')))
+                    self._send(200, result)
+                except (asyncio.TimeoutError, TimeoutError, concurrent.futures.CancelledError):
+                    self._send(504, {'error': 'backend timed out'})
+                except Exception as e:
+                    self._send(500, {'error': str(e)})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, host=HOST, port=PORT):
+        httpd = APIHTTPServer((host, port), self.make_handler())
+        print(f"Serving on http://{host}:{port} (max {self.max_pending} pending requests)")
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+# ONE SHARED EMBEDDING CLIENT AND ONE SHARED LLM CLIENT, EACH WITH A BOUNDED KEEP-ALIVE CONNECTION POOL
+def build_server(max_pending=MAX_PENDING, max_concurrency=MAX_CONCURRENCY, max_batch=MAX_BATCH,
+                 batch_wait=BATCH_WAIT, connections=BACKEND_CONNECTIONS):
+
+    from langchain_ollama import OllamaLLM
+    from answer_cache import AnswerCache
+    from memory_store import MemoryStore
+    import httpx
+    import models
+    import pipeline
+    import vector_db
+
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    client_kwargs = {'limits': limits}
+
+    retriever = vector_db.get_retriever({'embedding_client_kwargs': client_kwargs})
+    model = OllamaLLM(model=pipeline.LLM_MODEL, temperature=0.1, client_kwargs=client_kwargs,
+                      **models.ollama_options(pipeline.LLM_MODEL))
+
+    batcher = EmbeddingBatcher(retriever.vector_store.embeddings, max_batch=max_batch, max_wait=batch_wait)
+
+    return AssistantServer(
+        AsyncPipeline(
+            BatchingRetriever(retriever, batcher),
+            model,
+            max_concurrency=max_concurrency,
+            answer_cache=AnswerCache()
+        ),
+        batcher=batcher,
+        sessions=SessionStore(memory_store=MemoryStore()),
+        max_pending=max_pending
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP API for the T&E policy assistant")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING, help="requests in flight before returning 503")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY, help="requests processed at once")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="query embeddings per backend call")
+    parser.add_argument("--batch-wait-ms", type=float, default=BATCH_WAIT * 1000, help="how long to wait to fill a batch")
+    parser.add_argument("--connections", type=int, default=BACKEND_CONNECTIONS, help="pooled connections per backend")
+    args = parser.parse_args()
+
+    build_server(
+        max_pending=args.max_pending,
+        max_concurrency=args.max_concurrency,
+        max_batch=args.max_batch,
+        batch_wait=args.batch_wait_ms / 1000,
+        connections=args.connections
+    ).serve(args.host, args.port)
@@ -1,9 +1,15 @@
 import streamlit as st
-from langchain_ollama import OllamaLLM, OllamaEmbeddings
-from langchain_chroma import Chroma
-from vector_db import retriever
+from langchain_ollama import OllamaLLM
+from answer_cache import AnswerCache, answer_scope
+from generation import BackendSession, stream_answer, format_timings
+from context_session import ContextSession
+from memory_store import MemoryStore
+from allocator import ContextAllocator
+import vector_db
 import context
+import models
 import os
+import time
 
 
 st.set_page_config(
@@ -41,21 +47,38 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+LLM_MODEL = "llama3.2:1b"
+MODEL_PARAMS = {'model': LLM_MODEL, 'temperature': 0.1}
+
+
 @st.cache_resource
 def load_system():
-
-    LLM_MODEL = "llama3.2:1b"
     
     try:
-        llm = OllamaLLM(model=LLM_MODEL, temperature=0.1)
-        return llm, "ready"
+        start = time.perf_counter()
+        llm = OllamaLLM(model=LLM_MODEL, temperature=0.1, **models.ollama_options(LLM_MODEL))
+        retriever = vector_db.get_retriever()
+        return llm, retriever, "ready", time.perf_counter() - start
     except Exception as e:
-        return None, None, str(e)
+        return None, None, str(e), 0.0
+
+
+@st.cache_resource
+def load_answer_cache():
+
+    return AnswerCache()
 
-model, status = load_system()
+
+@st.cache_resource
+def get_memory_store():
+
+    return MemoryStore()
+
+model, retriever, status, startup_seconds = load_system()
+answer_cache = load_answer_cache()
 
 
-def display_token_breakdown(breakdown, total_tokens, overflow_occurred):
+def display_token_breakdown(breakdown, total_tokens, overflow_occurred, cache_hit=None):
     """Display token budget breakdown in table format like terminal output."""
     
     st.markdown("### 📊 Context Budget Breakdown")
@@ -102,7 +125,15 @@ def display_token_breakdown(breakdown, total_tokens, overflow_occurred):
         if ret_data['truncated']:
             st.warning(f"⚠️ **Budget Overflow:** Kept {ret_data.get('chunks_kept', 0)} chunks, dropped {ret_data.get('chunks_dropped', 0)} chunks (Original: {ret_data.get('original_tokens', 'N/A')} tokens)")
     
+    dedup_report = breakdown['retrieval'].get('dedup')
+    if dedup_report and dedup_report['tokens_saved']:
+        st.caption(f"♻️ **Dedup:** saved {dedup_report['tokens_saved']} tokens (merged {dedup_report['chunks_merged']} chunks, "
+                   f"removed {dedup_report['duplicates_removed']} duplicates)")
+    
     st.caption(f"**Total Context:** {total_tokens} tokens")
+    
+    if cache_hit:
+        st.caption(f"💾 **Answer cache:** {cache_hit} hit (LLM call skipped)")
 
 
 with st.sidebar:
@@ -110,6 +141,7 @@ with st.sidebar:
     
     if status == "ready":
         st.success("● System Ready")
+        st.caption(f"Started in {startup_seconds:.2f}s")
     else:
         st.error(f"● Error: {status}")
         if status == "Database not found":
@@ -122,6 +154,8 @@ with st.sidebar:
     show_breakdown = st.toggle("Show token breakdown", value=True)
     show_context = st.toggle("Show assembled context", value=False)
     show_sources = st.toggle("Show source chunks", value=False)
+    dynamic_budgets = st.toggle("Reallocate unused budget", value=False,
+                                help="Split one window by what each section needs instead of the fixed budgets")
     
     st.divider()
     
@@ -135,6 +169,24 @@ with st.sidebar:
         - **Tool Outputs:** {budgets['tool_outputs']} tokens
         """)
     
+    if hasattr(retriever, 'cache_stats'):
+        with st.expander("⚡ Retrieval Cache"):
+            cache_stats = retriever.cache_stats()
+            st.markdown(f"""
+            - **Results:** {cache_stats['results']['hits']} hits / {cache_stats['results']['misses']} misses
+            - **Query embeddings:** {cache_stats['embeddings']['hits']} hits / {cache_stats['embeddings']['misses']} misses
+            - **Entries:** {cache_stats['results']['size']}/{cache_stats['results']['max_entries']}
+            """)
+    
+    with st.expander("💾 Answer Cache"):
+        answer_stats = answer_cache.stats()
+        st.markdown(f"""
+        - **Exact hits:** {answer_stats['exact_hits']}
+        - **Near-duplicate hits:** {answer_stats['semantic_hits']}
+        - **Misses:** {answer_stats['misses']}
+        - **Stored answers:** {answer_stats['entries']} ({answer_stats['bytes'] / 1024:.0f} KB)
+        """)
+    
     st.divider()
     
     with st.expander("ℹ️ About"):
@@ -149,14 +201,24 @@ with st.sidebar:
     st.divider()
     if st.button("🗑️ Clear Chat History"):
         st.session_state.clear()
+        st.query_params.clear()
         st.rerun()
 
 
 if 'messages' not in st.session_state:
     st.session_state.messages = []
 
-if 'conversation_history' not in st.session_state:
-    st.session_state.conversation_history = []
+# EACH CONVERSATION HAS ITS OWN MEMORY, PERSISTED UNDER THE ?session= ID IN THE URL SO A RELOAD (OR A RESTART OF
+# THE APP) CONTINUES IT; CLEARING THE CHAT STARTS A NEW ONE
+if 'memory' not in st.session_state:
+    st.session_state.memory = get_memory_store().session(st.query_params.get("session"))
+    st.query_params["session"] = st.session_state.memory.session_id
+
+if 'backend_session' not in st.session_state:
+    st.session_state.backend_session = BackendSession()
+
+if 'context_session' not in st.session_state:
+    st.session_state.context_session = ContextSession(LLM_MODEL)
 
 
 st.title("✈️ T&E Policy Assistant")
@@ -199,10 +261,13 @@ for message in st.session_state.messages:
         with st.chat_message("assistant"):
             st.markdown(message["content"])
             
+            if "timings" in message:
+                st.caption(f"⏱ {format_timings(message['timings'])}")
+            
             if "breakdown" in message:
                 if show_breakdown:
                     st.divider()
-                    display_token_breakdown(message["breakdown"], message["total_tokens"], message["overflow"])
+                    display_token_breakdown(message["breakdown"], message["total_tokens"], message["overflow"], message.get("cache_hit"))
 
 
 
@@ -227,39 +292,62 @@ if user_input:
         with st.status("🔍 Processing...", expanded=False) as status:
             
             st.write("Searching policies...")
-            retrieved_docs = retriever.invoke(user_input)
+            # THE RETRIEVER HANDS BACK THE QUERY EMBEDDING IT SEARCHED WITH (None WHEN A KEYWORD MATCH SKIPPED THE
+            # EMBEDDING CALL), WHICH THE ANSWER CACHE REUSES BELOW
+            if hasattr(retriever, 'invoke_with_embedding'):
+                retrieved_docs, query_embedding = retriever.invoke_with_embedding(user_input)
+            else:
+                retrieved_docs, query_embedding = retriever.invoke(user_input), None
             st.write(f"✓ Retrieved {len(retrieved_docs)} chunks")
             
             st.write("Assembling context with token budgets...")
-            assembled_context, breakdown, overflow_occurred, total_tokens = context.assemble_context(
-                user_question=user_input,
-                retrieved_docs=retrieved_docs,
-                conversation_history=st.session_state.conversation_history,
-                memory_items=None,
-                tool_results=None
-            )
+            allocation = None
+            if dynamic_budgets:
+                assembled_context, breakdown, overflow_occurred, total_tokens, allocation = ContextAllocator.for_model(LLM_MODEL).assemble(
+                    user_question=user_input,
+                    retrieved_docs=retrieved_docs,
+                    conversation_history=st.session_state.memory.conversation_history,
+                    memory_items=st.session_state.memory.memory_items,
+                    tool_results=None
+                )
+            else:
+                assembled_context, breakdown, overflow_occurred, total_tokens = st.session_state.context_session.assemble(
+                    user_question=user_input,
+                    retrieved_docs=retrieved_docs,
+                    conversation_history=st.session_state.memory.conversation_history,
+                    memory_items=st.session_state.memory.memory_items,
+                    tool_results=None
+                )
             st.write("✓ Context assembled")
+            if allocation:
+                for decision in allocation['reallocations']:
+                    st.write(f"↔ {decision['section']} {decision['action']} {decision['tokens']} tokens "
+                             f"({decision['fixed_budget']} → {decision['budget']})")
             
-            st.write("Generating answer...")
-            prompt = f"""{assembled_context}
-
-            ---
-
-            Question: {user_input}
-
-            Answer (be concise and cite relevant policies):
-            """
+            prompt = context.build_prompt(assembled_context, user_input)
             
-            answer = model.invoke(prompt)
-            st.write("✓ Complete")
+            scope = answer_scope(MODEL_PARAMS, breakdown)
+            answer, cache_hit = answer_cache.get(prompt, MODEL_PARAMS, query_embedding, scope)
             
-            status.update(label="✅ Done!", state="complete")
+            st.write("Generating answer..." if not cache_hit else f"✓ Answer cache: {cache_hit} hit")
+            status.update(label="✅ Context ready", state="complete")
+        
+        # THE ANSWER IS RENDERED TOKEN BY TOKEN AS THE MODEL GENERATES IT
+        timings = None
+        if answer is None:
+            stream = stream_answer(model, prompt, st.session_state.backend_session)
+            st.write_stream(stream)
+            answer = stream.answer
+            timings = stream.timings()
+            answer_cache.put(prompt, MODEL_PARAMS, answer, user_input, query_embedding, scope)
+        else:
+            st.markdown(answer)
         
-        st.markdown(answer)
+        st.caption(f"⏱ {format_timings(timings)}")
         
         if show_breakdown:
             st.divider()
-            display_token_breakdown(breakdown, total_tokens, overflow_occurred)
+            display_token_breakdown(breakdown, total_tokens, overflow_occurred, cache_hit)
         
         if show_context:
             with st.expander("📄 Assembled Context"):
@@ -277,18 +365,10 @@ if user_input:
         "content": answer,
         "breakdown": breakdown,
         "total_tokens": total_tokens,
-        "overflow": overflow_occurred
-    })
-    
-    st.session_state.conversation_history.append({
-        'role': 'user',
-        'content': user_input
-    })
-    st.session_state.conversation_history.append({
-        'role': 'assistant',
-        'content': answer[:200]
+        "overflow": overflow_occurred,
+        "cache_hit": cache_hit,
+        "timings": timings
     })
     
-    if len(st.session_state.conversation_history) > 6:
-        st.session_state.conversation_history = st.session_state.conversation_history[-6:]
+    st.session_state.memory.record_turn(user_input, answer)
 
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeEmbeddings
+
+
+CORPUS = [
+    "I'm travelling to Tokyo next week for a client workshop. What is the hotel limit?",
+    "The hotel limit in Tokyo is $250 per night. Book through the travel portal.",
+    "My manager approved business class; flights over 6 hours need VP approval.",
+    "Per diem covers meals and incidentals. Taxi receipts are required above $25."
+]
+
+
+@pytest.fixture
+def embeddings():
+    return FakeEmbeddings()
+
+
+# A SMALL BYTE-LEVEL BPE TRAINED ON THE SPOT AND LOADED THROUGH THE SAME tokenizer.json PATH AS A MODEL'S OWN
+# TOKENIZER, SO THE TESTS COUNT REAL TOKENS WITHOUT DOWNLOADING AN ENCODING
+@pytest.fixture(scope="session")
+def counter(tmp_path_factory):
+    tokenizers = pytest.importorskip("tokenizers")
+    from tokenizer import TokenCounter
+
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.BPE())
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = tokenizers.decoders.ByteLevel()
+    tokenizer.train_from_iterator(CORPUS, tokenizers.trainers.BpeTrainer(
+        vocab_size=400, initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet(), show_progress=False
+    ))
+
+    path = str(tmp_path_factory.mktemp("tokenizer") / "bpe.json")
+    tokenizer.save(path)
+
+    return TokenCounter(path)
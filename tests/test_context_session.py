@@ -0,0 +1,55 @@
+import pytest
+
+import context
+import models
+from context_session import ContextSession
+from fakes import FakeRetriever, synthetic_documents
+
+
+QUESTIONS = [
+    "When do I need receipts for expenses?",
+    "What's the meal allowance for domestic travel?",
+    "I'm traveling to London next week - what do I need to know?",
+    "Tell me about ground transportation including taxis and rental cars"
+]
+
+
+# THE BREAKDOWN RECORDS HOW LONG PACKING, DEDUP AND COMPRESSION TOOK; THOSE ARE THE ONLY FIELDS ALLOWED TO DIFFER
+def without_timings(value):
+    if isinstance(value, dict):
+        return {key: without_timings(item) for key, item in value.items() if not key.endswith('seconds')}
+    if isinstance(value, (list, tuple)):
+        return type(value)(without_timings(item) for item in value)
+    return value
+
+
+@pytest.mark.parametrize("layout", ['prefix_stable', 'classic'])
+def test_session_matches_assemble_context_every_turn(counter, monkeypatch, layout):
+    monkeypatch.setattr(models, 'model_counter', lambda model=None: counter)
+
+    retriever = FakeRetriever(synthetic_documents(40), k=6)
+    session = ContextSession(counter=counter, layout=layout)
+    conversation_history, memory_items, tool_results = [], [], []
+
+    for turn in range(24):
+        question = QUESTIONS[turn // 2 % len(QUESTIONS)] + ("" if turn % 2 == 0 else " Please be specific.")
+        retrieved_docs = retriever.invoke(QUESTIONS[turn // 2 % len(QUESTIONS)])
+        if turn % 5 == 4:
+            memory_items = (memory_items + [f"The user asked about {question.split()[-1]}"])[-3:]
+        if turn % 7 == 6:
+            tool_results = [f"currency: 1 GBP = {1.2 + turn / 100:.2f} USD"]
+
+        expected = context.assemble_context(
+            question, retrieved_docs, conversation_history, memory_items, tool_results, layout=layout
+        )
+        actual = session.assemble(question, retrieved_docs, conversation_history, memory_items, tool_results)
+
+        assert without_timings(actual) == without_timings(expected)
+
+        conversation_history.append({'role': 'user', 'content': question})
+        conversation_history.append({'role': 'assistant', 'content': f"Answer {turn}: " + "see the policy. " * 20})
+
+    stats = session.stats()
+    assert stats['built']['instructions'] == 1
+    assert stats['reused']['memory'] > 0
+    assert stats['reused']['tool_outputs'] > 0
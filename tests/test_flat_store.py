@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+import pytest
+
+import flat_store
+from flat_store import FlatVectorStore
+
+
+TEXTS = {
+    'hotel_0': "hotel limit tokyo nightly rate",
+    'meals_0': "meal per diem breakfast lunch dinner",
+    'taxi_0': "taxi receipt airport transfer",
+    'flight_0': "flight business class approval long haul",
+    'visa_0': "visa passport embassy application fee"
+}
+
+
+def open_store(path, embeddings):
+    return FlatVectorStore("policies", str(path), embeddings)
+
+
+def fill(store, embeddings, ids=None):
+    ids = ids or list(TEXTS)
+    store.upsert(
+        ids,
+        embeddings.embed_documents([TEXTS[chunk_id] for chunk_id in ids]),
+        [{'source': f"{chunk_id.split('_')[0]}.txt", 'chunk_id': chunk_id} for chunk_id in ids],
+        [TEXTS[chunk_id] for chunk_id in ids]
+    )
+
+
+def top_ids(store, embeddings, text, k=3, filter=None):
+    return [document.id for document, _ in store.search_batch([embeddings.embed_query(text)], k, filter)[0]]
+
+
+def test_upsert_then_search(tmp_path, embeddings):
+    store = open_store(tmp_path, embeddings)
+    fill(store, embeddings)
+
+    results = store.search_batch([embeddings.embed_query(TEXTS['taxi_0'])], k=2)[0]
+
+    assert len(store) == len(TEXTS)
+    assert results[0][0].id == 'taxi_0'
+    assert results[0][0].page_content == TEXTS['taxi_0']
+    assert results[0][0].metadata == {'source': 'taxi.txt', 'chunk_id': 'taxi_0'}
+    assert results[0][1] == pytest.approx(1.0)
+    assert results[0][1] >= results[1][1]
+
+
+def test_upsert_replaces_an_existing_id(tmp_path, embeddings):
+    store = open_store(tmp_path, embeddings)
+    fill(store, embeddings)
+
+    replacement = "rail pass european train ticket"
+    store.upsert(['taxi_0'], embeddings.embed_documents([replacement]), [{'source': 'rail.txt'}], [replacement])
+
+    assert len(store) == len(TEXTS)
+    assert store.get(['taxi_0'])['documents'] == [replacement]
+    assert top_ids(store, embeddings, replacement, k=1) == ['taxi_0']
+    assert store.search_batch([embeddings.embed_query(replacement)], k=1)[0][0][0].metadata == {'source': 'rail.txt'}
+    assert 'taxi receipt' not in " ".join(store.get()['documents'])
+
+
+def test_delete_then_search(tmp_path, embeddings):
+    store = open_store(tmp_path, embeddings)
+    fill(store, embeddings)
+
+    store.delete(['hotel_0'])
+
+    assert len(store) == len(TEXTS) - 1
+    assert 'hotel_0' not in top_ids(store, embeddings, TEXTS['hotel_0'], k=len(TEXTS))
+    assert store.get(['hotel_0'])['ids'] == []
+    assert top_ids(store, embeddings, TEXTS['hotel_0'], k=len(TEXTS), filter={'source': 'hotel.txt'}) == []
+
+
+def test_compaction_preserves_ids_and_metadata(tmp_path, embeddings, monkeypatch):
+    # KEEP THE TOMBSTONES AROUND UNTIL compact() IS CALLED EXPLICITLY
+    monkeypatch.setattr(flat_store, 'COMPACT_RATIO', 1.0)
+
+    store = open_store(tmp_path, embeddings)
+    fill(store, embeddings)
+    before = store.get(include=['embeddings'])
+    generation = store._meta['generation']
+
+    store.delete(['meals_0', 'visa_0'])
+    store.compact()
+
+    after = store.get(include=['embeddings'])
+    kept = [i for i, chunk_id in enumerate(before['ids']) if chunk_id not in ('meals_0', 'visa_0')]
+
+    assert after['ids'] == [before['ids'][i] for i in kept]
+    assert after['documents'] == [before['documents'][i] for i in kept]
+    assert after['metadatas'] == [before['metadatas'][i] for i in kept]
+    assert np.allclose(after['embeddings'], before['embeddings'][kept])
+    assert store._meta['deleted'] == []
+    assert store._meta['rows'] == len(kept)
+    assert store._meta['generation'] == generation + 1
+    assert not os.path.exists(store.vectors_file(generation))
+    assert top_ids(store, embeddings, TEXTS['flight_0'], k=1) == ['flight_0']
+
+
+def test_deletes_past_the_ratio_compact_automatically(tmp_path, embeddings):
+    store = open_store(tmp_path, embeddings)
+    fill(store, embeddings)
+    generation = store._meta['generation']
+
+    store.delete(['hotel_0', 'meals_0'])
+
+    assert store._meta['deleted'] == []
+    assert store._meta['generation'] == generation + 1
+    assert sorted(store.get()['ids']) == ['flight_0', 'taxi_0', 'visa_0']
+
+
+def test_reopening_after_compaction(tmp_path, embeddings):
+    store = open_store(tmp_path, embeddings)
+    fill(store, embeddings)
+    store.delete(['hotel_0'])
+    store.compact()
+    expected = store.get(include=['embeddings'])
+
+    reopened = open_store(tmp_path, embeddings)
+    stored = reopened.get(include=['embeddings'])
+
+    assert stored['ids'] == expected['ids']
+    assert stored['documents'] == expected['documents']
+    assert stored['metadatas'] == expected['metadatas']
+    assert np.allclose(stored['embeddings'], expected['embeddings'])
+    for chunk_id in expected['ids']:
+        assert top_ids(reopened, embeddings, TEXTS[chunk_id], k=1) == [chunk_id]
+
+    # AND THE REOPENED STORE KEEPS WORKING AS A WRITER
+    fill(reopened, embeddings, ['hotel_0'])
+    assert top_ids(reopened, embeddings, TEXTS['hotel_0'], k=1) == ['hotel_0']
+
+
+def test_open_reader_follows_a_compaction_by_another_writer(tmp_path, embeddings):
+    writer = open_store(tmp_path, embeddings)
+    fill(writer, embeddings)
+    reader = open_store(tmp_path, embeddings)
+    assert len(reader) == len(TEXTS)
+
+    writer.delete(['taxi_0'])
+    writer.compact()
+
+    assert len(reader) == len(TEXTS) - 1
+    assert reader._meta['generation'] == writer._meta['generation']
+    assert 'taxi_0' not in top_ids(reader, embeddings, TEXTS['taxi_0'], k=len(TEXTS))
+    for chunk_id in reader.get()['ids']:
+        assert top_ids(reader, embeddings, TEXTS[chunk_id], k=1) == [chunk_id]
+
+
+def test_a_failed_upsert_leaves_the_saved_store_intact(tmp_path, embeddings):
+    store = open_store(tmp_path, embeddings)
+    fill(store, embeddings)
+
+    with pytest.raises(ValueError):
+        store.upsert(['bad_0'], [[1.0, 0.0]], [{}], ["wrong dimension"])
+
+    assert len(store) == len(TEXTS)
+    assert store.get(['bad_0'])['ids'] == []
+    assert len(open_store(tmp_path, embeddings)) == len(TEXTS)
@@ -0,0 +1,99 @@
+import memory_store
+from memory_store import ConversationMemory, MemoryStore
+
+
+TURNS = [
+    ("I'm travelling to Tokyo next week for a client workshop. What is the hotel limit?",
+     "The hotel limit in Tokyo is $250 per night. Book through the travel portal."),
+    ("My manager approved business class, can I book it?",
+     "Business class requires VP approval for flights over 6 hours."),
+    ("We are staying four nights. Is breakfast covered?",
+     "Breakfast is covered by the per diem when it is not included in the room rate."),
+    ("I'll take a taxi from the airport. Do I need a receipt?",
+     "Taxi receipts are required for fares above $25."),
+    ("Our client is paying for dinner on the last night. Does that change my per diem?",
+     "Meals provided by a client are deducted from the per diem for that day.")
+]
+
+
+def state(memory):
+    return {
+        'conversation_history': memory.conversation_history,
+        'memory_items': memory.memory_items,
+        'tokens': memory.tokens,
+        'next_seq': memory.next_seq,
+        'stats': memory.stats()
+    }
+
+
+def test_session_round_trip(tmp_path, counter):
+    path = str(tmp_path / "memory.sqlite3")
+
+    store = MemoryStore(path, counter=counter)
+    memory = store.session("trip")
+    for question, answer in TURNS:
+        memory.record_turn(question, answer)
+    saved = state(memory)
+    store.close()
+
+    loaded = MemoryStore(path, counter=counter).session("trip")
+
+    assert state(loaded) == saved
+    assert saved['memory_items']
+
+
+def test_round_trip_matches_a_memory_that_was_never_saved(tmp_path, counter, monkeypatch):
+    # A SMALL FACT RING AND BUDGET, SO HISTORY ENTRIES ARE DROPPED AND FACTS FOLDED INTO THE SUMMARY ALONG THE WAY
+    monkeypatch.setattr(memory_store, 'MAX_FACTS', 3)
+
+    path = str(tmp_path / "memory.sqlite3")
+    unsaved = ConversationMemory("trip", budget=60, counter=counter)
+
+    for question, answer in TURNS:
+        unsaved.record_turn(question, answer)
+
+        # EVERY TURN IS RECORDED THROUGH A FRESH STORE, AS IF THE PROCESS HAD RESTARTED BEFORE IT
+        store = MemoryStore(path, budget=60, counter=counter)
+        store.session("trip").record_turn(question, answer)
+        store.close()
+
+        assert state(MemoryStore(path, budget=60, counter=counter).session("trip")) == state(unsaved)
+
+    assert len(TURNS) * 2 > memory_store.HISTORY_TURNS
+    assert unsaved.facts_compacted
+    assert unsaved.summary_text
+
+
+def test_sessions_are_kept_apart_and_deleted(tmp_path, counter):
+    path = str(tmp_path / "memory.sqlite3")
+
+    store = MemoryStore(path, counter=counter)
+    store.session("a").record_turn(*TURNS[0])
+    store.session("b").record_turn(*TURNS[1])
+    store.delete("a")
+    store.close()
+
+    reopened = MemoryStore(path, counter=counter)
+    assert reopened.session("a").conversation_history == []
+    assert reopened.session("a").memory_items == []
+    assert reopened.session("b").conversation_history == [
+        {'role': 'user', 'content': TURNS[1][0]},
+        {'role': 'assistant', 'content': TURNS[1][1]}
+    ]
+
+
+def test_loading_with_a_smaller_budget_compacts_and_saves(tmp_path, counter):
+    path = str(tmp_path / "memory.sqlite3")
+
+    store = MemoryStore(path, counter=counter)
+    memory = store.session("trip")
+    for question, answer in TURNS:
+        memory.record_turn(question, answer)
+    store.close()
+
+    small = MemoryStore(path, budget=30, counter=counter).session("trip")
+    assert small.tokens <= 30
+    assert small.facts_compacted > memory.facts_compacted
+
+    again = MemoryStore(path, budget=30, counter=counter).session("trip")
+    assert state(again) == state(small)
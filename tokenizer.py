@@ -0,0 +1,148 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import tiktoken
+
+
+ENCODING_NAME = "cl100k_base"
+CACHE_SIZE = 4096
+
+
+# A LOCAL tokenizer.json (E.G. A MODEL'S OWN TOKENIZER EXPORTED FROM HUGGING FACE), WRAPPED TO LOOK LIKE A tiktoken ENCODING
+# THE tokenizers PACKAGE IS ONLY NEEDED WHEN A PROFILE ACTUALLY POINTS AT ONE OF THESE FILES
+class FileEncoding:
+
+    def __init__(self, path):
+        from tokenizers import Tokenizer
+
+        self.name = path
+        self._tokenizer = Tokenizer.from_file(path)
+
+    def encode(self, text):
+        return self._tokenizer.encode(text, add_special_tokens=False).ids
+
+    def encode_batch(self, texts):
+        return [encoding.ids for encoding in self._tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+    def decode(self, tokens):
+        return self._tokenizer.decode(tokens)
+
+
+def is_tokenizer_file(encoding_name):
+
+    return encoding_name.endswith('.json')
+
+
+# AN ENCODING IS EITHER A tiktoken NAME ("cl100k_base") OR THE PATH OF A tokenizer.json FILE
+# LOADING ONE IS EXPENSIVE (BPE RANKS, MERGES), SO EACH IS LOADED AT MOST ONCE PER PROCESS
+@lru_cache(maxsize=None)
+def load_encoding(encoding_name):
+
+    if is_tokenizer_file(encoding_name):
+        return FileEncoding(os.path.abspath(encoding_name))
+
+    return tiktoken.get_encoding(encoding_name)
+
+
+# WE LOAD THE ENCODING ONCE AND KEEP AN LRU CACHE OF TOKEN ARRAYS KEYED BY A HASH OF THE TEXT
+# THE SAME POLICY CHUNKS AND INSTRUCTIONS COME BACK ON EVERY QUERY, SO MOST LOOKUPS NEVER HIT THE ENCODER
+class TokenCounter:
+
+    def __init__(self, encoding_name=ENCODING_NAME, cache_size=CACHE_SIZE):
+        self.encoding_name = encoding_name
+        self.cache_size = cache_size
+        self._encoding = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            self._encoding = load_encoding(self.encoding_name)
+        return self._encoding
+
+    @staticmethod
+    def _key(text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def _get(self, key):
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return tokens
+
+    def _put(self, key, tokens):
+        with self._lock:
+            self._cache[key] = tokens
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def encode(self, text):
+        key = self._key(text)
+        tokens = self._get(key)
+        if tokens is None:
+            tokens = tuple(self.encoding.encode(text))
+            self._put(key, tokens)
+        return tokens
+
+    def encode_many(self, texts):
+        keys = [self._key(text) for text in texts]
+        results = [self._get(key) for key in keys]
+
+        # ONLY THE CACHE MISSES GO THROUGH THE ENCODER, AND THEY GO TOGETHER IN ONE encode_batch CALL
+        missing = [i for i, tokens in enumerate(results) if tokens is None]
+        if missing:
+            encoded = self.encoding.encode_batch([texts[i] for i in missing])
+            for i, tokens in zip(missing, encoded):
+                results[i] = tuple(tokens)
+                self._put(keys[i], results[i])
+
+        return results
+
+    def count(self, text):
+        return len(self.encode(text))
+
+    def count_many(self, texts):
+        return [len(tokens) for tokens in self.encode_many(texts)]
+
+    def decode(self, tokens):
+        return self.encoding.decode(list(tokens))
+
+    def truncate(self, text, max_tokens):
+        tokens = self.encode(text)
+
+        if len(tokens) <= max_tokens:
+            return text, len(tokens), False
+
+        return self.decode(tokens[:max_tokens]), max_tokens, True
+
+    def cache_info(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._cache),
+                'max_size': self.cache_size
+            }
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# ONE SHARED COUNTER PER ENCODING FOR THE WHOLE PROCESS
+@lru_cache(maxsize=None)
+def get_counter(encoding_name=ENCODING_NAME):
+    return TokenCounter(encoding_name)
@@ -1,67 +1,567 @@
-from langchain_ollama import OllamaEmbeddings
-from langchain_chroma import Chroma
-from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from models import model_counter
+import argparse
+import concurrent.futures
+import hashlib
+import json
 import os
-import glob
+import sys
+import threading
+import time
 
 
 POLICIES_FOLDER = "policies"
 DB_LOCATION = "./chroma_db"
 EMBEDDING_MODEL = "mxbai-embed-large"
+COLLECTION_NAME = "travel_expense_policies"
+MANIFEST_NAME = "index_manifest.json"
+CHECKPOINT_NAME = "ingest_checkpoint.jsonl"
+LEXICAL_INDEX_NAME = "bm25_index.json"
+ROUTER_NAME = "source_router.json"
 
+DEFAULT_CONFIG = {
+    'db_location': DB_LOCATION,
+    'collection_name': COLLECTION_NAME,
+    'embedding_model': EMBEDDING_MODEL,
+    'backend': 'chroma',
+    'ivf_nlist': None,
+    'ivf_nprobe': 8,
+    'k': 6,
+    'cache': True,
+    'cache_size': 1024,
+    'cache_ttl': 3600,
+    'embedding_client_kwargs': None,
+    'hybrid': True,
+    'hybrid_latency_budget': 3.0,
+    'lexical_fast_path': True,
+    'routing': True
+}
 
-# WE FIND ALL .txt FILES IN THE POLICIES FOLDER
-policy_files = glob.glob(os.path.join(POLICIES_FOLDER, "*.txt"))
-
-
-# WE THEN BREAK LONG DOCUMENTS INTO SMALLER CHUNKS SO WE CAN RETRIEVE RELEVANT PARTS AND NOT ENTIRE DOCUMENTS
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=500,
-    chunk_overlap=50,
-    length_function=len,
-    separators=["\n\n", "\n", ". ", " ", ""]
-)
-
-all_documents = []
-chunk_id = 0
-
-for policy_file in policy_files:
-    filename = os.path.basename(policy_file)
-    
-    with open(policy_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    chunks = text_splitter.split_text(content)
-    for i, chunk_text in enumerate(chunks):
-        document = Document(
-            page_content=chunk_text,
-            metadata={
-                "source": filename,
-                "chunk_id": f"{filename}_{i}"
-            }
+
+# IMPORTING THIS MODULE HAS NO SIDE EFFECTS: NOTHING IS READ, SPLIT OR EMBEDDED, AND THE HEAVY
+# LANGCHAIN / CHROMA / OLLAMA IMPORTS ARE DEFERRED UNTIL A STORE IS ACTUALLY OPENED
+_cache = {}
+_cache_lock = threading.Lock()
+_opening = {}
+open_timings = {}
+
+
+def resolve_config(config=None):
+
+    return {**DEFAULT_CONFIG, **(config or {})}
+
+
+def manifest_file(db_location=DB_LOCATION):
+
+    return os.path.join(db_location, MANIFEST_NAME)
+
+
+def checkpoint_file(db_location=DB_LOCATION):
+
+    return os.path.join(db_location, CHECKPOINT_NAME)
+
+
+def lexical_index_file(db_location=DB_LOCATION):
+
+    return os.path.join(db_location, LEXICAL_INDEX_NAME)
+
+
+def router_file(db_location=DB_LOCATION):
+
+    return os.path.join(db_location, ROUTER_NAME)
+
+
+# ANYTHING THAT CHANGES HOW CHUNKS ARE CUT, EMBEDDED OR COUNTED INVALIDATES THE WHOLE INDEX
+def index_signature(embedding_model=EMBEDDING_MODEL, backend='chroma'):
+
+    import ingest
+
+    settings = {
+        'embedding_model': embedding_model,
+        'chunker': 'tokens',
+        'chunk_tokens': ingest.text_splitter.target_tokens,
+        'chunk_overlap_tokens': ingest.text_splitter.overlap_tokens,
+        'token_encoding': model_counter().encoding_name
+    }
+    # SWITCHING BACKENDS OVER THE SAME DIRECTORY STARTS FROM AN EMPTY STORE, SO IT MUST RE-EMBED TOO
+    # (CHROMA ADDS NOTHING, SO INDEXES BUILT BEFORE THERE WAS A CHOICE STAY VALID)
+    if backend != 'chroma':
+        settings['backend'] = backend
+    return ingest.content_hash(json.dumps(settings, sort_keys=True))
+
+
+def load_manifest(db_location=DB_LOCATION):
+
+    path = manifest_file(db_location)
+
+    if not os.path.exists(path):
+        return {'signature': None, 'files': {}}
+
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# EVERY SAVE STAMPS THE MANIFEST WITH A VERSION DERIVED FROM ITS CONTENT, WHICH CACHES USE TO DETECT A RE-INDEX
+def save_manifest(manifest, db_location=DB_LOCATION):
+
+    path = manifest_file(db_location)
+    os.makedirs(db_location, exist_ok=True)
+    tmp_file = path + ".tmp"
+
+    content = {'signature': manifest['signature'], 'files': manifest['files']}
+    content['version'] = hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(content, f, indent=2, sort_keys=True)
+
+    os.replace(tmp_file, path)
+
+
+# THE INDEX VERSION IS RE-READ ONLY WHEN THE MANIFEST FILE CHANGES ON DISK, SO CHECKING IT PER QUERY IS ONE stat()
+# A RE-INDEX FROM ANOTHER PROCESS (E.G. `python vector_db.py`) IS PICKED UP BY RUNNING APPS AUTOMATICALLY
+_version_cache = {}
+
+
+def index_version(db_location=DB_LOCATION):
+
+    path = manifest_file(db_location)
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _version_cache.get(path)
+
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    version = load_manifest(db_location).get('version')
+    _version_cache[path] = (stamp, version)
+
+    return version
+
+
+# WE COMPARE THE POLICIES FOLDER AGAINST THE MANIFEST AND WORK OUT THE SMALLEST SET OF CHANGES
+# FILES WHOSE HASH IS UNCHANGED ARE NOT EVEN SPLIT; CHANGED FILES ONLY EMBED CHUNKS WHOSE CONTENT IS NEW
+def plan_index(manifest, policies_folder=POLICIES_FOLDER, split_workers=None):
+
+    import ingest
+
+    old_files = manifest['files']
+
+    plan = {
+        'added': [],
+        'changed': [],
+        'removed': [],
+        'unchanged': [],
+        'embed': [],
+        'delete': [],
+        'reindex': [],
+        'files': {},
+        'stats': {}
+    }
+
+    to_split = []
+    file_hashes = {}
+
+    for filename, content in ingest.iter_policy_files(policies_folder):
+        file_hash = ingest.content_hash(content)
+        old_entry = old_files.get(filename)
+
+        if old_entry and old_entry['hash'] == file_hash:
+            plan['unchanged'].append(filename)
+            plan['files'][filename] = old_entry
+            continue
+
+        plan['changed' if old_entry else 'added'].append(filename)
+        to_split.append((filename, content))
+        file_hashes[filename] = file_hash
+
+    split_results, plan['stats']['split'] = ingest.split_files(to_split, workers=split_workers or ingest.SPLIT_WORKERS)
+
+    for filename, documents in split_results.items():
+        old_entry = old_files.get(filename)
+        old_positions = {chunk['id']: i for i, chunk in enumerate(old_entry['chunks'])} if old_entry else {}
+        new_ids = set()
+
+        for i, document in enumerate(documents):
+            new_ids.add(document.id)
+
+            if document.id not in old_positions:
+                plan['embed'].append(document)
+            elif old_positions[document.id] != i:
+                plan['reindex'].append(document)
+
+        plan['delete'].extend(chunk_id for chunk_id in old_positions if chunk_id not in new_ids)
+
+        plan['files'][filename] = {
+            'hash': file_hashes[filename],
+            'chunks': [{'id': document.id, 'hash': ingest.content_hash(document.page_content)} for document in documents]
+        }
+
+    for filename, old_entry in old_files.items():
+        if filename not in plan['files']:
+            plan['removed'].append(filename)
+            plan['delete'].extend(chunk['id'] for chunk in old_entry['chunks'])
+
+    return plan
+
+
+def plan_has_changes(plan):
+
+    return bool(plan['embed'] or plan['delete'] or plan['reindex'])
+
+
+# WE APPLY A PLAN TO THE VECTOR STORE: DELETE REMOVED CHUNKS, UPSERT NEW ONES, AND REFRESH THE POSITION OF MOVED ONES
+# A REBUILD (OR A CHANGE IN CHUNKING / EMBEDDING SETTINGS) EMPTIES THE COLLECTION AND RE-EMBEDS EVERYTHING
+def sync_index(vector_store, config=None, rebuild=False, dry_run=False, batch_size=None,
+               embed_workers=None, split_workers=None):
+
+    import ingest
+
+    config = resolve_config(config)
+    db_location = config['db_location']
+    manifest = load_manifest(db_location)
+    signature = index_signature(config['embedding_model'], config['backend'])
+
+    if rebuild or manifest['signature'] != signature:
+        manifest = {'signature': signature, 'files': {}}
+        if not dry_run:
+            vector_store.reset_collection()
+            ingest.clear_checkpoint(checkpoint_file(db_location))
+            # THE EMPTY MANIFEST IS SAVED RIGHT AWAY SO AN INTERRUPTED REBUILD RESUMES INSTEAD OF TRUSTING THE OLD ONE
+            save_manifest(manifest, db_location)
+
+    plan = plan_index(manifest, split_workers=split_workers)
+
+    if dry_run:
+        return plan
+
+    if plan['delete']:
+        vector_store.delete(ids=plan['delete'])
+
+    plan['stats']['embed'] = ingest.embed_and_store(
+        vector_store,
+        plan['embed'],
+        checkpoint_file(db_location),
+        signature,
+        batch_size=batch_size or ingest.EMBED_BATCH_SIZE,
+        workers=embed_workers or ingest.EMBED_WORKERS
+    )
+
+    # MOVED CHUNKS KEEP THEIR EMBEDDING; ONLY THEIR METADATA (chunk_index) IS REWRITTEN
+    if plan['reindex']:
+        ingest.collection_of(vector_store).update(
+            ids=[document.id for document in plan['reindex']],
+            metadatas=[document.metadata for document in plan['reindex']]
+        )
+
+    save_manifest({'signature': signature, 'files': plan['files']}, db_location)
+    ingest.clear_checkpoint(checkpoint_file(db_location))
+
+    build_lexical_index(vector_store, db_location)
+    build_router(vector_store, db_location)
+
+    return plan
+
+
+# THE BM25 INDEX IS REBUILT FROM THE COLLECTION AFTER EVERY SYNC (A FEW HUNDRED CHUNKS TAKE MILLISECONDS)
+# AND STAMPED WITH THE MANIFEST VERSION, SO A STALE FILE IS NEVER MISTAKEN FOR THE CURRENT ONE
+def build_lexical_index(vector_store, db_location=DB_LOCATION):
+
+    from langchain_core.documents import Document
+    from lexical import BM25Index
+
+    stored = vector_store.get(include=['documents', 'metadatas'])
+    documents = [
+        Document(id=chunk_id, page_content=text, metadata=metadata or {})
+        for chunk_id, text, metadata in zip(stored['ids'], stored['documents'], stored['metadatas'])
+    ]
+    documents.sort(key=lambda document: (document.metadata.get('source', ''), document.metadata.get('chunk_index', 0)))
+
+    index = BM25Index.build(documents, version=index_version(db_location))
+    index.save(lexical_index_file(db_location))
+
+    return index
+
+
+# WE LOAD THE PERSISTED BM25 INDEX FOR THE CURRENT INDEX VERSION, REBUILDING IT IF IT IS MISSING OR OUT OF DATE
+# (E.G. A DATABASE INDEXED BEFORE THE LEXICAL INDEX EXISTED)
+def get_lexical_index(config=None):
+
+    config = resolve_config(config)
+    version = index_version(config['db_location'])
+    key = ('lexical', config['db_location'], version)
+
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+
+    from lexical import BM25Index
+
+    path = lexical_index_file(config['db_location'])
+    index = BM25Index.load(path) if os.path.exists(path) else None
+
+    if index is None or index.version != version:
+        index = build_lexical_index(get_vector_store(config), config['db_location'])
+
+    with _cache_lock:
+        for stale in [cached for cached in _cache if cached[:2] == key[:2] and cached != key]:
+            del _cache[stale]
+        return _cache.setdefault(key, index)
+
+
+# THE SOURCE ROUTER'S KEYWORD TABLE AND PER-FILE CENTROIDS COME FROM THE STORED CHUNKS AND THEIR EMBEDDINGS,
+# SO BUILDING IT NEVER CALLS THE EMBEDDING MODEL. IT IS VERSIONED LIKE THE BM25 INDEX
+def build_router(vector_store, db_location=DB_LOCATION):
+
+    from router import SourceRouter
+
+    stored = vector_store.get(include=['documents', 'metadatas', 'embeddings'])
+    router = SourceRouter.build(
+        stored['documents'], stored['metadatas'], stored['embeddings'], version=index_version(db_location)
+    )
+    router.save(router_file(db_location))
+
+    return router
+
+
+def get_router(config=None):
+
+    config = resolve_config(config)
+    version = index_version(config['db_location'])
+    key = ('router', config['db_location'], version)
+
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+
+    from router import SourceRouter
+
+    path = router_file(config['db_location'])
+    router = SourceRouter.load(path) if os.path.exists(path) else None
+
+    if router is None or router.version != version:
+        router = build_router(get_vector_store(config), config['db_location'])
+
+    with _cache_lock:
+        for stale in [cached for cached in _cache if cached[:2] == key[:2] and cached != key]:
+            del _cache[stale]
+        return _cache.setdefault(key, router)
+
+
+def describe_plan(plan):
+
+    lines = [
+        f"Files: {len(plan['added'])} added, {len(plan['changed'])} changed, "
+        f"{len(plan['removed'])} removed, {len(plan['unchanged'])} unchanged",
+        f"Chunks: {len(plan['embed'])} to embed, {len(plan['delete'])} to delete, "
+        f"{len(plan['reindex'])} moved"
+    ]
+
+    split_stats = plan['stats'].get('split')
+    if split_stats and split_stats['files']:
+        lines.append(
+            f"Split: {split_stats['chunks']} chunks from {split_stats['files']} files "
+            f"in {split_stats['seconds']:.2f}s ({split_stats['chunks_per_sec']:.0f} chunks/sec)"
         )
-        all_documents.append(document)
-        chunk_id += 1
 
+    embed_stats = plan['stats'].get('embed')
+    if embed_stats and embed_stats['batches']:
+        lines.append(
+            f"Embed: {embed_stats['embedded']} chunks in {embed_stats['batches']} batches "
+            f"in {embed_stats['seconds']:.2f}s ({embed_stats['embeddings_per_sec']:.1f} embeddings/sec, "
+            f"{embed_stats['retries']} retries, {embed_stats['skipped']} resumed from checkpoint)"
+        )
+
+    for label in ('added', 'changed', 'removed'):
+        for filename in plan[label]:
+            lines.append(f"  {label}: {filename}")
+
+    return "\n".join(lines)
+
+
+# WE OPEN (AND CACHE) THE PERSISTED STORE FOR A CONFIG. STARTUP NEVER READS OR SPLITS THE POLICIES;
+# THE ONLY EXCEPTION IS THE VERY FIRST RUN, WHEN NO DATABASE EXISTS YET AND WE HAVE TO INGEST ONCE
+# THAT INGEST CAN TAKE MINUTES, SO IT RUNS OUTSIDE _cache_lock: THE FIRST CALLER FOR A KEY OPENS THE STORE AND
+# PUBLISHES IT THROUGH A FUTURE IN _opening, LATER CALLERS FOR THE SAME KEY WAIT ON THAT FUTURE, AND EVERY
+# OTHER LOOKUP (OTHER STORES, RETRIEVERS, index_version, /health) CARRIES ON
+def get_vector_store(config=None, ingest_if_missing=True):
+
+    config = resolve_config(config)
+    key = (
+        'store', config['backend'], config['db_location'], config['collection_name'], config['embedding_model'],
+        repr(config['embedding_client_kwargs']), config['ivf_nlist'], config['ivf_nprobe']
+    )
+
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+
+        waiting = _opening.get(key)
+        if waiting is None:
+            opening = _opening[key] = concurrent.futures.Future()
+
+    if waiting is not None:
+        return waiting.result()
+
+    try:
+        vector_store = open_vector_store(config, key, ingest_if_missing)
+    except BaseException as error:
+        with _cache_lock:
+            del _opening[key]
+        opening.set_exception(error)
+        raise
+
+    with _cache_lock:
+        _cache[key] = vector_store
+        del _opening[key]
+    opening.set_result(vector_store)
+
+    return vector_store
+
+
+def open_vector_store(config, key, ingest_if_missing=True):
+
+    start = time.perf_counter()
+
+    from langchain_ollama import OllamaEmbeddings
+
+    database_missing = not os.path.exists(config['db_location'])
+    embeddings = OllamaEmbeddings(
+        model=config['embedding_model'],
+        client_kwargs=config['embedding_client_kwargs'] or {}
+    )
+
+    # 'flat' IS THE IN-PROCESS MEMORY-MAPPED NUMPY STORE (flat_store.py), 'ivf' ADDS AN APPROXIMATE
+    # INVERTED-FILE INDEX ON TOP OF IT (ivf_store.py); 'chroma' IS THE DEFAULT
+    if config['backend'] == 'flat':
+        from flat_store import FlatVectorStore
+
+        vector_store = FlatVectorStore(config['collection_name'], config['db_location'], embeddings)
+    elif config['backend'] == 'ivf':
+        from ivf_store import IVFVectorStore
+
+        vector_store = IVFVectorStore(
+            config['collection_name'],
+            config['db_location'],
+            embeddings,
+            nlist=config['ivf_nlist'],
+            nprobe=config['ivf_nprobe']
+        )
+    elif config['backend'] == 'chroma':
+        from langchain_chroma import Chroma
+
+        vector_store = Chroma(
+            collection_name=config['collection_name'],
+            persist_directory=config['db_location'],
+            embedding_function=embeddings
+        )
+    else:
+        raise ValueError(f"Unknown vector store backend {config['backend']!r}; expected 'chroma', 'flat' or 'ivf'")
+
+    if database_missing and ingest_if_missing:
+        sync_index(vector_store, config)
+
+    open_timings[key] = time.perf_counter() - start
+
+    return vector_store
+
+
+# WE THEN CREATE A RETRIEVER THAT WILL FIND AND RETURN THE TOP k (DEFAULT 6) MOST RELEVANT CHUNKS
+# WITH routing ON, THE VECTOR SEARCH IS LIMITED TO THE POLICY FILES THE QUESTION IS ABOUT (SEE router.py)
+# WITH hybrid ON, VECTOR RESULTS ARE FUSED WITH THE BM25 INDEX (SEE hybrid.py)
+def get_retriever(config=None):
+
+    config = resolve_config(config)
+    key = ('retriever',) + tuple(sorted((name, repr(value)) for name, value in config.items()))
+
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+
+    vector_store = get_vector_store(config)
+
+    # ROUTING NEEDS THE QUERY EMBEDDING, WHICH ONLY THE CACHED RETRIEVER HANDS TO THE STORE, AND THE HYBRID
+    # RETRIEVER DELEGATES EMBEDDING AND SEARCH TO IT, SO WITH THE CACHE OFF WE STILL USE IT, WITH ENTRIES THAT
+    # EXPIRE IMMEDIATELY
+    if config['cache'] or config['routing'] or config['hybrid']:
+        from retrieval_cache import CachedRetriever
+
+        if config['routing']:
+            get_router(config)
+
+        retriever = CachedRetriever(
+            vector_store,
+            k=config['k'],
+            version_fn=lambda: index_version(config['db_location']),
+            max_entries=config['cache_size'] if config['cache'] else 1,
+            ttl=config['cache_ttl'] if config['cache'] else 0,
+            router_fn=(lambda: get_router(config)) if config['routing'] else None
+        )
+    else:
+        retriever = vector_store.as_retriever(search_kwargs={"k": config['k']})
+
+    if config['hybrid']:
+        from hybrid import FAST_PATH_MARGIN, HybridRetriever
+
+        get_lexical_index(config)
+        retriever = HybridRetriever(
+            retriever,
+            index_fn=lambda: get_lexical_index(config),
+            k=config['k'],
+            latency_budget=config['hybrid_latency_budget'],
+            fast_path_margin=FAST_PATH_MARGIN if config['lexical_fast_path'] else None
+        )
+
+    with _cache_lock:
+        return _cache.setdefault(key, retriever)
+
+
+def clear_cache():
+
+    with _cache_lock:
+        _cache.clear()
+        open_timings.clear()
+
+
+# KEEPS `from vector_db import retriever` WORKING, BUT ONLY OPENS THE STORE WHEN IT IS FIRST USED
+def __getattr__(name):
 
-# WE THEN CREATE EMBEDDINGS AND VECTOR STORE
-add_documents = not os.path.exists(DB_LOCATION)
+    if name == 'retriever':
+        return get_retriever()
+    if name == 'vector_store':
+        return get_vector_store()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-embeddings = OllamaEmbeddings(model=EMBEDDING_MODEL)
 
-vector_store = Chroma(
-    collection_name="travel_expense_policies",
-    persist_directory=DB_LOCATION,
-    embedding_function=embeddings
-)
+# RUN `python vector_db.py` AFTER EDITING POLICIES TO RE-EMBED ONLY WHAT CHANGED
+if __name__ == "__main__":
+    import ingest
 
-if add_documents:
-    vector_store.add_documents(documents=all_documents)
+    parser = argparse.ArgumentParser(description="Incrementally index the policies folder into the vector store")
+    parser.add_argument("--rebuild", action="store_true", help="drop the collection and re-embed every policy file")
+    parser.add_argument("--check", action="store_true", help="report what would change without embedding anything")
+    parser.add_argument("--batch-size", type=int, default=ingest.EMBED_BATCH_SIZE, help="chunks per embedding request")
+    parser.add_argument("--embed-workers", type=int, default=ingest.EMBED_WORKERS, help="concurrent embedding requests")
+    parser.add_argument("--split-workers", type=int, default=ingest.SPLIT_WORKERS, help="processes used to split files")
+    parser.add_argument("--backend", choices=["chroma", "flat", "ivf"], default=DEFAULT_CONFIG['backend'], help="vector store backend")
+    parser.add_argument("--db-location", default=DB_LOCATION, help="directory holding the index")
+    args = parser.parse_args()
 
+    cli_config = {'backend': args.backend, 'db_location': args.db_location}
 
-# WE THEN CREATE A RETRIEVER THAT WILL FIND AND RETURN THE TOP 6(k=6) MOST RELEVANT CHUNKS
-retriever = vector_store.as_retriever(
-    search_kwargs={"k": 6}
-)
+    plan = sync_index(
+        get_vector_store(cli_config, ingest_if_missing=False),
+        cli_config,
+        rebuild=args.rebuild,
+        dry_run=args.check,
+        batch_size=args.batch_size,
+        embed_workers=args.embed_workers,
+        split_workers=args.split_workers
+    )
+    print(describe_plan(plan))
 
+    if args.check and plan_has_changes(plan):
+        sys.exit(1)